@@ -0,0 +1,297 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import numpy as np
+import model_registry
+import instrumentation
+
+# This module chooses the batch size and the number of threads of the models for a memory budget
+# The memory needed per sequence is estimated from the inputs (12,000 nt of padded sequence or structure,
+# 32,768 graph features) and the activations of the model and is then measured by predicting a calibration batch
+# The batch size is chosen so that the current memory of the process plus one batch of every concurrently running
+# model stay below the budget, the run_* scripts predict every batch of that size in one call of the model
+# Only the batch size is tuned by measurements, the number of threads is not calibrated: the usable cores are divided
+# among the models that run at the same time (see choose_threads)
+# The measurements and the chosen settings are saved per model, backend and host, so later runs on the same host
+# skip the calibration
+# The autotuning is enabled by a memory budget, either with the environment variable NCRNA_MEMORY_BUDGET (e.g. 16G)
+# or with model_registry.set_memory_budget, and is run by model_registry.get_model when a model is loaded
+
+# Default location of the saved settings
+DEFAULT_CACHE_FILE = os.path.expanduser("~/.cache/ncrna_classifier/autotune.json")
+
+# Widths of the inputs of the models and the number of bytes per value while they are predicted
+# Padded sequences and structures are uint8 matrices, which the models convert to float32, graph features are float32
+SEQUENCE_LENGTH = 12000
+GRAPH_FEATURES = 32768
+MODEL_INPUT_BYTES = {"mncr": SEQUENCE_LENGTH * (1 + 4) + GRAPH_FEATURES * 4,
+                     "seqenc": SEQUENCE_LENGTH * (1 + 4),
+                     "strenc": SEQUENCE_LENGTH * (1 + 4),
+                     "grenc": GRAPH_FEATURES * 4}
+
+# Limits of the batch size and the size of the calibration batch
+MIN_BATCH_SIZE = 1
+MAX_BATCH_SIZE = 8192
+CALIBRATION_BATCH_SIZE = 256
+
+# Fraction of the free budget that is used for the batches, the rest is left for the decoding and writing
+BUDGET_FRACTION = 0.8
+
+MEMORY_UNITS = {"": 1, "B": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+########################################################################################################################
+
+
+def parse_memory_size(text):
+
+    # This function converts a memory size like "16G", "512M" or "1000000" into bytes
+
+    text = str(text).strip().upper().removesuffix("IB").removesuffix("B")
+    unit = text[-1] if text != "" and text[-1] in MEMORY_UNITS else ""
+    try:
+        size = float(text[:len(text) - len(unit)])
+    except ValueError:
+        raise ValueError(f"Invalid memory size {text}, use e.g. 16G or 512M")
+    if size <= 0:
+        raise ValueError(f"Invalid memory size {text}, it has to be larger than 0")
+    return int(size * MEMORY_UNITS[unit])
+
+########################################################################################################################
+
+
+def available_cores():
+
+    # This function returns the number of cpu cores the process may run on
+
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+########################################################################################################################
+
+
+def host_key():
+
+    # This function describes the host by its name, its usable cores and its memory
+    # Settings are only reused on hosts with the same description
+
+    try:
+        memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        memory = 0
+    return f"{socket.gethostname()} {available_cores()} cores {memory / 1024 ** 3:.0f} GB"
+
+########################################################################################################################
+
+
+def read_settings(cache_file=DEFAULT_CACHE_FILE):
+
+    # This function returns the saved settings of all models and hosts
+
+    try:
+        with open(cache_file, "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+########################################################################################################################
+
+
+def save_settings(key, settings, cache_file=DEFAULT_CACHE_FILE):
+
+    # This function saves the settings of one model and host
+    # The file is replaced atomically, so processes that tune at the same time do not corrupt it
+
+    if os.path.dirname(cache_file) != "":
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    all_settings = read_settings(cache_file)
+    all_settings[key] = settings
+    with open(f"{cache_file}.{os.getpid()}.tmp", "w") as file:
+        json.dump(all_settings, file, indent=1, sort_keys=True)
+    os.replace(f"{cache_file}.{os.getpid()}.tmp", cache_file)
+
+########################################################################################################################
+
+
+def settings_key(model_name):
+
+    # This function returns the key of the settings of a model with the current backend on this host
+
+    return f"{model_name} {model_registry.backend} {host_key()}"
+
+########################################################################################################################
+
+
+def choose_threads(model_name, cache_file=DEFAULT_CACHE_FILE):
+
+    # This function returns the number of intra-op and inter-op threads for a model
+    # The saved thread counts are used if the model was tuned on this host before, otherwise the usable cores are
+    # divided among the models that run at the same time
+    # The thread counts are not measured, they only keep concurrently running models from competing for the cores
+    # tensorflow uses the same threads for all models, so they have to be set before the first model is loaded
+
+    settings = read_settings(cache_file).get(settings_key(model_name))
+    if settings is not None:
+        return settings["intra_op_threads"], settings["inter_op_threads"]
+    cores = available_cores()
+    return max(1, cores // max(1, model_registry.concurrent_models)), min(2, cores)
+
+########################################################################################################################
+
+
+def count_activations(model):
+
+    # This function returns the number of values of all layer outputs of a model for one sequence
+    # For TFLite models, these are the tensors whose first dimension is the batch
+
+    if isinstance(model, model_registry.TFLiteModel):
+        return sum(int(np.prod(details["shape"][1:])) for details in model.interpreter.get_tensor_details()
+                   if len(details["shape_signature"]) > 0 and details["shape_signature"][0] == -1)
+
+    num_values = 0
+    for layer in model.layers:
+        try:
+            outputs = layer.output if isinstance(layer.output, (list, tuple)) else [layer.output]
+        except (AttributeError, ValueError):
+            continue
+        num_values = num_values + sum(int(np.prod([size or 1 for size in output.shape[1:]])) for output in outputs)
+    return num_values
+
+########################################################################################################################
+
+
+def estimate_bytes_per_sequence(model_name, model):
+
+    # This function estimates the memory needed per sequence of a batch from the inputs and the activations
+    # All activations are counted as if they were kept until the end of the batch, so the estimate is an upper bound
+
+    return MODEL_INPUT_BYTES[model_name] + 4 * count_activations(model)
+
+########################################################################################################################
+
+
+def calibration_inputs(model_name, batch_size):
+
+    # This function returns a batch of fully padded inputs of a model, which are as large as any real batch
+
+    import data_processing
+    sequences = np.full((batch_size, SEQUENCE_LENGTH), data_processing.NUCLEOTIDE_PAD_VALUE, dtype=np.uint8)
+    if model_name == "mncr":
+        return [sequences, np.zeros((batch_size, GRAPH_FEATURES), dtype=np.float32)]
+    elif model_name == "seqenc":
+        return sequences
+    elif model_name == "strenc":
+        return np.full((batch_size, SEQUENCE_LENGTH), data_processing.STRUCTURE_PAD_VALUE, dtype=np.uint8)
+    else:
+        return np.zeros((batch_size, GRAPH_FEATURES), dtype=np.float32)
+
+########################################################################################################################
+
+
+def calibrate(model_name, model, batch_size):
+
+    # This function predicts a calibration batch of batch_size sequences and measures the memory and time per sequence
+    # A first small batch is predicted before, so that the one-time setup of the prediction is not measured
+    # Returns the bytes and the seconds per sequence, the bytes are 0 if the peak memory cannot be measured
+
+    model.predict(calibration_inputs(model_name, 1), verbose=0, batch_size=1)
+
+    inputs = calibration_inputs(model_name, batch_size)
+    instrumentation.reset_peak_rss()
+    rss_before = instrumentation.read_peak_rss()
+    start_time = time.perf_counter()
+    # The calibration batch is predicted at once like the batches of the runs, see run_seqenc.predict_batches
+    model.predict(inputs, verbose=0, batch_size=batch_size)
+    seconds = time.perf_counter() - start_time
+    # The inputs were allocated before the measurement started
+    input_bytes = sum(array.nbytes for array in (inputs if isinstance(inputs, list) else [inputs]))
+    peak_increase = instrumentation.read_peak_rss() - rss_before
+
+    bytes_per_sequence = (peak_increase + input_bytes) / batch_size if peak_increase > 0 else 0
+    return bytes_per_sequence, seconds / batch_size
+
+########################################################################################################################
+
+
+def budget_batch_size(bytes_per_sequence, memory_budget):
+
+    # This function returns the largest batch size for which one batch of every concurrently running model fits into
+    # the part of the memory budget that is not used by the process yet
+
+    instrumentation.reset_peak_rss()
+    free_bytes = (memory_budget - instrumentation.read_peak_rss()) * BUDGET_FRACTION
+    batch_size = int(free_bytes / max(1, model_registry.concurrent_models) / max(bytes_per_sequence, 1))
+    return min(MAX_BATCH_SIZE, max(MIN_BATCH_SIZE, batch_size))
+
+########################################################################################################################
+
+
+def tune(model_name, model, memory_budget=None, cache_file=DEFAULT_CACHE_FILE, recalibrate=False):
+
+    # This function chooses the batch size of a loaded model for the memory budget (in bytes, by default the budget
+    # of model_registry) and sets it in model_registry
+    # The memory per sequence is taken from the saved settings of the model on this host, if the model file did not
+    # change since, otherwise it is estimated and measured by calibrate
+    # Returns the settings
+
+    if memory_budget is None:
+        memory_budget = parse_memory_size(model_registry.memory_budget)
+    key = settings_key(model_name)
+    model_file = model.tflite_file if isinstance(model, model_registry.TFLiteModel) else \
+        model_registry.MODEL_FILES[model_name]
+    model_mtime = os.path.getmtime(model_file) if os.path.isfile(model_file) else 0
+
+    settings = read_settings(cache_file).get(key)
+    if recalibrate or settings is None or settings["model_mtime"] != model_mtime:
+        with instrumentation.stage(f"autotune {model_name}"):
+            estimate = estimate_bytes_per_sequence(model_name, model)
+            calibration_size = min(CALIBRATION_BATCH_SIZE, budget_batch_size(estimate, memory_budget))
+            bytes_per_sequence, seconds_per_sequence = calibrate(model_name, model, calibration_size)
+        settings = {"model_mtime": model_mtime,
+                    "estimated_bytes_per_sequence": estimate,
+                    "bytes_per_sequence": bytes_per_sequence if bytes_per_sequence > 0 else estimate,
+                    "calibration_batch_size": calibration_size,
+                    "sequences_per_second": 1 / max(seconds_per_sequence, 1e-9),
+                    "intra_op_threads": model_registry.threads["intra_op"],
+                    "inter_op_threads": model_registry.threads["inter_op"]}
+
+    settings["memory_budget"] = memory_budget
+    settings["batch_size"] = budget_batch_size(settings["bytes_per_sequence"], memory_budget)
+    save_settings(key, settings, cache_file)
+    model_registry.batch_sizes[model_name] = settings["batch_size"]
+    return settings
+
+########################################################################################################################
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Choose the batch size and the number of threads of the models for a "
+                                                 "memory budget and save them for later runs on this host.")
+    parser.add_argument("memory_budget", help="Memory the process may use, e.g. 16G or 512M")
+    parser.add_argument("models", nargs="*", default=list(model_registry.MODEL_FILES),
+                        help="Models to tune, by default all models")
+    parser.add_argument("--backend", default=model_registry.backend, choices=list(model_registry.BACKENDS))
+    parser.add_argument("--concurrent", type=int, default=1,
+                        help="Number of models that predict at the same time and share the budget")
+    parser.add_argument("--recalibrate", action="store_true", help="Measure the memory again instead of reusing it")
+    args = parser.parse_args()
+
+    model_registry.set_backend(args.backend)
+    model_registry.set_memory_budget(args.memory_budget, args.concurrent)
+    for model_name in [model_name.lower() for model_name in args.models]:
+        if model_name not in model_registry.MODEL_FILES:
+            print(f"Unknown model {model_name}")
+            sys.exit(1)
+        # Loading the model tunes it with the saved settings or a new calibration
+        model = model_registry.get_model(model_name)
+        tuned = tune(model_name, model, recalibrate=True) if args.recalibrate else \
+            read_settings()[settings_key(model_name)]
+        print(f"{model_name}: batch size {tuned['batch_size']}, "
+              f"{tuned['intra_op_threads']} intra-op and {tuned['inter_op_threads']} inter-op threads, "
+              f"{tuned['bytes_per_sequence'] / 1024 ** 2:.2f} MB per sequence "
+              f"(estimated {tuned['estimated_bytes_per_sequence'] / 1024 ** 2:.2f} MB), "
+              f"{tuned['sequences_per_second']:.1f} sequences/s")
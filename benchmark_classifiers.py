@@ -53,5 +53,5 @@ if __name__ == '__main__':
     labels_file.close()
 
     # Print classification report, MCC and confusion matrix to files
-    output_analysis.return_output_analysis(labels, results)
-    output_analysis.plot_confusion_matrix(labels, results)
+    matrix = output_analysis.return_output_analysis(labels, results, num_bootstrap_samples=1000)
+    output_analysis.plot_matrix(matrix)
@@ -0,0 +1,327 @@
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
+import instrumentation
+
+# This script measures the throughput (sequences per second) and the peak memory of the preprocessing functions
+# and of the prediction step of every model on the test datasets and on synthetic datasets of any size
+# Every stage runs in a fresh process, so that the memory of one stage does not hide the memory of the next one
+# The results are saved as json and can be compared with a baseline of an earlier run to find regressions
+# In contrast to benchmark_classifiers.py, the quality of the predictions is not measured
+
+# Functions that create one python object or one dense row per nucleotide or feature are only run on the first
+# LEGACY_LIMIT sequences of a dataset, the models only predict the first PREDICT_LIMIT sequences
+LEGACY_LIMIT = 2000
+PREDICT_LIMIT = 2000
+
+# Stages that can be benchmarked, the inputs they need and the largest number of sequences they process
+STAGES = {"read_fasta_file": (["fasta"], None),
+          "read_fasta_chunks": (["fasta"], None),
+          "pad_sequences": (["fasta"], LEGACY_LIMIT),
+          "encode_nucleotides": (["fasta"], LEGACY_LIMIT),
+          "encode_nucleotide_matrix": (["fasta"], LEGACY_LIMIT),
+          "encode_ragged": (["fasta"], None),
+          "struc_annotator": (["structure"], None),
+          "struc_annotator_batch": (["structure"], None),
+          "struct_list_annotator": (["structure"], LEGACY_LIMIT),
+          "read_graphprot_vectors": (["feature"], LEGACY_LIMIT),
+          "read_graphprot_matrix": (["feature"], None),
+          "predict_seqenc": (["fasta"], PREDICT_LIMIT),
+          "predict_strenc": (["structure"], PREDICT_LIMIT),
+          "predict_grenc": (["feature"], PREDICT_LIMIT),
+          "predict_mncr": (["fasta", "feature"], PREDICT_LIMIT)}
+
+# Datasets of the repository, inputs that do not exist for a dataset are created synthetically
+TEST_DATASETS = {"small_testset_30": {"fasta": "testing_datasets/small_testset_30.fasta",
+                                      "structure": "testing_datasets/small_testset_30_pysster.txt"},
+                 "rnacentral_testset": {"fasta": "testing_datasets/rnacentral_testset.fasta"}}
+
+########################################################################################################################
+
+
+def sample_lengths(num_sequences, rng, length_file="testing_datasets/rnacentral_testset.fasta"):
+
+    # This function samples sequence lengths from the length distribution of the RNAcentral test set,
+    # which contains all six ncRNA classes
+
+    from Bio import SeqIO
+    lengths = np.array([len(rec.seq) for rec in SeqIO.parse(length_file, "fasta")])
+    return rng.choice(lengths, num_sequences)
+
+########################################################################################################################
+
+
+def write_synthetic_inputs(inputs, lengths, rng, chunk_size=10000):
+
+    # This function writes random sequences with the given lengths to the files in inputs ("fasta", "structure"
+    # and "feature"), only inputs that do not exist yet are written
+    # Structures are random sequences of the six structure codes and feature vectors contain about one feature
+    # per two nucleotides (at least 20, at most 4,000), which approximates the size of GraphProt feature files
+
+    nucleotides = np.frombuffer(b"ACGT", dtype=np.uint8)
+    structure_codes = np.frombuffer(b"FSIMHT", dtype=np.uint8)
+    files = {key: open(f"{path}.tmp", "w") for key, path in inputs.items() if not os.path.isfile(path)}
+    for start in range(0, len(lengths), chunk_size):
+        for i, length in enumerate(lengths[start:start + chunk_size], start=start):
+            sequence = rng.choice(nucleotides, length).tobytes().decode()
+            if "fasta" in files:
+                files["fasta"].write(f">synthetic_{i}\n{sequence}\n")
+            if "structure" in files:
+                structure = rng.choice(structure_codes, length).tobytes().decode()
+                files["structure"].write(f">synthetic_{i}\n{sequence}\n{structure}\n")
+            if "feature" in files:
+                positions = np.unique(rng.integers(0, 32768, int(np.clip(length // 2, 20, 4000))))
+                files["feature"].write(" ".join(f"{position}:{value:.6f}" for position, value
+                                                in zip(positions, rng.random(len(positions)))) + "\n")
+    for key, file in files.items():
+        file.close()
+        os.replace(f"{inputs[key]}.tmp", inputs[key])
+
+########################################################################################################################
+
+
+def prepare_datasets(sizes, data_dir, seed=0):
+
+    # This function returns the inputs of the test datasets and of synthetic datasets with the given numbers of
+    # sequences, which are created in data_dir if they do not exist yet
+    # Inputs that are missing for a test dataset (structures, graph features) are created synthetically
+    # for the sequence lengths of the test dataset
+
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+
+    datasets = {}
+    for name, inputs in TEST_DATASETS.items():
+        from Bio import SeqIO
+        inputs = dict(inputs)
+        missing = {key: f"{data_dir}/{name}_synthetic.{key}" for key in ("structure", "feature") if key not in inputs}
+        lengths = [len(rec.seq) for rec in SeqIO.parse(inputs["fasta"], "fasta")]
+        write_synthetic_inputs(missing, lengths, np.random.default_rng(seed))
+        inputs.update(missing)
+        datasets[name] = inputs
+
+    for size in sizes:
+        rng = np.random.default_rng(seed)
+        inputs = {key: f"{data_dir}/synthetic_{size}_seed{seed}.{key}" for key in ("fasta", "structure", "feature")}
+        if not all(os.path.isfile(path) for path in inputs.values()):
+            print(f"Creating synthetic dataset with {size} sequences in {data_dir}")
+            write_synthetic_inputs(inputs, sample_lengths(size, rng), rng)
+        datasets[f"synthetic_{size}"] = inputs
+
+    return datasets
+
+########################################################################################################################
+
+
+def setup_stage(stage, inputs, limit):
+
+    # This function reads the inputs a stage needs, which is not part of the measured time
+    # Returns a function that runs the stage and returns the number of processed sequences
+
+    import data_processing
+    import pandas as pd
+
+    def read_sequences():
+        return data_processing.read_fasta_file(inputs["fasta"])["Seq"].iloc[:limit]
+
+    def read_structures():
+        records = itertools.islice(data_processing.read_pysster_file(inputs["structure"]), limit)
+        return [(sequence, structure) for seq_id, sequence, structure in records]
+
+    def read_feature_lines():
+        with open(inputs["feature"], "rb") as file:
+            return b"".join(itertools.islice(file, limit))
+
+    if stage == "read_fasta_file":
+        return lambda: len(data_processing.read_fasta_file(inputs["fasta"]))
+    elif stage == "read_fasta_chunks":
+        return lambda: sum(len(df) for df in data_processing.read_fasta_chunks(inputs["fasta"], 10000))
+    elif stage == "pad_sequences":
+        sequences = read_sequences()
+        return lambda: len(data_processing.pad_sequences(sequences, 12000))
+    elif stage == "encode_nucleotides":
+        padded = data_processing.pad_sequences(read_sequences(), 12000)
+        return lambda: len(data_processing.encode_nucleotides(padded))
+    elif stage == "encode_nucleotide_matrix":
+        sequences = read_sequences()
+        return lambda: len(data_processing.encode_nucleotide_matrix(sequences, 12000))
+    elif stage == "encode_ragged":
+        sequences = read_sequences()
+        return lambda: len(data_processing.encode_ragged(sequences, data_processing.NUCLEOTIDE_TABLE, 12000)[1]) - 1
+    elif stage == "struc_annotator":
+        records = read_structures()
+        return lambda: len([data_processing.struc_annotator(sequence, structure) for sequence, structure in records])
+    elif stage == "struc_annotator_batch":
+        sequences, structures = zip(*read_structures())
+        return lambda: len(data_processing.struc_annotator_batch(sequences, structures))
+    elif stage == "struct_list_annotator":
+        sequences, structures = zip(*read_structures())
+        annotated = data_processing.pad_sequences(pd.Series(data_processing.struc_annotator_batch(sequences,
+                                                                                                 structures)), 12000)
+        return lambda: len(data_processing.struct_list_annotator(annotated))
+    elif stage == "read_graphprot_vectors":
+        # read_graphprot_vectors reads the whole file, so only the first lines are copied into a file of their own
+        feature_file = f"{inputs['feature']}.first_{limit}.feature"
+        with open(feature_file, "wb") as file:
+            file.write(read_feature_lines())
+        num_lines = sum(1 for line in open(feature_file, "rb"))
+        df = pd.DataFrame(index=[f"sequence_{i}" for i in range(num_lines)])
+        return lambda: len(data_processing.read_graphprot_vectors(df, feature_file))
+    elif stage == "read_graphprot_matrix":
+        return lambda: data_processing.read_graphprot_matrix(inputs["feature"]).shape[0]
+
+    # Prediction stages, the model is loaded and the inputs are encoded before the measurement
+    import model_registry
+    model_name = stage.split("_")[1]
+    if not os.path.isfile(model_registry.MODEL_FILES[model_name]) and model_registry.backend == "keras":
+        raise FileNotFoundError(f"Could not find {model_registry.MODEL_FILES[model_name]}")
+    model = model_registry.get_model(model_name)
+    if model_name in ("seqenc", "mncr"):
+        buffer, offsets = data_processing.encode_ragged(read_sequences(), data_processing.NUCLEOTIDE_TABLE, 12000)
+    if model_name in ("grenc", "mncr"):
+        graph_matrix = data_processing.parse_graphprot_features(read_feature_lines())
+
+    if model_name == "seqenc":
+        import run_seqenc
+        return lambda: len(run_seqenc.predict_batches(model, buffer, offsets))
+    elif model_name == "strenc":
+        import run_strenc
+        sequences, structures = zip(*read_structures())
+        buffer, offsets = data_processing.encode_ragged(data_processing.struc_annotator_batch(sequences, structures),
+                                                        data_processing.STRUCTURE_TABLE, 12000)
+        return lambda: len(run_strenc.predict_batches(model, buffer, offsets))
+    elif model_name == "grenc":
+        import run_grenc
+        return lambda: len(run_grenc.predict_batches(model, graph_matrix, 1024))
+    else:
+        import run_mncr
+        num_sequences = min(len(offsets) - 1, graph_matrix.shape[0])
+        return lambda: len(run_mncr.predict_batches(model, buffer, offsets[:num_sequences + 1],
+                                                    graph_matrix[:num_sequences]))
+
+########################################################################################################################
+
+
+def run_stage(stage, inputs, limit):
+
+    # This function runs one stage and returns its measurements
+    # It is run in a process of its own by benchmark_stage
+
+    stage_function = setup_stage(stage, inputs, limit)
+    rss_before = instrumentation.read_current_rss()
+    # The peak is only the peak of the stage if it can be reset, otherwise it includes the memory used before
+    peak_was_reset = instrumentation.reset_peak_rss()
+    cpu_start_time = time.process_time()
+    start_time = time.perf_counter()
+    # The stages of the instrumentation within an outer stage do not reset the peak memory measured here
+    with instrumentation.stage(f"benchmark {stage}"):
+        num_sequences = stage_function()
+    seconds = time.perf_counter() - start_time
+    cpu_seconds = time.process_time() - cpu_start_time
+    peak_rss = instrumentation.read_peak_rss()
+
+    return {"sequences": num_sequences, "seconds": seconds, "cpu_seconds": cpu_seconds,
+            "sequences_per_second": num_sequences / max(seconds, 1e-9),
+            "peak_rss_mb": peak_rss / 1024 ** 2,
+            "peak_rss_increase_mb": (peak_rss - rss_before) / 1024 ** 2 if peak_was_reset else None}
+
+########################################################################################################################
+
+
+def benchmark_stage(stage, inputs, limit):
+
+    # This function runs a stage in a new process and returns its measurements or the error that occurred
+
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        try:
+            return executor.submit(run_stage, stage, inputs, limit).result()
+        except Exception as error:
+            return {"error": f"{type(error).__name__}: {error}"}
+
+########################################################################################################################
+
+
+def compare_with_baseline(results, baseline, tolerance):
+
+    # This function compares the throughput of every stage with the baseline
+    # Stages without throughput in the baseline (no processed sequences) cannot be compared and are only reported
+    # Returns the list of stages whose throughput dropped by more than tolerance (a fraction)
+
+    baseline_results = {(result["dataset"], result["stage"]): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        reference = baseline_results.get((result["dataset"], result["stage"]))
+        if reference is None or "error" in result or "error" in reference:
+            continue
+        if reference["sequences_per_second"] <= 0:
+            print(f"{result['stage']} on {result['dataset']} is not compared, "
+                  f"it processed no sequences in the baseline")
+            continue
+        change = result["sequences_per_second"] / reference["sequences_per_second"] - 1
+        result["baseline_sequences_per_second"] = reference["sequences_per_second"]
+        result["change"] = change
+        if change < -tolerance:
+            regressions.append(result)
+    return regressions
+
+########################################################################################################################
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure the throughput and peak memory of the preprocessing "
+                                                 "functions and the models on the test datasets and on synthetic "
+                                                 "datasets.")
+    parser.add_argument("--sizes", type=int, nargs="*", default=[10000],
+                        help="Numbers of sequences of the synthetic datasets, e.g. 10000 100000 1000000")
+    parser.add_argument("--datasets", nargs="*", default=None,
+                        help="Datasets to run, by default the test datasets and all synthetic datasets")
+    parser.add_argument("--stages", nargs="*", default=list(STAGES), choices=list(STAGES))
+    parser.add_argument("--data-dir", default="benchmark_data", help="Directory for the synthetic datasets")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", default="", help="Results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Largest accepted drop of sequences per second compared to the baseline")
+    args = parser.parse_args()
+
+    datasets = prepare_datasets(args.sizes, args.data_dir, args.seed)
+    if args.datasets is not None:
+        datasets = {name: inputs for name, inputs in datasets.items() if name in args.datasets}
+
+    results = []
+    for dataset, inputs in datasets.items():
+        for stage in args.stages:
+            required_inputs, limit = STAGES[stage]
+            result = {"dataset": dataset, "stage": stage, "limit": limit}
+            result.update(benchmark_stage(stage, {key: inputs[key] for key in required_inputs}, limit))
+            results.append(result)
+            if "error" in result:
+                print(f"{dataset:>20} {stage:>25}: skipped ({result['error']})")
+            else:
+                print(f"{dataset:>20} {stage:>25}: {result['sequences']:>8} sequences in {result['seconds']:8.3f}s "
+                      f"({result['sequences_per_second']:12.1f} sequences/s), peak RSS {result['peak_rss_mb']:8.1f} MB")
+
+    regressions = []
+    if args.baseline != "":
+        with open(args.baseline, "r") as file:
+            regressions = compare_with_baseline(results, json.load(file), args.tolerance)
+        for result in regressions:
+            print(f"Regression: {result['stage']} on {result['dataset']} is {-result['change']:.0%} slower "
+                  f"({result['sequences_per_second']:.1f} instead of {result['baseline_sequences_per_second']:.1f} "
+                  f"sequences/s)")
+        print(f"{len(regressions)} regressions compared to {args.baseline}")
+
+    with open(args.output, "w") as file:
+        json.dump({"host": socket.gethostname(), "platform": platform.platform(), "python": platform.python_version(),
+                   "cpus": os.cpu_count(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "seed": args.seed,
+                   "results": results}, file, indent=1)
+    print(f"Results are saved in {args.output}")
+    sys.exit(1 if len(regressions) > 0 else 0)
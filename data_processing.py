@@ -1,15 +1,114 @@
 import sys
 import os
-import time
+import csv
+import gzip
+import itertools
+import graphprot_features
+import instrumentation
 import numpy as np
 import pandas as pd
+from scipy import sparse
 from Bio import SeqIO
 from Bio.SeqRecord import SeqRecord
 from Bio.Seq import Seq
-from sklearn.preprocessing import OrdinalEncoder
 
 pd.options.mode.chained_assignment = None  # default='warn'
 
+# Characters allowed in nucleotide sequences (IUPAC codes and the padding character "_") and in annotated structure
+# sequences (combinations of nucleotide and structure, see struc_annotator)
+NUCLEOTIDE_CATEGORIES = ["A", "C", "G", "T", "N", "R", "K", "S", "Y", "M", "W", "B", "H", "D", "V", "_"]
+STRUCTURE_CATEGORIES = ["Q", "W", "E", "R", "T", "Z", "U", "I", "O", "P",
+                        "A", "S", "D", "F", "G", "H", "J", "K", "L", "Y",
+                        "X", "C", "V", "B", "N", "_"]
+
+# Fasta files are read in blocks of this many bytes, see iter_fasta_batches
+FASTA_BLOCK_SIZE = 16 * 1024 ** 2
+# Translation table that converts lower case to upper case letters, used together with the deletion of whitespace
+UPPER_CASE_TABLE = bytes.maketrans(b"abcdefghijklmnopqrstuvwxyz", b"ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+
+########################################################################################################################
+
+
+def open_fasta_file(filename):
+
+    # This function opens a fasta file for reading bytes
+    # Files compressed with gzip or bgzip (.gz, .bgz) are recognized by their first two bytes and decompressed
+    # while they are read
+
+    with open(filename, "rb") as file:
+        is_gzip = file.read(2) == b"\x1f\x8b"
+    return gzip.open(filename, "rb") if is_gzip else open(filename, "rb")
+
+########################################################################################################################
+
+
+def parse_fasta_block(data):
+
+    # This function parses a block of complete fasta records given as bytes
+    # Returns the list of identifiers (the header up to the first whitespace, like Bio.SeqIO) and the list of
+    # upper case sequences without line breaks
+    # Every record is converted by a few calls on bytes and all identifiers and sequences of the block are decoded
+    # at once, so no objects are created per line or per nucleotide
+
+    # Text before the first record is ignored
+    if not data.startswith(b">"):
+        start = data.find(b"\n>")
+        if start == -1:
+            return [], []
+        data = data[start + 1:]
+
+    headers = []
+    sequences = []
+    for record in data[1:].split(b"\n>"):
+        header, _, sequence = record.partition(b"\n")
+        headers.append(header.split(None, 1)[0] if header.strip() != b"" else b"")
+        sequences.append(sequence.translate(UPPER_CASE_TABLE, b" \t\r\n"))
+
+    return b"\n".join(headers).decode("utf-8", errors="replace").split("\n"), \
+        b"\n".join(sequences).decode("utf-8", errors="replace").split("\n")
+
+########################################################################################################################
+
+
+def iter_fasta_batches(filename, batch_size=100000, block_size=FASTA_BLOCK_SIZE):
+
+    # This function reads a fasta file (optionally compressed, see open_fasta_file) and yields its records in batches
+    # of batch_size records as tuples of the list of identifiers and the list of upper case sequences
+    # The file is read in blocks of block_size bytes and only the complete records of every block are parsed
+    # (see parse_fasta_block), so the memory usage depends on the block and batch size and not on the size of the file
+    # Duplicate identifiers are kept
+
+    ids = []
+    sequences = []
+    # Pieces of the record that is not complete yet
+    pending = []
+    previous_end = b""
+    with open_fasta_file(filename) as file:
+        while True:
+            block = file.read(block_size)
+            if len(block) == 0:
+                complete = b"".join(pending)
+                pending = []
+            else:
+                # A record ends where the next line starts with ">", which might be the first byte of the block
+                split = (previous_end + block).rfind(b"\n>") + 1 - len(previous_end)
+                previous_end = block[-1:]
+                if split < 0:
+                    pending.append(block)
+                    continue
+                complete = b"".join(pending + [block[:split]])
+                pending = [block[split:]]
+
+            if len(complete) > 0:
+                block_ids, block_sequences = parse_fasta_block(complete)
+                ids.extend(block_ids)
+                sequences.extend(block_sequences)
+            while len(ids) >= batch_size or len(block) == 0 and len(ids) > 0:
+                yield ids[:batch_size], sequences[:batch_size]
+                ids, sequences = ids[batch_size:], sequences[batch_size:]
+            if len(block) == 0:
+                break
+
 ########################################################################################################################
 
 
@@ -20,13 +119,46 @@ def read_fasta_file(filename):
     # To read in all fastas in a folder refer to read_fastas
     # "labels" allows the user to add the rna type
     # to each fasta header and read them into the df as a column
+    # The file may be compressed with gzip or bgzip, see iter_fasta_batches
+
+    with instrumentation.stage("read_fasta_file") as stage:
+        ids = []
+        sequences = []
+        for batch_ids, batch_sequences in iter_fasta_batches(filename):
+            ids.extend(batch_ids)
+            sequences.extend(batch_sequences)
+        df = pd.DataFrame({"Seq": pd.Series(sequences, index=ids, dtype=object)})
+        if df.index.has_duplicates:
+            # Like a dictionary, every identifier is kept at its first position with the last of its sequences
+            df = df.groupby(level=0, sort=False).last()
+
+        df["length"] = df["Seq"].str.len()
+        stage.add_items(len(df))
 
-    sequence_dict = {rec.id: [str(rec.seq).upper()] for rec in SeqIO.parse(filename, "fasta")}
-    df = pd.DataFrame.from_dict(sequence_dict, orient="index", columns=["Seq"])
+    return df
 
-    df["length"] = df["Seq"].map(len)
+########################################################################################################################
 
-    return df
+
+def read_fasta_chunks(filename, chunk_size):
+    # This function reads a fasta file in chunks of chunk_size sequences
+    # Every chunk is returned as a dataframe of the same format as the one created by read_fasta_file
+    # Only the current chunk is held in memory, which allows predicting fasta files of arbitrary size
+    # In contrast to read_fasta_file, duplicate identifiers are kept, so that the n-th row of all chunks
+    # still corresponds to the n-th sequence of the file
+
+    batches = iter_fasta_batches(filename, chunk_size)
+    while True:
+        # Only reading the chunk is measured, not the processing of the chunk by the caller
+        with instrumentation.stage("read_fasta_chunks") as stage:
+            batch = next(batches, None)
+            if batch is None:
+                stage.discard()
+                break
+            df = pd.DataFrame({"Seq": pd.Series(batch[1], index=batch[0], dtype=object)})
+            df["length"] = df["Seq"].str.len()
+            stage.add_items(len(df))
+        yield df
 
 ########################################################################################################################
 
@@ -34,34 +166,34 @@ def read_fasta_file(filename):
 def transform_seq_into_graphfeatures(fasta_file,
                                      path=os.getcwd(),
                                      fasta2shrep_path="~/tools/pkgs/graphprot-1.1.7-2/libexec/graphprot/fasta2shrep_gspan.pl",
-                                     eden_path="~/tools/envs/graphprot/libexec/graphprot/EDeN"):
+                                     eden_path="~/tools/envs/graphprot/libexec/graphprot/EDeN",
+                                     num_workers=0,
+                                     cache_file=""):
     
     # This function applies the graphprot transformation to a fasta file
     # The first step is to create a graph representation of the secondary structure using fasta2shrep
     # The second step is then to create the feature vectors using EDeN
-    # This function takes a very long time for longer sequences
+    # This function takes a very long time for longer sequences, therefore the fasta file is split into shards
+    # that are processed by num_workers parallel workers (by default one per cpu), see graphprot_features
     # The user needs to provide the path to the fasta2shrep.pl executable
     # as well as the path to EDeN
+    # The feature file is saved as [path]/graphprot_output/[fasta name].gspan.gz.feature
+    # If a cache_file is given (e.g. sequence_cache.DEFAULT_CACHE_FILE), only sequences whose feature vectors are not
+    # in the cache are processed
+    # Returns True if the feature file was created
     
     if not os.path.isdir(path):
         print(path)
         print("Please provide a valid directory for the output")
-    else:
-        # Create path for graphprot outputs
-        if not os.path.isdir(f"{path}/graphprot_output"):
-            os.mkdir(f"{path}/graphprot_output")
-
-        start_time = time.time()
+        return False
 
-        gspan_file = f"{path}/graphprot_output/{fasta_file.split('.')[0]}.gspan.gz"
-        # Create graph representation of the secondary structure
-        os.system(f"""{fasta2shrep_path}
-         -abstr -stdout -M 3 -wins '150,' -shift '25' -fasta {fasta_file} -t 3 | gzip > {gspan_file}""")
-        # Use the Graph Kernel method to create the feature vectors
-        os.system(f"{eden_path} -a FEATURE -i {gspan_file}")
+    # Create path for graphprot outputs
+    if not os.path.isdir(f"{path}/graphprot_output"):
+        os.mkdir(f"{path}/graphprot_output")
 
-        end_time = time.time()
-        print(f"Time elapsed: {(end_time-start_time)/(60*60)}h")
+    feature_file = f"{path}/graphprot_output/{os.path.basename(fasta_file).split('.')[0]}.gspan.gz.feature"
+    return graphprot_features.create_graph_features(fasta_file, feature_file, "", fasta2shrep_path, eden_path,
+                                                    num_workers, cache_file=cache_file)
                     
 ########################################################################################################################
 
@@ -83,27 +215,299 @@ def read_graphprot_vectors(df, feature_file):
             print(f"Could not open {feature_file}")
             sys.exit()
 
-        lines = feature_file.readlines()
-        feature_file.close()
-
-        df["feature_vectors"] = ""
-        # Every line is saved as a vector where each entry is one feature
-        for line, i in zip(lines, range(len(lines))):
-            # Create an empty vector to fill with the features
-            unsparse_vector = np.zeros(32768)
-            for feature in line.split(" "):
-                if feature != "":
-                    # Every feature is of the form "position:value", where position is the index in the vector
-                    # and value is the value for the feature
-                    unsparse_vector[int(feature.split(":")[0])] = feature.split(":")[1].strip("\n")
-            # Save the vector in the dataframe
-            df.feature_vectors[i] = unsparse_vector
+        with instrumentation.stage("read_graphprot_vectors") as stage:
+            lines = feature_file.readlines()
+            feature_file.close()
+
+            df["feature_vectors"] = ""
+            # Every line is saved as a vector where each entry is one feature
+            for line, i in zip(lines, range(len(lines))):
+                # Save the vector in the dataframe
+                df.feature_vectors[i] = graphprot_line_to_vector(line)
+            stage.add_items(len(lines))
 
     return df
 
 ########################################################################################################################
 
 
+def graphprot_line_to_vector(line, num_features=32768):
+
+    # This function turns one line of a graphprot feature file into a vector where each entry is one feature
+
+    # Create an empty vector to fill with the features
+    unsparse_vector = np.zeros(num_features)
+    for feature in line.split():
+        # Every feature is of the form "position:value", where position is the index in the vector
+        # and value is the value for the feature
+        unsparse_vector[int(feature.split(":")[0])] = feature.split(":")[1]
+    return unsparse_vector
+
+########################################################################################################################
+
+
+def parse_graphprot_features(data, num_features=32768):
+
+    # This function parses the content of a graphprot feature file given as bytes into a sparse csr matrix
+    # Every line is one row of the matrix and every feature of the form "position:value" one entry
+    # All lines are parsed at once: the number of features per line is derived from the positions of
+    # the line breaks and colons, and all positions and values are converted in one step
+    # The values are stored as float32, the dtype used by the models
+
+    with instrumentation.stage("parse_graphprot_features") as stage:
+        raw = np.frombuffer(data, dtype=np.uint8)
+        line_ends = np.flatnonzero(raw == ord("\n"))
+        # The last line might not end with a line break
+        if len(raw) > 0 and raw[-1] != ord("\n"):
+            line_ends = np.append(line_ends, len(raw))
+        colons = np.flatnonzero(raw == ord(":"))
+        indptr = np.concatenate(([0], np.searchsorted(colons, line_ends)))
+
+        tokens = np.array(data.replace(b":", b" ").split(), dtype=np.float64)
+        indices = tokens[0::2].astype(np.int32)
+        values = tokens[1::2].astype(np.float32)
+        stage.add_items(len(line_ends))
+
+    return sparse.csr_matrix((values, indices, indptr), shape=(len(line_ends), num_features))
+
+########################################################################################################################
+
+
+def read_graphprot_matrix(feature_file, num_features=32768):
+
+    # This function reads the feature vectors created by transform_seq_into_graphfeatures
+    # into a sparse csr matrix with one row per line of the feature file, see parse_graphprot_features
+    # In contrast to read_graphprot_vectors, no dense vectors are created
+    # Use iter_dense_batches to create the dense model inputs batch by batch
+
+    try:
+        file = open(feature_file, "rb")
+    except IOError:
+        print(f"Could not open {feature_file}")
+        sys.exit()
+    data = file.read()
+    file.close()
+
+    return parse_graphprot_features(data, num_features)
+
+########################################################################################################################
+
+
+def read_graphprot_chunks(feature_file, chunk_size, num_features=32768):
+
+    # This function reads the feature vectors of a graphprot feature file in chunks of chunk_size lines
+    # Every chunk is returned as a sparse csr matrix with one row per feature vector
+    # The chunks are in the same order as the lines of the feature file, so they can be read in parallel to
+    # the chunks of read_fasta_chunks
+
+    with open(feature_file, "rb") as file:
+        while True:
+            lines = list(itertools.islice(file, chunk_size))
+            if len(lines) == 0:
+                break
+            yield parse_graphprot_features(b"".join(lines), num_features)
+
+########################################################################################################################
+
+
+def iter_dense_batches(matrix, batch_size=1024):
+
+    # This function yields consecutive rows of a sparse matrix as dense float32 matrices of at most batch_size rows
+    # Only one dense batch exists at a time, which keeps the memory usage of the graph input low
+
+    for start in range(0, matrix.shape[0], batch_size):
+        with instrumentation.stage("dense_graph_batch") as stage:
+            batch = matrix[start:start + batch_size].toarray().astype(np.float32, copy=False)
+            stage.add_items(len(batch))
+        yield batch
+
+########################################################################################################################
+
+
+def iter_sparse_batches(matrix, batch_size=1024):
+
+    # This function yields consecutive rows of a sparse matrix or a feature store as float32 csr matrices of at most
+    # batch_size rows, the input of the sparse models of model_registry.get_sparse_model
+    # In contrast to iter_dense_batches, only the non-zero features of the batch are stored
+
+    for start in range(0, matrix.shape[0], batch_size):
+        yield sparse.csr_matrix(matrix[start:start + batch_size], dtype=np.float32)
+
+########################################################################################################################
+
+
+def is_feature_store(path):
+
+    # This function tests if path is a directory created by write_feature_store
+
+    return all(os.path.isfile(f"{path}/{name}.bin") for name in ("indptr", "indices", "data"))
+
+########################################################################################################################
+
+
+def write_feature_store(feature_file, path, fasta_file="", chunk_size=100000, num_features=32768):
+
+    # This function converts a graphprot feature file chunk by chunk into a feature store on disk,
+    # a directory with the three arrays of the sparse csr matrix (indptr.bin, indices.bin and data.bin)
+    # If the fasta file used for the creation of the feature file is given, its identifiers are saved in ids.txt,
+    # so that rows can also be fetched by sequence identifier, see FeatureStore
+    # The store can be used instead of the feature file by GrEnc and MncR and opens without parsing any text
+    # Returns the number of stored feature vectors
+
+    if not os.path.isdir(path):
+        os.mkdir(path)
+    if os.path.isfile(f"{path}/ids.txt"):
+        os.remove(f"{path}/ids.txt")
+
+    num_rows = 0
+    num_entries = 0
+    indptr_file = open(f"{path}/indptr.bin", "wb")
+    indices_file = open(f"{path}/indices.bin", "wb")
+    data_file = open(f"{path}/data.bin", "wb")
+    indptr_file.write(np.zeros(1, dtype=np.int64).tobytes())
+    # The identifiers of the fasta file are read in chunks of the same size as the feature vectors
+    ids = [] if fasta_file != "" else None
+    sequence_chunks = read_fasta_chunks(fasta_file, chunk_size) if fasta_file != "" else iter(())
+    for matrix in read_graphprot_chunks(feature_file, chunk_size, num_features):
+        indptr_file.write((matrix.indptr[1:].astype(np.int64) + num_entries).tobytes())
+        indices_file.write(matrix.indices.astype(np.int32).tobytes())
+        data_file.write(matrix.data.astype(np.float32).tobytes())
+        num_entries = num_entries + matrix.nnz
+        num_rows = num_rows + matrix.shape[0]
+        sequence_df = next(sequence_chunks, None)
+        if ids is not None and sequence_df is not None:
+            ids.extend(sequence_df.index)
+    indptr_file.close()
+    indices_file.close()
+    data_file.close()
+
+    if ids is not None:
+        # The identifiers are only saved if the fasta file matches the feature file
+        ids.extend(seq_id for sequence_df in sequence_chunks for seq_id in sequence_df.index)
+        if len(ids) == num_rows:
+            with open(f"{path}/ids.txt", "w") as ids_file:
+                ids_file.write("".join(f"{seq_id}\n" for seq_id in ids))
+        else:
+            print(f"Number of lines in {feature_file} does not match number of sequences in {fasta_file}, "
+                  f"the identifiers are not saved")
+
+    return num_rows
+
+########################################################################################################################
+
+
+class FeatureStore:
+
+    # A feature store created by write_feature_store
+    # The arrays are memory mapped, so only the rows that are fetched are read from disk
+    # Rows are fetched as sparse csr matrices by position (rows, or slicing like a matrix) or by identifier (rows_by_id)
+    # Stores without identifiers use "sequence_n" as identifier of the n-th row, like GrEnc without fasta file
+    # The identifiers are only read when they are used, so opening a store does not depend on its number of rows
+
+    def __init__(self, path, num_features=32768):
+        self.path = path
+        self.num_features = num_features
+        self.indptr = np.fromfile(f"{path}/indptr.bin", dtype=np.int64)
+        self.indices = self.open_array("indices", np.int32)
+        self.data = self.open_array("data", np.float32)
+        self.shape = (len(self.indptr) - 1, num_features)
+
+        self.has_ids = os.path.isfile(f"{path}/ids.txt")
+        self.ids = None
+        self.id_index = None
+
+    def open_array(self, name, dtype):
+        if os.path.getsize(f"{self.path}/{name}.bin") == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(f"{self.path}/{name}.bin", dtype=dtype, mode="r")
+
+    def rows(self, positions):
+
+        # Returns the rows at the given positions as csr matrix in the given order
+
+        positions = np.asarray(positions, dtype=np.int64)
+        with instrumentation.stage("feature_store_rows", len(positions)):
+            starts = self.indptr[positions]
+            lengths = self.indptr[positions + 1] - starts
+            indptr = np.concatenate(([0], np.cumsum(lengths)))
+            # Positions of the entries of all requested rows within indices and data
+            entries = np.repeat(starts - indptr[:-1], lengths) + np.arange(indptr[-1])
+
+            return sparse.csr_matrix((self.data[entries], self.indices[entries], indptr),
+                                     shape=(len(positions), self.num_features))
+
+    def get_ids(self):
+
+        # Returns the identifiers of all rows, they are read on first use
+
+        if self.ids is None:
+            self.ids = list(itertools.chain.from_iterable(self.iter_ids(1000000)))
+        return self.ids
+
+    def iter_ids(self, chunk_size):
+
+        # Yields the identifiers of the rows in chunks of chunk_size identifiers
+        # Only one chunk is held in memory, without identifiers only the names of the current chunk are created
+
+        if not self.has_ids:
+            for start in range(0, self.shape[0], chunk_size):
+                yield [f"sequence_{i}" for i in range(start, min(start + chunk_size, self.shape[0]))]
+            return
+        with open(f"{self.path}/ids.txt", "r") as ids_file:
+            while True:
+                ids = [line.strip("\n") for line in itertools.islice(ids_file, chunk_size)]
+                if len(ids) == 0:
+                    break
+                yield ids
+
+    def positions(self, ids):
+
+        # Returns the positions of the given identifiers, None if an identifier is not in the store
+        # The index is built on first use, duplicate identifiers refer to their first row
+
+        if self.id_index is None:
+            self.id_index = {}
+            for i, seq_id in enumerate(self.get_ids()):
+                self.id_index.setdefault(seq_id, i)
+        return [self.id_index.get(seq_id) for seq_id in ids]
+
+    def rows_by_id(self, ids):
+
+        # Returns the rows of the given identifiers as csr matrix in the given order
+        # Raises a KeyError for identifiers that are not in the store
+
+        positions = self.positions(ids)
+        missing = [seq_id for seq_id, i in zip(ids, positions) if i is None]
+        if len(missing) > 0:
+            raise KeyError(f"{len(missing)} identifiers are not in {self.path}, e.g. {missing[0]}")
+        return self.rows(positions)
+
+    def __getitem__(self, key):
+        return self.rows(np.arange(*key.indices(self.shape[0])))
+
+########################################################################################################################
+
+
+def read_graph_features(graph_input, ids=None):
+
+    # This function returns the graph feature vectors of either a graphprot feature file (as sparse csr matrix)
+    # or a feature store created by write_feature_store
+    # If identifiers are given and the feature store has identifiers, the rows of these identifiers are returned
+    # in their order (raises a KeyError for unknown identifiers), otherwise all rows in the order of the file
+    # The feature store itself is returned if all of its rows are requested, so that they are read batch by batch
+    # during the prediction
+
+    if is_feature_store(graph_input):
+        store = FeatureStore(graph_input)
+        if ids is None or not store.has_ids or list(ids) == store.get_ids():
+            return store
+        return store.rows_by_id(list(ids))
+
+    return read_graphprot_matrix(graph_input)
+
+########################################################################################################################
+
+
 def pad_sequences(seq_list, length, char="_"):
     
     # This function pads a list of sequences of nucleotides to a specified length
@@ -112,10 +516,11 @@ def pad_sequences(seq_list, length, char="_"):
     # char is the padding character
     # For sequences that are longer than the specified length,
 
-    # Pad sequences on the right with the provided character
-    pad_list = seq_list.str.ljust(length, char)
-    # Reduce length of sequences that are too long
-    pad_list = pad_list.map(lambda x: x[0:length])
+    with instrumentation.stage("pad_sequences", len(seq_list)):
+        # Pad sequences on the right with the provided character
+        pad_list = seq_list.str.ljust(length, char)
+        # Reduce length of sequences that are too long
+        pad_list = pad_list.map(lambda x: x[0:length])
 
     return pad_list
 
@@ -146,12 +551,15 @@ def encode_nucleotides(seq_list):
     # Input is a column of a dataframe of padded sequences
     # Output is a list of lists of integers encoding the sequence
     
-    categories = ["A", "C", "G", "T", "N", "R", "K", "S", "Y", "M", "W", "B", "H", "D", "V", "_"]
-    # create scikit-learns ordinal encoder
-    ordi = OrdinalEncoder(handle_unknown="use_encoded_value", unknown_value=16)
-    ordi.fit(np.array(list(categories)).reshape(-1, 1))
-    
-    return seq_list.map(lambda seq: ordi.transform(np.array(list(seq)).reshape(-1, 1)))
+    # For large inputs refer to encode_nucleotide_matrix, which creates the same encoding as uint8 matrix
+
+    with instrumentation.stage("encode_nucleotides", len(seq_list)):
+        # create scikit-learns ordinal encoder, scikit-learn is only imported when it is used
+        from sklearn.preprocessing import OrdinalEncoder
+        ordi = OrdinalEncoder(handle_unknown="use_encoded_value", unknown_value=16)
+        ordi.fit(np.array(NUCLEOTIDE_CATEGORIES).reshape(-1, 1))
+
+        return seq_list.map(lambda seq: ordi.transform(np.array(list(seq)).reshape(-1, 1)))
     
 ##########################################################################################################
 
@@ -166,6 +574,213 @@ def transform_seq_into_ml_input(seq_list):
 ##########################################################################################################
 
 
+def build_encoding_table(categories, unknown_value):
+
+    # This function creates a lookup table that maps every byte to the integer assigned to it
+    # by scikit-learn's ordinal encoder fitted on the given categories
+    # The ordinal encoder numbers the categories in sorted order, all other characters get the unknown value
+
+    table = np.full(256, unknown_value, dtype=np.uint8)
+    for i, category in enumerate(sorted(categories)):
+        table[ord(category)] = i
+    return table
+
+
+NUCLEOTIDE_TABLE = build_encoding_table(NUCLEOTIDE_CATEGORIES, 16)
+STRUCTURE_TABLE = build_encoding_table(STRUCTURE_CATEGORIES, len(STRUCTURE_CATEGORIES))
+
+# Encoded value of the padding character "_"
+NUCLEOTIDE_PAD_VALUE = NUCLEOTIDE_TABLE[ord("_")]
+STRUCTURE_PAD_VALUE = STRUCTURE_TABLE[ord("_")]
+
+##########################################################################################################
+
+
+def encode_ragged(seq_list, table, length=12000):
+
+    # This function encodes sequences into a ragged representation without any padding:
+    # one uint8 buffer with all encoded sequences concatenated and an int64 offsets array,
+    # where sequence i is stored in buffer[offsets[i]:offsets[i + 1]]
+    # seq_list is any iterable of strings and table is a lookup table created by build_encoding_table
+    # Sequences that are longer than length are cut, since the models only use the first length positions
+
+    with instrumentation.stage("encode_ragged") as stage:
+        seqs = [seq[0:length] for seq in seq_list]
+        offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs)))
+
+        # Every character that is not ascii is replaced by a single "?" and therefore gets the unknown value
+        buffer = table[np.frombuffer("".join(seqs).encode("ascii", errors="replace"), dtype=np.uint8)]
+        stage.add_items(len(seqs))
+
+    return buffer, offsets
+
+##########################################################################################################
+
+
+def ragged_to_matrix(buffer, offsets, start, stop, length, pad_value):
+
+    # This function expands the sequences start to stop - 1 of a ragged representation (see encode_ragged)
+    # into a uint8 matrix of the given length, in which every row is padded on the right with pad_value
+
+    lengths = np.minimum(offsets[start + 1:stop + 1] - offsets[start:stop], length)
+    matrix = np.full((stop - start, length), pad_value, dtype=np.uint8)
+    if np.all(offsets[start + 1:stop + 1] - offsets[start:stop] == lengths):
+        # Write all encoded sequences row by row to the left of the padding at once
+        matrix[np.arange(length) < lengths[:, None]] = buffer[offsets[start]:offsets[stop]]
+    else:
+        # Sequences that are longer than length have to be cut row by row
+        for row, (offset, seq_length) in enumerate(zip(offsets[start:stop], lengths)):
+            matrix[row, :seq_length] = buffer[offset:offset + seq_length]
+
+    return matrix
+
+##########################################################################################################
+
+
+def iter_padded_batches(buffer, offsets, pad_value, batch_size=1024, length=12000):
+
+    # This function yields the sequences of a ragged representation as padded uint8 matrices of at most
+    # batch_size rows, so the padding only exists for the batch that is currently predicted
+
+    num_sequences = len(offsets) - 1
+    for start in range(0, num_sequences, batch_size):
+        with instrumentation.stage("pad_batch", min(start + batch_size, num_sequences) - start):
+            batch = ragged_to_matrix(buffer, offsets, start, min(start + batch_size, num_sequences), length, pad_value)
+        yield batch
+
+##########################################################################################################
+
+
+def encode_padded_matrix(seq_list, length, table, char="_"):
+
+    # This function pads, encodes and transforms sequences into one uint8 matrix
+    # The result is the same as applying pad_sequences, encode_nucleotides (or struct_list_annotator)
+    # and transform_seq_into_ml_input, but every sequence is only copied once
+    # seq_list is any iterable of strings, length is the desired padding length
+    # and table is a lookup table created by build_encoding_table
+
+    buffer, offsets = encode_ragged(seq_list, table, length)
+    return ragged_to_matrix(buffer, offsets, 0, len(offsets) - 1, length, table[ord(char)])
+
+##########################################################################################################
+
+
+def encode_nucleotide_matrix(seq_list, length=12000):
+
+    # This function encodes nucleotide sequences into the uint8 input matrix of the SeqEnc model
+    # and the sequence branch of the MncR model, see encode_padded_matrix
+
+    return encode_padded_matrix(seq_list, length, NUCLEOTIDE_TABLE)
+
+##########################################################################################################
+
+
+def encode_structure_matrix(seq_list, length=12000):
+
+    # This function encodes annotated structure sequences into the uint8 input matrix of the StrEnc model,
+    # see encode_padded_matrix
+
+    return encode_padded_matrix(seq_list, length, STRUCTURE_TABLE)
+
+##########################################################################################################
+
+
+def is_ragged_store(path):
+
+    # This function tests if path is a directory created by write_ragged_store
+
+    return os.path.isfile(f"{path}/buffer.bin") and os.path.isfile(f"{path}/offsets.bin")
+
+##########################################################################################################
+
+
+def write_ragged_store(fasta_file, path, chunk_size=100000, length=12000):
+
+    # This function encodes the nucleotide sequences of a fasta file chunk by chunk into a ragged store on disk,
+    # a directory with the concatenated encoded sequences (buffer.bin), the offsets of the sequences (offsets.bin)
+    # and the sequence identifiers (ids.txt)
+    # The store only needs about one byte per nucleotide and can be used instead of the fasta file by
+    # SeqEnc and MncR, see read_ragged_store
+    # Returns the number of stored sequences
+
+    if not os.path.isdir(path):
+        os.mkdir(path)
+
+    num_sequences = 0
+    total_length = 0
+    buffer_file = open(f"{path}/buffer.bin", "wb")
+    offsets_file = open(f"{path}/offsets.bin", "wb")
+    ids_file = open(f"{path}/ids.txt", "w")
+    offsets_file.write(np.zeros(1, dtype=np.int64).tobytes())
+    for ids, sequences in iter_fasta_batches(fasta_file, chunk_size):
+        buffer, offsets = encode_ragged(sequences, NUCLEOTIDE_TABLE, length)
+        buffer_file.write(buffer.tobytes())
+        offsets_file.write((offsets[1:] + total_length).tobytes())
+        ids_file.write("".join(f"{seq_id}\n" for seq_id in ids))
+        total_length = total_length + offsets[-1]
+        num_sequences = num_sequences + len(ids)
+    buffer_file.close()
+    offsets_file.close()
+    ids_file.close()
+
+    return num_sequences
+
+##########################################################################################################
+
+
+def read_ragged_store(path):
+
+    # This function opens a ragged store created by write_ragged_store
+    # The buffer and the offsets are memory mapped, so only the batches that are predicted are read from disk
+    # Returns the list of identifiers, the buffer and the offsets
+
+    with open(f"{path}/ids.txt", "r") as ids_file:
+        ids = [line.strip("\n") for line in ids_file]
+    buffer = np.memmap(f"{path}/buffer.bin", dtype=np.uint8, mode="r") \
+        if os.path.getsize(f"{path}/buffer.bin") > 0 else np.zeros(0, dtype=np.uint8)
+    offsets = np.fromfile(f"{path}/offsets.bin", dtype=np.int64)
+
+    return ids, buffer, offsets
+
+##########################################################################################################
+
+
+def read_encoded_sequences(sequence_input, length=12000):
+
+    # This function returns the identifiers and the ragged encoded nucleotide sequences of either a fasta file
+    # or a ragged store created by write_ragged_store
+    # In contrast to read_fasta_file, duplicate identifiers are kept
+
+    if is_ragged_store(sequence_input):
+        return read_ragged_store(sequence_input)
+
+    ids = []
+    buffers = []
+    offsets = [np.zeros(1, dtype=np.int64)]
+    for chunk_ids, sequences in iter_fasta_batches(sequence_input, 100000):
+        buffer, chunk_offsets = encode_ragged(sequences, NUCLEOTIDE_TABLE, length)
+        ids.extend(chunk_ids)
+        buffers.append(buffer)
+        offsets.append(chunk_offsets[1:] + offsets[-1][-1])
+
+    return ids, np.concatenate(buffers) if len(buffers) > 0 else np.zeros(0, dtype=np.uint8), np.concatenate(offsets)
+
+##########################################################################################################
+
+
+def write_predictions(output, ids, results, pred_probabilities):
+
+    # This function writes one line per prediction to an opened output file
+    # Every line consists of the sequence identifier, the predicted ncRNA type and the probability of the prediction
+
+    with instrumentation.stage("write_predictions", len(results)):
+        for id, pred, pred_probability in zip(ids, results, pred_probabilities):
+            output.write(f"{id}\t{pred}\t{pred_probability}\n")
+
+##########################################################################################################
+
+
 def write_seq_df_to_fasta(df,
                           seq_col="Seq",
                           type_col="rna_type",
@@ -194,23 +809,56 @@ def read_ncr_results(path, df, col_name, tabs=True):
     # The results are read into a column of a data frame, the name of the column is provided by col_name
     # Keys of the data frame must match the sequence IDs
     # tabs is a bool that indicates whether the result file is separated by tabs or commas
-    
-    df[col_name] = ""
-    for filename in os.listdir(path):
-        print(filename)
+    # All .txt files in path are read with pandas, concatenated and aligned to the data frame in one step,
+    # sequences without a result get NaN and if an ID occurs several times, its last result is used
+    # Returns the list of IDs that are not in the data frame
+
+    results = []
+    for filename in sorted(os.listdir(path)):
         if filename.endswith(".txt"):
-            with open(path + "/" + filename) as file:
-                for line in file:
-                    if tabs:
-                        seq_id = line.split("\t")[0].strip()
-                        pred = line.split("\t")[1].strip()
-                    else:
-                        seq_id = line.split(",")[0].strip()
-                        pred = line.split(",")[1].strip()
-                    try:
-                        df[col_name][seq_id] = pred
-                    except IndexError:
-                        print(f"{seq_id} not found in df")
+            results.append(pd.read_csv(f"{path}/{filename}", sep="\t" if tabs else ",", header=None, usecols=[0, 1],
+                                       names=["id", "prediction"], dtype=str, quoting=csv.QUOTE_NONE,
+                                       skip_blank_lines=True))
+    results = pd.concat(results, ignore_index=True) if len(results) > 0 else \
+        pd.DataFrame({"id": [], "prediction": []}, dtype=str)
+    results = results.dropna().apply(lambda column: column.str.strip())
+    results = results.drop_duplicates("id", keep="last").set_index("id")["prediction"]
+
+    df[col_name] = results.reindex(df.index).to_numpy()
+
+    unmatched = results.index[~results.index.isin(df.index)].tolist()
+    print(f"Read {len(results)} results from {path}, {len(results) - len(unmatched)} of them match the data frame")
+    if len(unmatched) > 0:
+        print(f"{len(unmatched)} IDs not found in df: "
+              f"{', '.join(unmatched[:10])}{', ...' if len(unmatched) > 10 else ''}")
+
+    return unmatched
+
+########################################################################################################################
+
+
+def build_annotation_table():
+
+    # This method creates the translation table used by struc_annotator and struc_annotator_batch
+    # The table is indexed by the byte of the nucleotide and the byte of the structure code
+    # and contains the byte of the combined letter according to supplementary table 3
+    # Structure codes other than "F", "S", "I", "M", "H", "T" are marked with 0
+
+    # Assignment of letters for combinations
+    dic = {"A": ["Q", "W", "E", "R", "T", "Z"],
+           "C": ["U", "I", "O", "P", "A", "S"],
+           "G": ["D", "F", "G", "H", "J", "K"],
+           "T": ["L", "Y", "X", "C", "V", "B"]}
+    table = np.zeros((256, 256), dtype=np.uint8)
+    for j, struct in enumerate(["F", "S", "I", "M", "H", "T"]):
+        # If any IUPAC code other than the four nts is used, the combination is encoded as "N"
+        table[:, ord(struct)] = ord("N")
+        for nucleotide, letters in dic.items():
+            table[ord(nucleotide), ord(struct)] = ord(letters[j])
+    return table
+
+
+ANNOTATION_TABLE = build_annotation_table()
 
 ########################################################################################################################
 
@@ -221,27 +869,104 @@ def struc_annotator(sequence, structure):
     # The structure sequence can only contain "F", "S", "I", "M", "H", "T"
     # while the nucleotide sequence may include all IUPAC characters
     # Annotation is done according to supplementary table 3
+    # To annotate many sequences at once refer to struc_annotator_batch
 
-    if len(sequence) != len(structure):
-        print("Sequence and structure not of equal length")
-    else:
-        annotated_struct = ""
-
-        # Assignment of letters for combinations
-        dic = {"A": ["Q", "W", "E", "R", "T", "Z"],
-               "C": ["U", "I", "O", "P", "A", "S"],
-               "G": ["D", "F", "G", "H", "J", "K"],
-               "T": ["L", "Y", "X", "C", "V", "B"],
-               "other": ["N", "N", "N", "N", "N", "N"]}
-        df = pd.DataFrame(dic, index=["F", "S", "I", "M", "H", "T"])
-        for i in range(0, len(sequence)):
-            if sequence[i] in ["A", "C", "G", "T"]:
-                # Prolong structure sequence by new combination
-                annotated_struct = annotated_struct + df[sequence[i]][structure[i]]
+    return struc_annotator_batch([sequence], [structure])[0]
+
+########################################################################################################################
+
+
+def struc_annotator_batch(sequences, structures):
+
+    # This method annotates a list of nucleotide sequences with the corresponding list of pysster structure sequences
+    # All pairs are translated at once using ANNOTATION_TABLE, the result is the same as calling struc_annotator
+    # for every pair
+    # Pairs that are not of equal length or contain structure codes other than "F", "S", "I", "M", "H", "T"
+    # are annotated as None
+
+    sequences = list(sequences)
+    structures = list(structures)
+    with instrumentation.stage("struc_annotator_batch", len(sequences)):
+        annotated_structs = [None] * len(sequences)
+
+        valid = []
+        for i in range(len(sequences)):
+            if len(sequences[i]) != len(structures[i]):
+                print("Sequence and structure not of equal length")
+            else:
+                valid.append(i)
+        if len(valid) == 0:
+            return annotated_structs
+
+        # Translate all pairs in one lookup, characters that are not ascii are replaced by "?"
+        seq_bytes = np.frombuffer("".join(sequences[i] for i in valid).encode("ascii", errors="replace"),
+                                  dtype=np.uint8)
+        struct_bytes = np.frombuffer("".join(structures[i] for i in valid).encode("ascii", errors="replace"),
+                                     dtype=np.uint8)
+        annotated = ANNOTATION_TABLE[seq_bytes, struct_bytes]
+
+        # Find the pairs that contain unknown structure codes
+        ends = np.cumsum([len(sequences[i]) for i in valid])
+        unknown_pairs = set(np.searchsorted(ends, np.flatnonzero(annotated == 0), side="right"))
+
+        annotated = annotated.tobytes().decode("ascii")
+        start = 0
+        for k, (i, end) in enumerate(zip(valid, ends)):
+            if k in unknown_pairs:
+                print("Structure contains codes other than F, S, I, M, H and T")
             else:
-                # If any IUPAC code other than the four nts is used, the structure sequence is prolonged with "N"
-                annotated_struct = annotated_struct + df["other"][structure[i]]
-        return annotated_struct
+                annotated_structs[i] = annotated[start:end]
+            start = end
+
+        return annotated_structs
+
+########################################################################################################################
+
+
+def read_pysster_file(filename):
+
+    # This method reads a structure file created by pysster record by record
+    # Every record consists of three lines: identifier, nucleotide sequence and structure sequence
+    # It yields tuples of (identifier, sequence, structure) without holding the whole file in memory
+
+    with open(filename, "r") as file:
+        yield from parse_pysster_lines(file)
+
+########################################################################################################################
+
+
+def parse_pysster_lines(lines):
+
+    # This method parses any iterable of lines in the pysster format, e.g. an opened file or a list of strings
+    # and yields tuples of (identifier, sequence, structure), see read_pysster_file
+
+    lines = iter(lines)
+    while True:
+        record = list(itertools.islice(lines, 3))
+        if len(record) < 3:
+            break
+        seq_id = record[0].strip(">").split(" ")[0].strip("\n")
+        yield seq_id, record[1].strip("\n"), record[2].strip("\n")
+
+########################################################################################################################
+
+
+def read_pysster_chunks(filename, chunk_size):
+
+    # This method reads a structure file created by pysster in chunks of chunk_size records
+    # Every chunk is returned as a tuple of the list of identifiers and the list of annotated structure sequences
+    # created by struc_annotator_batch
+
+    records = read_pysster_file(filename)
+    while True:
+        with instrumentation.stage("read_pysster_chunks") as stage:
+            chunk = list(itertools.islice(records, chunk_size))
+            if len(chunk) == 0:
+                stage.discard()
+                break
+            ids, sequences, structures = zip(*chunk)
+            stage.add_items(len(ids))
+        yield list(ids), struc_annotator_batch(sequences, structures)
 
 ########################################################################################################################
 
@@ -249,10 +974,33 @@ def struc_annotator(sequence, structure):
 def struct_list_annotator(seq_list):
 
     # This method encodes the possible characters in the pysster structure file using sklearns ordinal encoder
+    # For large inputs refer to encode_structure_matrix, which creates the same encoding as uint8 matrix
 
-    categories = ["Q", "W", "E", "R", "T", "Z", "U", "I", "O", "P",
-                  "A", "S", "D", "F", "G", "H", "J", "K", "L", "Y",
-                  "X", "C", "V", "B", "N", "_"]
-    ordi = OrdinalEncoder(handle_unknown="use_encoded_value", unknown_value=len(categories))
-    ordi.fit(np.array(list(categories)).reshape(-1, 1))
-    return seq_list.map(lambda seq: ordi.transform(np.array(list(seq)).reshape(-1, 1)))
+    with instrumentation.stage("struct_list_annotator", len(seq_list)):
+        from sklearn.preprocessing import OrdinalEncoder
+        ordi = OrdinalEncoder(handle_unknown="use_encoded_value", unknown_value=len(STRUCTURE_CATEGORIES))
+        ordi.fit(np.array(STRUCTURE_CATEGORIES).reshape(-1, 1))
+        return seq_list.map(lambda seq: ordi.transform(np.array(list(seq)).reshape(-1, 1)))
+
+########################################################################################################################
+
+
+if __name__ == '__main__':
+    # Encode a fasta file into a ragged store, which can be used instead of the fasta file by SeqEnc and MncR,
+    # or convert a graphprot feature file into a feature store, which can be used instead of the feature file by
+    # GrEnc and MncR
+    if len(sys.argv) == 3 and not sys.argv[1].endswith(".feature"):
+        num_sequences = write_ragged_store(sys.argv[1], sys.argv[2])
+        print(f"Encoded {num_sequences} sequences into {sys.argv[2]}")
+    elif len(sys.argv) in (3, 4) and sys.argv[1].endswith(".feature"):
+        num_rows = write_feature_store(sys.argv[1], sys.argv[2], sys.argv[3] if len(sys.argv) == 4 else "")
+        print(f"Converted {num_rows} feature vectors into {sys.argv[2]}")
+    else:
+        print("Please enter a fasta file and the path to the ragged store that is created\n"
+              "or a graphprot feature file, the path to the feature store that is created and optionally "
+              "the fasta file used for the creation of the feature file\n"
+              "Example:\n"
+              "python data_processing.py testing_datasets/rnacentral_testset.fasta rnacentral_testset.ragged\n"
+              "or\n"
+              "python data_processing.py graphprot_output/rnacentral_testset.gspan.gz.feature "
+              "rnacentral_testset.features testing_datasets/rnacentral_testset.fasta")
@@ -0,0 +1,330 @@
+import os
+import sys
+import json
+import gzip
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import itertools
+import numpy as np
+import sequence_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from Bio import SeqIO
+
+# This module creates GraphProt feature files in parallel
+# The fasta file is split into shards, fasta2shrep_gspan.pl and EDeN are run on every shard in a pool of workers
+# and the feature files of the shards are merged in the order of the input
+# Every finished shard is kept in the work directory, so that an interrupted run continues with the missing shards
+# With a cache (see sequence_cache), only the sequences without cached feature vectors are processed
+
+# Parameters used for the creation of the graph features of all models
+FASTA2SHREP_PARAMETERS = ["-abstr", "-stdout", "-M", "3", "-wins", "150,", "-shift", "25"]
+
+# The feature vector of a sequence is cached under the sequence and the parameters of both tools
+CACHE_PARAMETERS = f"fasta2shrep_gspan.pl {' '.join(FASTA2SHREP_PARAMETERS)} | EDeN -a FEATURE"
+
+########################################################################################################################
+
+
+def find_tool(tool_path):
+
+    # This function returns the absolute path to an executable or an empty string if it cannot be found
+    # tool_path may be a path (including "~") or the name of an executable on the PATH
+
+    tool_path = os.path.expanduser(tool_path)
+    if os.path.isfile(tool_path) and os.access(tool_path, os.X_OK):
+        return os.path.abspath(tool_path)
+    return shutil.which(tool_path) or ""
+
+########################################################################################################################
+
+
+def split_fasta_into_shards(fasta_file, work_dir, num_shards):
+
+    # This function splits a fasta file into num_shards consecutive shards of about the same number of nucleotides
+    # The shards are written to work_dir as shard_00000.fasta, shard_00001.fasta, ...
+    # A description of the shards is saved in work_dir/shards.json and returned
+    # If shards.json already exists for the same fasta file, the existing shards are reused
+
+    manifest_file = f"{work_dir}/shards.json"
+    fasta_stat = os.stat(fasta_file)
+    if os.path.isfile(manifest_file):
+        with open(manifest_file, "r") as file:
+            manifest = json.load(file)
+        if manifest["fasta_file"] == os.path.abspath(fasta_file) and manifest["size"] == fasta_stat.st_size \
+                and manifest["mtime"] == fasta_stat.st_mtime:
+            return manifest
+        print(f"{work_dir} contains shards of a different input, the shards are created again")
+
+    # Feature files of earlier shards must not be mistaken for finished shards of the new split
+    for file_name in os.listdir(work_dir):
+        if file_name.startswith("shard_") and file_name.endswith(".feature"):
+            os.remove(f"{work_dir}/{file_name}")
+
+    # Determine the length of every sequence to balance the number of nucleotides per shard
+    lengths = [len(rec.seq) for rec in SeqIO.parse(fasta_file, "fasta")]
+    num_shards = max(1, min(num_shards, len(lengths)))
+    target_length = sum(lengths) / num_shards
+
+    shards = []
+    shard = None
+    records = SeqIO.parse(fasta_file, "fasta")
+    for rec, length in zip(records, lengths):
+        # Start a new shard once the current shard has reached its share of nucleotides
+        if shard is None or (shard["nucleotides"] >= target_length and len(shards) < num_shards):
+            if shard is not None:
+                shard_file.close()
+            shard = {"name": f"shard_{len(shards):05d}", "sequences": 0, "nucleotides": 0, "max_length": 0}
+            shards.append(shard)
+            shard_file = open(f"{work_dir}/{shard['name']}.fasta", "w")
+        SeqIO.write(rec, shard_file, "fasta")
+        shard["sequences"] = shard["sequences"] + 1
+        shard["nucleotides"] = shard["nucleotides"] + length
+        shard["max_length"] = max(shard["max_length"], length)
+    if shard is not None:
+        shard_file.close()
+
+    manifest = {"fasta_file": os.path.abspath(fasta_file), "size": fasta_stat.st_size, "mtime": fasta_stat.st_mtime,
+                "shards": shards}
+    # Write the description atomically, so that an interrupted split is not mistaken for a finished one
+    with open(f"{manifest_file}.tmp", "w") as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(f"{manifest_file}.tmp", manifest_file)
+
+    return manifest
+
+########################################################################################################################
+
+
+def run_shard(shard, work_dir, fasta2shrep_path, eden_path, threads_per_shard=1):
+
+    # This function creates the graph features of one shard
+    # The graph representation created by fasta2shrep is compressed into shard_xxxxx.gspan.gz
+    # and EDeN creates the feature vectors from it
+    # The feature file is only moved to shard_xxxxx.feature once it is complete, which marks the shard as finished
+    # Returns an error message or an empty string if the shard was successful
+
+    fasta_file = f"{work_dir}/{shard['name']}.fasta"
+    gspan_file = f"{work_dir}/{shard['name']}.gspan.gz"
+
+    # Create graph representation of the secondary structure
+    command = [fasta2shrep_path] + FASTA2SHREP_PARAMETERS + ["-fasta", fasta_file, "-t", str(threads_per_shard)]
+    # stderr goes to a temporary file, a pipe that is only read after stdout could fill up and block fasta2shrep
+    with gzip.open(gspan_file, "wb") as gspan, tempfile.TemporaryFile() as stderr_file:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr_file, cwd=work_dir)
+        shutil.copyfileobj(process.stdout, gspan)
+        process.wait()
+        stderr_file.seek(0)
+        stderr = stderr_file.read()
+    if process.returncode != 0:
+        return f"fasta2shrep failed with exit code {process.returncode}: {stderr.decode(errors='replace')[-500:]}"
+
+    # Use the Graph Kernel method to create the feature vectors, EDeN writes them next to the gspan file
+    process = subprocess.run([eden_path, "-a", "FEATURE", "-i", gspan_file], capture_output=True, cwd=work_dir)
+    if process.returncode != 0:
+        return f"EDeN failed with exit code {process.returncode}: {process.stderr.decode(errors='replace')[-500:]}"
+    if not os.path.isfile(f"{gspan_file}.feature"):
+        return f"EDeN did not create {gspan_file}.feature"
+
+    # Every sequence has to be represented by exactly one feature vector
+    with open(f"{gspan_file}.feature", "rb") as file:
+        num_lines = sum(1 for line in file)
+    if num_lines != shard["sequences"]:
+        return f"{gspan_file}.feature contains {num_lines} feature vectors for {shard['sequences']} sequences"
+
+    os.replace(f"{gspan_file}.feature", f"{work_dir}/{shard['name']}.feature")
+    os.remove(gspan_file)
+    return ""
+
+########################################################################################################################
+
+
+def merge_shards(shards, work_dir, output_file):
+
+    # This function concatenates the feature files of all shards in the order of the input into output_file
+    # The merged file is written under a temporary name and renamed once it is complete
+
+    with open(f"{output_file}.tmp", "wb") as output:
+        for shard in shards:
+            with open(f"{work_dir}/{shard['name']}.feature", "rb") as file:
+                shutil.copyfileobj(file, output)
+    os.replace(f"{output_file}.tmp", output_file)
+
+########################################################################################################################
+
+
+def split_cached_features(fasta_file, work_dir, cache, chunk_size=10000):
+
+    # This function looks up the feature vectors of all sequences of a fasta file in the cache
+    # Cached feature vectors are written in the order of the input to work_dir/cache_hits.feature and all other
+    # sequences to work_dir/cache_misses.fasta
+    # Returns a boolean array that is True for every sequence with a cached feature vector
+
+    is_cached = []
+    records = SeqIO.parse(fasta_file, "fasta")
+    with open(f"{work_dir}/cache_hits.feature", "wb") as hits, open(f"{work_dir}/cache_misses.fasta", "w") as misses:
+        while True:
+            chunk = list(itertools.islice(records, chunk_size))
+            if len(chunk) == 0:
+                break
+            keys = [sequence_cache.sequence_key(str(rec.seq), CACHE_PARAMETERS) for rec in chunk]
+            cached = cache.get_many(keys)
+            for rec, key in zip(chunk, keys):
+                if key in cached:
+                    hits.write(cached[key])
+                else:
+                    SeqIO.write(rec, misses, "fasta")
+                is_cached.append(key in cached)
+
+    return np.array(is_cached, dtype=bool)
+
+########################################################################################################################
+
+
+def cache_shard(shard, work_dir, cache):
+
+    # This function stores the feature vectors of a finished shard in the cache
+
+    with open(f"{work_dir}/{shard['name']}.feature", "rb") as file:
+        cache.put_many({sequence_cache.sequence_key(str(rec.seq), CACHE_PARAMETERS): line for rec, line in
+                        zip(SeqIO.parse(f"{work_dir}/{shard['name']}.fasta", "fasta"), file)})
+
+########################################################################################################################
+
+
+def merge_cached_features(is_cached, work_dir, computed_file, output_file):
+
+    # This function merges the cached feature vectors from work_dir/cache_hits.feature and the computed feature
+    # vectors from computed_file into output_file in the order of the input (see split_cached_features)
+
+    with open(f"{work_dir}/cache_hits.feature", "rb") as hits, open(f"{output_file}.tmp", "wb") as output:
+        computed = open(computed_file, "rb") if not is_cached.all() else None
+        for cached in is_cached:
+            output.write(next(hits) if cached else next(computed))
+        if computed is not None:
+            computed.close()
+    os.replace(f"{output_file}.tmp", output_file)
+
+########################################################################################################################
+
+
+def create_graph_features(fasta_file, output_file, work_dir="",
+                          fasta2shrep_path="~/tools/pkgs/graphprot-1.1.7-2/libexec/graphprot/fasta2shrep_gspan.pl",
+                          eden_path="~/tools/envs/graphprot/libexec/graphprot/EDeN",
+                          num_workers=0, shards_per_worker=4, cache_file="",
+                          cache_max_bytes=sequence_cache.DEFAULT_MAX_BYTES):
+
+    # This function creates the GraphProt feature file of a fasta file in parallel
+    # The fasta file is split into shards (by default 4 per worker) that are processed by num_workers workers
+    # (by default one per cpu), shards with the longest sequences are started first
+    # Finished shards are kept in work_dir (by default [output_file].shards), so that running the function again
+    # after a crash only processes the missing shards
+    # If a cache_file is given, feature vectors of sequences that were already processed are taken from the cache
+    # and only the remaining sequences are processed, their feature vectors are added to the cache shard by shard
+    # Returns True if the feature file was created and False if a tool is missing or a shard failed
+
+    if num_workers <= 0:
+        num_workers = os.cpu_count() or 1
+    if work_dir == "":
+        work_dir = f"{output_file}.shards"
+    # The tools are run within the work directory, so all paths passed to them have to be absolute
+    work_dir = os.path.abspath(work_dir)
+
+    # Report missing tools before any work is done
+    tools = {"fasta2shrep_gspan.pl": find_tool(fasta2shrep_path), "EDeN": find_tool(eden_path)}
+    missing_tools = [name for name, path in tools.items() if path == ""]
+    if len(missing_tools) > 0:
+        print(f"Could not find the executable(s) {', '.join(missing_tools)}. "
+              f"Please provide the paths to fasta2shrep_gspan.pl and EDeN")
+        return False
+
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+
+    start_time = time.time()
+    cache = None
+    shard_input, shard_output, shard_dir = fasta_file, output_file, work_dir
+    if cache_file != "":
+        # Only the sequences without cached feature vectors are split into shards
+        cache = sequence_cache.SequenceCache(cache_file, cache_max_bytes)
+        is_cached = split_cached_features(fasta_file, work_dir, cache)
+        print(f"{is_cached.sum()} of {len(is_cached)} feature vectors are taken from the cache {cache_file}")
+        shard_input, shard_output = f"{work_dir}/cache_misses.fasta", f"{work_dir}/cache_misses.feature"
+        shard_dir = f"{work_dir}/cache_misses"
+        if not os.path.isdir(shard_dir):
+            os.makedirs(shard_dir)
+
+    if cache is None or not is_cached.all():
+        shards = split_fasta_into_shards(shard_input, shard_dir, num_workers * shards_per_worker)["shards"]
+        missing_shards = [shard for shard in shards if not os.path.isfile(f"{shard_dir}/{shard['name']}.feature")]
+        print(f"{len(shards) - len(missing_shards)} of {len(shards)} shards are already finished, "
+              f"processing {len(missing_shards)} shards with {num_workers} workers")
+
+        # Schedule the shards with the longest sequences first, since they take the longest
+        missing_shards.sort(key=lambda x: (x["max_length"], x["nucleotides"]), reverse=True)
+
+        failed_shards = []
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            futures = {executor.submit(run_shard, shard, shard_dir, tools["fasta2shrep_gspan.pl"], tools["EDeN"]):
+                       shard for shard in missing_shards}
+            for num_finished, future in enumerate(as_completed(futures), start=1):
+                shard = futures[future]
+                try:
+                    error = future.result()
+                except OSError as exception:
+                    error = str(exception)
+                if error != "":
+                    failed_shards.append(shard["name"])
+                    print(f"{shard['name']} failed: {error}")
+                else:
+                    if cache is not None:
+                        cache_shard(shard, shard_dir, cache)
+                    print(f"{shard['name']} finished ({num_finished} of {len(missing_shards)}, "
+                          f"{(time.time() - start_time) / 60:.1f} min elapsed)")
+
+        if len(failed_shards) > 0:
+            print(f"{len(failed_shards)} shards failed: {', '.join(sorted(failed_shards))}\n"
+                  f"Run again to retry the failed shards, finished shards are kept in {shard_dir}")
+            return False
+
+        merge_shards(shards, shard_dir, shard_output)
+        num_sequences = sum(shard["sequences"] for shard in shards)
+
+    if cache is not None:
+        merge_cached_features(is_cached, work_dir, shard_output, output_file)
+        cache.report("GraphProt feature cache")
+        cache.close()
+        num_sequences = len(is_cached)
+
+    print(f"Graph features of {num_sequences} sequences are saved in {output_file}")
+    print(f"Time elapsed: {(time.time() - start_time) / (60 * 60)}h")
+    return True
+
+########################################################################################################################
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Create the GraphProt feature file of a fasta file in parallel. "
+                                                 "Interrupted runs continue with the unfinished shards.")
+    parser.add_argument("fasta_file")
+    parser.add_argument("output_file", help="Feature file that is created, e.g. sequences.gspan.gz.feature")
+    parser.add_argument("--fasta2shrep", default="~/tools/pkgs/graphprot-1.1.7-2/libexec/graphprot/fasta2shrep_gspan.pl",
+                        help="Path to fasta2shrep_gspan.pl")
+    parser.add_argument("--eden", default="~/tools/envs/graphprot/libexec/graphprot/EDeN", help="Path to EDeN")
+    parser.add_argument("--workers", type=int, default=0, help="Number of parallel workers, by default one per cpu")
+    parser.add_argument("--shards-per-worker", type=int, default=4)
+    parser.add_argument("--work-dir", default="",
+                        help="Directory for the shards, by default [output_file].shards")
+    parser.add_argument("--cache", default="", nargs="?", const=sequence_cache.DEFAULT_CACHE_FILE,
+                        help=f"Take known feature vectors from a cache file and add new ones to it, "
+                             f"by default {sequence_cache.DEFAULT_CACHE_FILE}")
+    parser.add_argument("--cache-size", type=float, default=sequence_cache.DEFAULT_MAX_BYTES / 1024 ** 3,
+                        help="Size limit of the cache in GB, least recently used entries are evicted")
+    args = parser.parse_args()
+
+    success = create_graph_features(args.fasta_file, args.output_file, args.work_dir, args.fasta2shrep, args.eden,
+                                    args.workers, args.shards_per_worker, args.cache,
+                                    int(args.cache_size * 1024 ** 3))
+    sys.exit(0 if success else 1)
@@ -0,0 +1,252 @@
+import os
+import sys
+import json
+import time
+import atexit
+import resource
+import threading
+
+# This module records the wall time, cpu time, number of processed items and peak memory of the stages of a run
+# (reading, encoding, loading the model, predicting, writing), see stage
+# It is disabled by default, then stage only returns a shared object that does nothing
+# Set the environment variable NCRNA_INSTRUMENTATION to a file to enable it for any script, e.g.
+# NCRNA_INSTRUMENTATION=stages.jsonl python run_mncr.py input.fasta input.feature
+# When the process exits, one line per stage is appended to a .jsonl file, or a file in the Prometheus text format
+# is written if the file ends with .prom (for the textfile collector of the node exporter)
+# Set NCRNA_INSTRUMENTATION_JOB to name the run in the output, by default the name of the script is used
+
+# Aggregated measurements of every stage name, see report
+stages = {}
+output_file = ""
+job = ""
+enabled = False
+
+lock = threading.Lock()
+# Stages that are currently running in any thread of the process
+running = set()
+
+########################################################################################################################
+
+
+def read_current_rss():
+
+    # This function returns the current resident set size of the process in bytes (Linux only, otherwise 0)
+
+    try:
+        with open("/proc/self/statm", "r") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return 0
+
+########################################################################################################################
+
+
+def read_peak_rss():
+
+    # This function returns the peak resident set size of the process in bytes
+    # On Linux, the peak can be reset by reset_peak_rss, otherwise it is the peak since the start of the process
+
+    try:
+        with open("/proc/self/status", "r") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+########################################################################################################################
+
+
+def clear_peak_rss():
+
+    # This function resets the peak resident set size of the process to the current resident set size (Linux only)
+    # Returns False if the peak cannot be reset
+
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+########################################################################################################################
+
+
+def reset_peak_rss():
+
+    # This function resets the peak resident set size of the process, see clear_peak_rss
+    # The peak reached so far is kept by all running stages
+    # Returns False if the peak cannot be reset
+
+    with lock:
+        peak_rss = read_peak_rss()
+        for running_stage in running:
+            running_stage.peak_rss = max(running_stage.peak_rss, peak_rss)
+        return clear_peak_rss()
+
+########################################################################################################################
+
+
+class Stage:
+
+    # A running stage, created by stage
+    # The number of processed items can be given when the stage is created or added while it runs with add_items
+    # The peak memory is only reset when the first stage of the process starts, so stages that run at the same time
+    # in other threads or around it are not affected, and the peak of a stage includes the stages before it within
+    # the same outer stage
+
+    def __init__(self, name, items):
+        self.name = name
+        self.items = items
+        self.peak_rss = 0
+        self.discarded = False
+
+    def add_items(self, num_items):
+
+        # This method adds processed items to the stage, e.g. the rows of every chunk of a generator
+
+        self.items = self.items + num_items
+
+    def discard(self):
+
+        # This method drops the measurements of the stage, e.g. of the last call of a generator that found no items
+
+        self.discarded = True
+
+    def __enter__(self):
+        with lock:
+            if len(running) == 0:
+                clear_peak_rss()
+            running.add(self)
+        self.start_cpu_time = time.process_time()
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall_seconds = time.perf_counter() - self.start_time
+        cpu_seconds = time.process_time() - self.start_cpu_time
+        with lock:
+            self.peak_rss = max(self.peak_rss, read_peak_rss())
+            running.discard(self)
+            if self.discarded:
+                return False
+            record = stages.setdefault(self.name, {"calls": 0, "items": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0,
+                                                   "peak_rss_bytes": 0})
+            record["calls"] = record["calls"] + 1
+            record["items"] = record["items"] + self.items
+            record["wall_seconds"] = record["wall_seconds"] + wall_seconds
+            record["cpu_seconds"] = record["cpu_seconds"] + cpu_seconds
+            record["peak_rss_bytes"] = max(record["peak_rss_bytes"], self.peak_rss)
+        return False
+
+########################################################################################################################
+
+
+class DisabledStage:
+
+    # The stage returned by stage while the instrumentation is disabled, it does not measure anything
+
+    def add_items(self, num_items):
+        pass
+
+    def discard(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+DISABLED_STAGE = DisabledStage()
+
+########################################################################################################################
+
+
+def stage(name, items=0):
+
+    # This function returns a context manager that measures the code run within it as the stage name, e.g.
+    # with instrumentation.stage("encode_ragged", len(sequences)):
+    # Stages with the same name are summed up, stages can be nested and run in several threads at the same time
+    # cpu time and peak memory are measured for the whole process, so they include other threads running at
+    # the same time
+
+    if not enabled:
+        return DISABLED_STAGE
+    return Stage(name, items)
+
+########################################################################################################################
+
+
+def enable(file, job_name=""):
+
+    # This function enables the instrumentation and writes the measurements to file when the process exits
+
+    global enabled, output_file, job
+    if not enabled:
+        atexit.register(report)
+    output_file = file
+    job = job_name if job_name != "" else os.path.basename(sys.argv[0]).rsplit(".", 1)[0]
+    enabled = True
+
+########################################################################################################################
+
+
+def format_jsonl():
+
+    # This function returns one json line per stage
+
+    timestamp = time.strftime("%Y-%m-%dT%H:%M:%S")
+    return "".join(json.dumps({"job": job, "pid": os.getpid(), "time": timestamp, "stage": name, **record}) + "\n"
+                   for name, record in stages.items())
+
+########################################################################################################################
+
+
+def format_prometheus():
+
+    # This function returns the measurements in the Prometheus text format, one metric per measurement
+    # with the labels job and stage
+
+    metrics = [("calls", "ncrna_stage_calls_total", "counter", "Number of times the stage was run"),
+               ("items", "ncrna_stage_items_total", "counter", "Number of items processed by the stage"),
+               ("wall_seconds", "ncrna_stage_wall_seconds_total", "counter", "Wall time spent in the stage"),
+               ("cpu_seconds", "ncrna_stage_cpu_seconds_total", "counter", "cpu time of the process during the stage"),
+               ("peak_rss_bytes", "ncrna_stage_peak_rss_bytes", "gauge", "Peak resident set size during the stage")]
+    lines = []
+    for key, metric, metric_type, description in metrics:
+        lines.append(f"# HELP {metric} {description}")
+        lines.append(f"# TYPE {metric} {metric_type}")
+        for name, record in stages.items():
+            job_label = job.replace("\\", "\\\\").replace('"', '\\"')
+            stage_label = name.replace("\\", "\\\\").replace('"', '\\"')
+            lines.append(f'{metric}{{job="{job_label}",stage="{stage_label}"}} {record[key]}')
+    return "\n".join(lines) + "\n"
+
+########################################################################################################################
+
+
+def report():
+
+    # This function writes the measurements to the output file
+    # Prometheus files are replaced atomically, so a collector never reads a partly written file,
+    # json lines are appended, so several runs can share one file
+
+    if not enabled or len(stages) == 0:
+        return
+    with lock:
+        if output_file.endswith(".prom"):
+            with open(f"{output_file}.{os.getpid()}.tmp", "w") as file:
+                file.write(format_prometheus())
+            os.replace(f"{output_file}.{os.getpid()}.tmp", output_file)
+        else:
+            with open(output_file, "a") as file:
+                file.write(format_jsonl())
+
+########################################################################################################################
+
+
+if os.environ.get("NCRNA_INSTRUMENTATION", "") != "":
+    enable(os.environ["NCRNA_INSTRUMENTATION"], os.environ.get("NCRNA_INSTRUMENTATION_JOB", ""))
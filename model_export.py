@@ -0,0 +1,154 @@
+import model_registry
+import os
+import sys
+import argparse
+import numpy as np
+import run_ensemble
+
+# This module exports the keras models to TFLite, which runs the models on cpus with less overhead than keras and,
+# with the standalone runtime ai-edge-litert, without tensorflow
+# The weights can be quantized to float16 or int8 (dynamic range quantization, activations are computed in float)
+# Every export is compared with the keras model on a labelled test set and only kept if its accuracy and MCC
+# do not drop by more than a threshold
+# Exported models are used by selecting a TFLite backend, see model_registry.set_backend
+
+QUANTIZATIONS = ["", "float16", "int8"]
+
+########################################################################################################################
+
+
+def convert_to_tflite(model_name, quantization=""):
+
+    # This function converts the keras model into a TFLite model with the given quantization
+    # Returns the TFLite model as bytes
+
+    ks = model_registry.import_keras()
+    import tensorflow as tf
+
+    model = ks.models.load_model(model_registry.MODEL_FILES[model_name], compile=False)
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantization == "float16":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == "int8":
+        # Without a representative dataset, the weights are stored as int8 and the activations stay float
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    return converter.convert()
+
+########################################################################################################################
+
+
+def read_labels(labels_file):
+
+    # This function reads a file with one ncRNA class label per line
+
+    with open(labels_file, "r") as file:
+        return [line.strip() for line in file if line.strip() != ""]
+
+########################################################################################################################
+
+
+def compare_with_keras(model_name, tflite_file, inputs, labels):
+
+    # This function predicts the encoded inputs (see run_ensemble.read_inputs) with the keras model, also if a TFLite
+    # backend is selected, and the TFLite model
+    # It returns the accuracy and MCC of both and the fraction of sequences with the same predicted class
+
+    from sklearn.metrics import accuracy_score, matthews_corrcoef
+
+    scores = {}
+    predictions = {}
+    for name, model in (("keras", model_registry.get_keras_model(model_name)),
+                        ("tflite", model_registry.TFLiteModel(tflite_file))):
+        predictions[name], pred_probabilities = model_registry.decode_predictions(
+            run_ensemble.predict_model(model_name, inputs, model=model))
+        scores[name] = {"accuracy": accuracy_score(labels, predictions[name]),
+                        "mcc": matthews_corrcoef(labels, predictions[name])}
+    scores["agreement"] = np.mean(np.array(predictions["keras"]) == np.array(predictions["tflite"]))
+
+    return scores
+
+########################################################################################################################
+
+
+def export_model(model_name, quantization, inputs=None, labels=None, max_drop=0.01):
+
+    # This function exports a model to model_registry.tflite_model_file(model_name, quantization)
+    # If inputs and labels are given, the export is only saved if neither its accuracy nor its MCC are more than
+    # max_drop lower than those of the keras model, without them it is saved unchecked
+    # Returns True if the export was saved
+
+    tflite_file = model_registry.tflite_model_file(model_name, quantization)
+    with open(f"{tflite_file}.tmp", "wb") as file:
+        file.write(convert_to_tflite(model_name, quantization))
+    print(f"Converted {model_registry.MODEL_FILES[model_name]} to TFLite "
+          f"({quantization if quantization != '' else 'float32'}, "
+          f"{os.path.getsize(f'{tflite_file}.tmp') / 1024 ** 2:.1f} MB)")
+
+    if inputs is not None:
+        scores = compare_with_keras(model_name, f"{tflite_file}.tmp", inputs, labels)
+        print(f"Accuracy: {scores['keras']['accuracy']:.4f} (keras), {scores['tflite']['accuracy']:.4f} (TFLite)\n"
+              f"MCC: {scores['keras']['mcc']:.4f} (keras), {scores['tflite']['mcc']:.4f} (TFLite)\n"
+              f"Same predicted class: {scores['agreement']:.2%}")
+        if scores["keras"]["accuracy"] - scores["tflite"]["accuracy"] > max_drop or \
+                scores["keras"]["mcc"] - scores["tflite"]["mcc"] > max_drop:
+            print(f"Rejected: accuracy or MCC dropped by more than {max_drop}")
+            os.remove(f"{tflite_file}.tmp")
+            return False
+
+    os.replace(f"{tflite_file}.tmp", tflite_file)
+    print(f"Saved {tflite_file}")
+    return True
+
+########################################################################################################################
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export the models to TFLite and check their accuracy and MCC "
+                                                 "against the keras models on a labelled test set.")
+    parser.add_argument("models", nargs="*", default=list(model_registry.MODEL_FILES),
+                        help="Models to export, by default all models")
+    parser.add_argument("--quantization", choices=["none", "float16", "int8"], default="none")
+    parser.add_argument("--fasta", default="testing_datasets/rnacentral_testset.fasta",
+                        help="Fasta file of the test set (MncR, SeqEnc)")
+    parser.add_argument("--feature", default="", help="GraphProt features of the test set (MncR, GrEnc)")
+    parser.add_argument("--structure", default="", help="Pysster structures of the test set (StrEnc)")
+    parser.add_argument("--labels", default="testing_datasets/rnacentral_testset_labels.txt",
+                        help="ncRNA class labels of the test set, one per line")
+    parser.add_argument("--max-drop", type=float, default=0.01,
+                        help="Largest accepted drop of accuracy and MCC compared to the keras model")
+    parser.add_argument("--skip-check", action="store_true", help="Save the exports without comparing them")
+    args = parser.parse_args()
+
+    quantization = "" if args.quantization == "none" else args.quantization
+    given_inputs = {"fasta": args.fasta, "feature": args.feature, "structure": args.structure}
+    labels = read_labels(args.labels) if not args.skip_check else None
+
+    num_failed = 0
+    for model_name in [model_name.lower() for model_name in args.models]:
+        if model_name not in model_registry.MODEL_FILES:
+            print(f"Unknown model {model_name}")
+            num_failed = num_failed + 1
+            continue
+        print(f"\n{model_name}")
+
+        inputs = None
+        if not args.skip_check:
+            missing = [key for key in run_ensemble.MODEL_INPUTS[model_name] if given_inputs[key] == ""]
+            if len(missing) > 0:
+                print(f"Cannot check the export without a {' and a '.join(missing)} input of the test set, "
+                      f"provide it or use --skip-check")
+                num_failed = num_failed + 1
+                continue
+            ids, inputs = run_ensemble.read_inputs(*[given_inputs[key] if key in run_ensemble.MODEL_INPUTS[model_name]
+                                                     else "" for key in ("fasta", "feature", "structure")])
+            if len(ids) != len(labels):
+                print(f"The test set contains {len(ids)} sequences, but {args.labels} contains {len(labels)} labels")
+                num_failed = num_failed + 1
+                continue
+
+        if not export_model(model_name, quantization, inputs, labels, args.max_drop):
+            num_failed = num_failed + 1
+
+    sys.exit(1 if num_failed > 0 else 0)
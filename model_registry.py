@@ -0,0 +1,441 @@
+import os
+import sys
+import time
+import threading
+import numpy as np
+import instrumentation
+
+# The registry loads every model at most once per process and imports keras and scikit-learn only when
+# a model or the label decoder is requested for the first time, so that scripts start without waiting for tensorflow
+
+# Time at which the registry was imported, used as the start of the process for the reported timings
+START_TIME = time.time()
+
+# The model files of the four classifiers, keyed by the lower case model name
+MODEL_FILES = {"mncr": "model_files/mncr_fold7.hdf5",
+               "strenc": "model_files/strenc_fold7.hdf5",
+               "seqenc": "model_files/seqenc_fold8.hdf5",
+               "grenc": "model_files/grenc_fold2.hdf5"}
+
+RNA_TYPES = ["lncRNA", "miRNA", "rRNA", "snRNA", "snoRNA", "tRNA"]
+
+# Backends that can run the models and the quantization of the TFLite files they use, see set_backend
+# The TFLite files are created by model_export.py
+BACKENDS = {"keras": None, "tflite": "", "tflite-float16": "float16", "tflite-int8": "int8"}
+backend = os.environ.get("NCRNA_BACKEND", "keras")
+
+# Memory budget for the batches of the models (e.g. "16G"), an empty string disables the autotuning,
+# see set_memory_budget and autotune.py
+memory_budget = os.environ.get("NCRNA_MEMORY_BUDGET", "")
+# Number of models that predict at the same time and share the memory budget
+concurrent_models = 1
+
+# GrEnc and the graph branch of MncR predict the graph features as sparse matrices with the keras backend,
+# see get_sparse_model, set NCRNA_SPARSE_GRAPH_INPUT=0 to predict them as dense matrices
+sparse_graph_input = os.environ.get("NCRNA_SPARSE_GRAPH_INPUT", "1") != "0"
+# Activations of the first layer of the graph input that the sparse models can compute
+SPARSE_ACTIVATIONS = {"linear": lambda x: x, "relu": lambda x: np.maximum(x, 0)}
+
+# Batch sizes chosen by autotune.py, models without a chosen batch size are predicted in batches of DEFAULT_BATCH_SIZE
+DEFAULT_BATCH_SIZE = 1024
+batch_sizes = {}
+
+# Number of intra-op and inter-op threads of tensorflow and the TFLite interpreters, 0 uses their defaults
+threads = {"intra_op": 0, "inter_op": 0}
+
+# Loaded models and the label decoder are cached here
+models = {}
+# Sparse versions of the loaded models keyed by the id of the model, None if a model has no sparse version
+sparse_models = {}
+label_decoder = None
+
+# Seconds spent on importing, loading and predicting, see report_timings
+timings = {}
+
+########################################################################################################################
+
+
+def import_keras():
+
+    # This function imports keras on first use and records how long the import took
+
+    if "keras" not in sys.modules:
+        os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+        start_time = time.time()
+        import keras
+        timings["import keras"] = time.time() - start_time
+        apply_threads()
+    return sys.modules["keras"]
+
+########################################################################################################################
+
+
+def apply_threads():
+
+    # This function sets the thread counts of tensorflow, which is only possible before it runs the first model
+
+    if "keras" not in sys.modules or sys.modules["keras"].backend.backend() != "tensorflow":
+        return
+    import tensorflow as tf
+    try:
+        if threads["intra_op"] > 0:
+            tf.config.threading.set_intra_op_parallelism_threads(threads["intra_op"])
+        if threads["inter_op"] > 0:
+            tf.config.threading.set_inter_op_parallelism_threads(threads["inter_op"])
+    except RuntimeError:
+        raise RuntimeError("The number of threads can only be set before the first model is loaded")
+
+########################################################################################################################
+
+
+def set_threads(intra_op=0, inter_op=0):
+
+    # This function sets the number of threads used within one operation (intra_op) and for independent operations
+    # (inter_op) of the models, 0 keeps the default of tensorflow (all cores)
+    # tensorflow uses the same threads for all models, so they have to be set before the first model is loaded,
+    # TFLite interpreters use intra_op threads and take them from the models that are loaded afterwards
+
+    threads["intra_op"] = intra_op
+    threads["inter_op"] = inter_op
+    apply_threads()
+
+########################################################################################################################
+
+
+def set_memory_budget(budget, num_concurrent_models=1):
+
+    # This function enables the autotuning of the batch sizes and threads for a memory budget like "16G" or "512M"
+    # for all models that are loaded afterwards (see autotune.py)
+    # num_concurrent_models is the number of models that predict at the same time and share the budget
+    # The budget can also be set with the environment variable NCRNA_MEMORY_BUDGET
+
+    global memory_budget, concurrent_models
+    if budget != "":
+        import autotune
+        autotune.parse_memory_size(budget)
+    memory_budget = budget
+    concurrent_models = num_concurrent_models
+
+########################################################################################################################
+
+
+def get_batch_size(model_name):
+
+    # This function returns the batch size of a model, which is chosen by autotune.py if a memory budget is set
+
+    return batch_sizes.get(model_name.lower(), DEFAULT_BATCH_SIZE)
+
+########################################################################################################################
+
+
+def get_predict_batch_size(model_name):
+
+    # This function returns the number of sequences that a model predicts in one call within a batch
+    # A batch chosen for the memory budget is predicted in one call, otherwise the batch size is None and keras
+    # splits every batch into its default batches of 32, which keeps the memory of the activations small
+
+    return batch_sizes.get(model_name.lower())
+
+########################################################################################################################
+
+
+def converted_model_files(model_name):
+
+    # This function returns the paths of the architecture and weight files created by convert_model
+    # They are saved next to the hdf5 file of the model
+
+    base_path = MODEL_FILES[model_name].rsplit(".", 1)[0]
+    return f"{base_path}.json", f"{base_path}.weights.npz"
+
+########################################################################################################################
+
+
+def convert_model(model_name):
+
+    # This function converts the hdf5 file of a model into a json file with the architecture and an uncompressed
+    # npz file with the weights, which load faster than the hdf5 file since the optimizer state is not restored
+    # and the model is not compiled
+    # get_model uses the converted files as soon as they exist and are newer than the hdf5 file
+
+    ks = import_keras()
+    model = ks.models.load_model(MODEL_FILES[model_name], compile=False)
+    json_file, weights_file = converted_model_files(model_name)
+    with open(json_file, "w") as file:
+        file.write(model.to_json())
+    np.savez(weights_file, *model.get_weights())
+    print(f"Converted {MODEL_FILES[model_name]} into {json_file} and {weights_file}")
+
+########################################################################################################################
+
+
+def tflite_model_file(model_name, quantization=""):
+
+    # This function returns the path of the TFLite file of a model with the given quantization ("", "float16" or "int8")
+    # It is saved next to the hdf5 file of the model
+
+    base_path = MODEL_FILES[model_name].rsplit(".", 1)[0]
+    return f"{base_path}_{quantization}.tflite" if quantization != "" else f"{base_path}.tflite"
+
+########################################################################################################################
+
+
+def set_backend(backend_name):
+
+    # This function selects the backend used by get_model for all models that are loaded afterwards
+    # "keras" uses the hdf5 files, "tflite", "tflite-float16" and "tflite-int8" the TFLite files exported
+    # by model_export.py
+    # The backend can also be selected with the environment variable NCRNA_BACKEND
+
+    global backend
+    if backend_name not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend_name}, choose one of {', '.join(BACKENDS)}")
+    backend = backend_name
+
+########################################################################################################################
+
+
+def import_tflite_interpreter():
+
+    # This function returns the TFLite interpreter class of the first installed runtime
+    # The standalone runtimes (ai-edge-litert, tflite-runtime) start much faster than tensorflow
+
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+    except ImportError:
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+    return Interpreter
+
+########################################################################################################################
+
+
+class TFLiteModel:
+
+    # A model exported to TFLite with the same predict method as the keras models, so that it can be used
+    # by all run_* scripts
+    # The inputs are assigned to the inputs of the model by their shape, which differs for the two inputs of MncR
+
+    def __init__(self, tflite_file, num_threads=None):
+        if num_threads is None and threads["intra_op"] > 0:
+            num_threads = threads["intra_op"]
+        self.tflite_file = tflite_file
+        self.interpreter = import_tflite_interpreter()(model_path=tflite_file, num_threads=num_threads)
+        self.runner = self.interpreter.get_signature_runner()
+        self.input_details = self.runner.get_input_details()
+        self.output_name = list(self.runner.get_output_details())[0]
+        # An interpreter must not be invoked by several threads at the same time
+        self.lock = threading.Lock()
+
+    def predict(self, inputs, verbose=0, batch_size=None):
+
+        # The interpreter always predicts all given inputs at once, batch_size is accepted like in keras
+
+        if not isinstance(inputs, (list, tuple)):
+            inputs = [inputs]
+        feed = {}
+        for array in inputs:
+            name = [name for name, details in self.input_details.items()
+                    if name not in feed and tuple(details["shape_signature"][1:]) == array.shape[1:]][0]
+            feed[name] = np.asarray(array, dtype=self.input_details[name]["dtype"])
+        with self.lock:
+            return self.runner(**feed)[self.output_name].copy()
+
+########################################################################################################################
+
+
+class SparseGraphModel:
+
+    # A keras model whose graph feature input is given as sparse matrix, with the same predict method as the keras
+    # models, see get_sparse_model
+    # The first dense layer of the graph input is computed as product of the sparse feature vectors and its weights,
+    # which only touches the non-zero features, and the remaining layers are run by keras on the small activations
+    # of that layer and the other inputs, so no dense feature vectors of 32,768 values are created
+
+    def __init__(self, model, graph_layer):
+        ks = import_keras()
+        self.model = model
+        self.graph_index = [i for i, tensor in enumerate(model.inputs) if tensor is graph_layer.input][0]
+        weights = graph_layer.get_weights()
+        self.kernel = weights[0].astype(np.float32)
+        self.bias = weights[1].astype(np.float32) if graph_layer.use_bias else np.zeros(weights[0].shape[1],
+                                                                                          dtype=np.float32)
+        self.activation = SPARSE_ACTIVATIONS[graph_layer.activation.__name__]
+        self.head = ks.Model(inputs=[graph_layer.output if i == self.graph_index else tensor
+                                     for i, tensor in enumerate(model.inputs)], outputs=model.outputs)
+
+    def predict(self, inputs, verbose=0, batch_size=None):
+        inputs = list(inputs) if isinstance(inputs, (list, tuple)) else [inputs]
+        graph_batch = inputs[self.graph_index]
+        with instrumentation.stage("sparse graph layer", graph_batch.shape[0]):
+            # A sparse matrix times a dense matrix is a dense matrix
+            inputs[self.graph_index] = self.activation(np.asarray(graph_batch @ self.kernel) + self.bias)
+        prediction = self.head.predict(inputs if len(inputs) > 1 else inputs[0], verbose=verbose, batch_size=batch_size)
+        return prediction[0] if isinstance(prediction, list) else prediction
+
+########################################################################################################################
+
+
+def get_sparse_model(model):
+
+    # This function returns a version of a loaded model that takes the graph features as sparse csr matrix,
+    # or None if the graph features have to be given as dense matrix
+    # The graph features can be sparse if the model is a keras model whose graph input (32,768 features) is only
+    # used by one dense layer with a linear or relu activation, which is the case for GrEnc and MncR
+    # The sparse versions are disabled by sparse_graph_input and are created once per model
+
+    if not sparse_graph_input or isinstance(model, TFLiteModel) or not hasattr(model, "layers"):
+        return None
+    if id(model) not in sparse_models:
+        graph_inputs = [tensor for tensor in model.inputs if tensor.shape[-1] == 32768]
+        graph_layers = [layer for layer in model.layers if len(graph_inputs) == 1 and
+                        any(tensor is graph_inputs[0] for node in getattr(layer, "_inbound_nodes", [])
+                            for tensor in node.input_tensors)]
+        if len(graph_layers) == 1 and type(graph_layers[0]).__name__ == "Dense" and \
+                graph_layers[0].activation.__name__ in SPARSE_ACTIVATIONS:
+            sparse_models[id(model)] = SparseGraphModel(model, graph_layers[0])
+        else:
+            sparse_models[id(model)] = None
+    return sparse_models[id(model)]
+
+########################################################################################################################
+
+
+def get_model(model_name):
+
+    # This function returns the model with the given name, which is loaded when it is requested for the first time
+    # Models are loaded from the files created by convert_model if they are up-to-date, otherwise from the hdf5 file
+    # If a TFLite backend is selected (see set_backend), the exported TFLite file of the model is loaded instead
+    # If a memory budget is set (see set_memory_budget), the threads are chosen before the first model is loaded
+    # and the batch size of every model is chosen when it is loaded
+
+    model_name = model_name.lower()
+    if memory_budget != "" and len(models) == 0 and threads["intra_op"] == 0 and threads["inter_op"] == 0:
+        import autotune
+        set_threads(*autotune.choose_threads(model_name))
+
+    if backend != "keras":
+        if f"{model_name} {backend}" not in models:
+            start_time = time.time()
+            tflite_file = tflite_model_file(model_name, BACKENDS[backend])
+            if not os.path.isfile(tflite_file):
+                raise FileNotFoundError(f"Could not find {tflite_file}, please export it with model_export.py")
+            with instrumentation.stage(f"load {model_name}"):
+                models[f"{model_name} {backend}"] = TFLiteModel(tflite_file)
+            timings[f"load {model_name} ({backend})"] = time.time() - start_time
+            tune_model(model_name, models[f"{model_name} {backend}"])
+        return models[f"{model_name} {backend}"]
+
+    return get_keras_model(model_name)
+
+########################################################################################################################
+
+
+def get_keras_model(model_name):
+
+    # This function returns the keras model with the given name regardless of the selected backend (see get_model)
+
+    model_name = model_name.lower()
+    if model_name not in models:
+        ks = import_keras()
+        start_time = time.time()
+
+        with instrumentation.stage(f"load {model_name}"):
+            hdf5_file = MODEL_FILES[model_name]
+            json_file, weights_file = converted_model_files(model_name)
+            if os.path.isfile(json_file) and os.path.isfile(weights_file) and \
+                    (not os.path.isfile(hdf5_file) or os.path.getmtime(weights_file) >= os.path.getmtime(hdf5_file)):
+                with open(json_file, "r") as file:
+                    model = ks.models.model_from_json(file.read())
+                weights = np.load(weights_file)
+                model.set_weights([weights[f"arr_{i}"] for i in range(len(weights.files))])
+            else:
+                # The models are only used for predictions, so they do not need to be compiled
+                model = ks.models.load_model(hdf5_file, compile=False)
+
+        models[model_name] = model
+        timings[f"load {model_name}"] = time.time() - start_time
+        tune_model(model_name, model)
+
+    return models[model_name]
+
+########################################################################################################################
+
+
+def tune_model(model_name, model):
+
+    # This function chooses the batch size of a model that was just loaded if a memory budget is set
+
+    if memory_budget != "":
+        import autotune
+        start_time = time.time()
+        autotune.tune(model_name, model)
+        timings[f"autotune {model_name}"] = time.time() - start_time
+
+########################################################################################################################
+
+
+def get_label_decoder():
+
+    # This function returns a one hot encoder fitted on the 6 possible RNA types, which is used to return
+    # the output as plain text
+    # It is created once per process
+
+    global label_decoder
+    if label_decoder is None:
+        from sklearn.preprocessing import OneHotEncoder
+        label_decoder = OneHotEncoder(sparse_output=False)
+        label_decoder.fit(np.array(RNA_TYPES).reshape(-1, 1))
+    return label_decoder
+
+########################################################################################################################
+
+
+def decode_predictions(prediction):
+
+    # This function converts the softmax outputs of a model into the predicted ncRNA types and their probabilities
+    # The time until the first prediction is decoded is recorded as first prediction latency
+
+    if "first prediction" not in timings:
+        timings["first prediction"] = time.time() - START_TIME
+
+    with instrumentation.stage("decode_predictions", len(prediction)):
+        # Return probability for each prediction
+        pred_probabilities = [np.max(x) for x in prediction]
+        # Convert results to ncRNA types
+        results = [x[0] for x in get_label_decoder().inverse_transform(prediction)]
+
+    return results, pred_probabilities
+
+########################################################################################################################
+
+
+def report_timings():
+
+    # This function prints the recorded timings in seconds
+
+    for name, seconds in timings.items():
+        print(f"{name}: {seconds:.2f}s")
+
+########################################################################################################################
+
+
+if __name__ == '__main__':
+    # Convert the given models, or all models if none are given, into the faster loading format
+    if len(sys.argv) > 1 and sys.argv[1] == "convert":
+        model_names = [model_name.lower() for model_name in sys.argv[2:]] or list(MODEL_FILES)
+        for model_name in model_names:
+            if model_name not in MODEL_FILES:
+                print(f"Unknown model {model_name}")
+            elif not os.path.isfile(MODEL_FILES[model_name]):
+                print(f"Could not find {MODEL_FILES[model_name]}")
+            else:
+                convert_model(model_name)
+    else:
+        print("Convert the hdf5 model files into a faster loading format by running\n"
+              "python model_registry.py convert\n"
+              "or\n"
+              "python model_registry.py convert seqenc grenc")
@@ -0,0 +1,318 @@
+import os
+import io
+import sys
+import json
+import queue
+import argparse
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import pandas as pd
+from Bio import SeqIO
+import data_processing
+import model_registry
+
+pd.options.mode.chained_assignment = None  # default='warn'
+
+########################################################################################################################
+
+
+class MicroBatcher:
+
+    # A micro batcher owns one loaded model and a thread that runs all predictions of this model
+    # Concurrent requests are put into a queue, the thread collects them until max_batch_size rows are gathered
+    # or no new request arrived within max_wait seconds and predicts all collected rows with one model.predict call
+    # Inputs are lists of matrices (one matrix per model input), the rows of all matrices belong to the same sequences
+    # Sparse matrices are only converted into dense matrices per batch
+
+    def __init__(self, model, max_batch_size=256, max_wait=0.005):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def predict(self, inputs):
+
+        # Submit the inputs of one request and wait until its rows were predicted
+        # Requests with more than max_batch_size rows are submitted in parts of max_batch_size rows
+        # Returns the prediction matrix of the request
+
+        requests = []
+        for start in range(0, inputs[0].shape[0], self.max_batch_size):
+            request = {"inputs": [matrix[start:start + self.max_batch_size] for matrix in inputs],
+                       "done": threading.Event(), "prediction": None, "error": None}
+            self.requests.put(request)
+            requests.append(request)
+        for request in requests:
+            request["done"].wait()
+            if request["error"] is not None:
+                raise request["error"]
+        return np.concatenate([request["prediction"] for request in requests])
+
+    def _run(self):
+        while True:
+            # Block until the first request arrives, then collect further requests for a short time
+            batch = [self.requests.get()]
+            num_rows = batch[0]["inputs"][0].shape[0]
+            while num_rows < self.max_batch_size:
+                try:
+                    request = self.requests.get(timeout=self.max_wait)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                num_rows = num_rows + request["inputs"][0].shape[0]
+
+            try:
+                # Stack the inputs of all requests and predict them together
+                inputs = [np.concatenate([dense_matrix(request["inputs"][i]) for request in batch])
+                          for i in range(len(batch[0]["inputs"]))]
+                if len(inputs) == 1:
+                    inputs = inputs[0]
+                prediction = self.model.predict(inputs, verbose=0)
+
+                # Hand every request its own rows of the prediction
+                start = 0
+                for request in batch:
+                    end = start + request["inputs"][0].shape[0]
+                    request["prediction"] = prediction[start:end]
+                    start = end
+            except Exception as error:
+                for request in batch:
+                    request["error"] = error
+            for request in batch:
+                request["done"].set()
+
+########################################################################################################################
+
+
+def dense_matrix(matrix):
+
+    # This function returns a sparse matrix as a dense matrix and a dense matrix unchanged
+
+    return matrix.toarray() if hasattr(matrix, "toarray") else matrix
+
+########################################################################################################################
+
+
+def parse_fasta_text(text):
+
+    # This function parses the content of a fasta file into a list of identifiers and a list of uppercase sequences
+
+    records = list(SeqIO.parse(io.StringIO(text), "fasta"))
+    return [rec.id for rec in records], [str(rec.seq).upper() for rec in records]
+
+########################################################################################################################
+
+
+def prepare_inputs(model_name, payload):
+
+    # This function turns the payload of a request into the sequence identifiers and the model inputs
+    # The payload is a dictionary with the keys "fasta" (MncR, SeqEnc and optionally GrEnc),
+    # "feature" (MncR and GrEnc) and "pysster" (StrEnc), each containing the content of the respective file
+    # The graph features are returned as a sparse matrix, which the micro batcher converts per batch
+    # Raises a ValueError if the payload does not fit the model
+
+    if not isinstance(payload, dict) or not all(isinstance(value, str) for value in payload.values()):
+        raise ValueError("The payload has to be a JSON object with the file contents as strings")
+    if model_name in {"mncr", "seqenc"}:
+        if "fasta" not in payload:
+            raise ValueError(f"{model_name} requires a fasta input")
+        ids, sequences = parse_fasta_text(payload["fasta"])
+        inputs = [data_processing.encode_nucleotide_matrix(sequences, 12000)]
+    elif model_name == "strenc":
+        if "pysster" not in payload:
+            raise ValueError("strenc requires a pysster structure input")
+        records = list(data_processing.parse_pysster_lines(io.StringIO(payload["pysster"])))
+        ids = [record[0] for record in records]
+        structures = data_processing.struc_annotator_batch([record[1] for record in records],
+                                                           [record[2] for record in records])
+        if None in structures:
+            raise ValueError("Structure input contains invalid records")
+        inputs = [data_processing.encode_structure_matrix(structures, 12000)]
+    else:
+        # The identifiers of GrEnc are taken from the optional fasta input
+        ids = None
+        if "fasta" in payload:
+            ids, _ = parse_fasta_text(payload["fasta"])
+        inputs = []
+
+    if model_name in {"mncr", "grenc"}:
+        if "feature" not in payload:
+            raise ValueError(f"{model_name} requires a graph feature input")
+        graph_matrix = data_processing.parse_graphprot_features(payload["feature"].encode())
+        # Positions outside of the feature vectors would be written outside of the dense matrix
+        graph_matrix.check_format(full_check=True)
+        if ids is None:
+            ids = [f"sequence_{i}" for i in range(graph_matrix.shape[0])]
+        if graph_matrix.shape[0] != len(ids):
+            raise ValueError("Number of graph feature vectors does not match number of sequences")
+        inputs.append(graph_matrix)
+
+    return ids, inputs
+
+########################################################################################################################
+
+
+class PredictionServer(ThreadingHTTPServer):
+
+    # HTTP server that keeps the models warm and routes every request to the micro batcher of the requested model
+    # POST /predict/<model> with a JSON payload (see prepare_inputs) returns "id\tclass\tprob" lines
+    # GET /health returns the names of the loaded models
+
+    daemon_threads = True
+
+    def __init__(self, address, models, max_batch_size=256, max_wait=0.005):
+        super().__init__(address, PredictionRequestHandler)
+
+        # Load every model once, keras is only imported by the server,
+        # so that the client starts without loading tensorflow
+        self.batchers = {}
+        for model_name in models:
+            if not os.path.isfile(model_registry.MODEL_FILES[model_name]):
+                print(f"Could not find {model_registry.MODEL_FILES[model_name]}, {model_name} will not be served")
+                continue
+            model = model_registry.get_model(model_name)
+            self.batchers[model_name] = MicroBatcher(model, max_batch_size, max_wait)
+            print(f"Loaded {model_name}")
+
+    def predict(self, model_name, payload):
+
+        # Predicts the payload with the requested model and returns the output lines as one string
+        # Raises a ValueError if the payload cannot be read
+
+        try:
+            ids, inputs = prepare_inputs(model_name, payload)
+        except ValueError:
+            raise
+        except Exception as error:
+            raise ValueError(f"The input could not be read: {error!r}")
+        if len(ids) == 0:
+            return ""
+        prediction = self.batchers[model_name].predict(inputs)
+        results, pred_probabilities = model_registry.decode_predictions(prediction)
+
+        output = io.StringIO()
+        data_processing.write_predictions(output, ids, results, pred_probabilities)
+        return output.getvalue()
+
+
+class PredictionRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._respond(200, json.dumps({"models": sorted(self.server.batchers)}), "application/json")
+        else:
+            self._respond(404, "Unknown path\n")
+
+    def do_POST(self):
+        model_name = self.path.rstrip("/").split("/")[-1].lower()
+        if not self.path.startswith("/predict/") or model_name not in self.server.batchers:
+            self._respond(404, f"Model {model_name} is not served\n")
+            return
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            self._respond(200, self.server.predict(model_name, payload))
+        except ValueError as error:
+            self._respond(400, f"{error}\n")
+        except Exception as error:
+            # Errors of the model or the micro batcher are reported instead of closing the connection
+            self._respond(500, f"Prediction failed: {error!r}\n")
+
+    def _respond(self, status, text, content_type="text/plain"):
+        body = text.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Requests are not logged to keep the console output readable
+        pass
+
+########################################################################################################################
+
+
+def predict_remote(model_name, fasta_file_input="", graph_input="", structure_input="",
+                   host="127.0.0.1", port=8765):
+
+    # This function is the client of the prediction server
+    # It sends the given input files to a running server and returns the output lines "id\tclass\tprob"
+    # in the same format as the files written by the run_* scripts
+
+    payload = {}
+    for key, filename in (("fasta", fasta_file_input), ("feature", graph_input), ("pysster", structure_input)):
+        if filename != "":
+            with open(filename, "r") as file:
+                payload[key] = file.read()
+
+    request = urllib.request.Request(f"http://{host}:{port}/predict/{model_name.lower()}",
+                                     data=json.dumps(payload).encode(),
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request) as response:
+        return response.read().decode()
+
+########################################################################################################################
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve the ncRNA classifiers from one long-running process "
+                                                 "or send input files to a running server.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="Load the models and start the server")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8765)
+    serve_parser.add_argument("--models", default="mncr,strenc,seqenc,grenc",
+                              help="Comma separated list of the models to serve")
+    serve_parser.add_argument("--max-batch-size", type=int, default=256,
+                              help="Maximum number of sequences predicted together")
+    serve_parser.add_argument("--max-wait", type=float, default=0.005,
+                              help="Seconds to wait for further requests before predicting a batch")
+    serve_parser.add_argument("--backend", default=model_registry.backend, choices=list(model_registry.BACKENDS),
+                              help="Run the models with keras or with the TFLite files exported by model_export.py")
+
+    predict_parser = subparsers.add_parser("predict", help="Send input files to a running server")
+    predict_parser.add_argument("--host", default="127.0.0.1")
+    predict_parser.add_argument("--port", type=int, default=8765)
+    predict_parser.add_argument("--model", required=True, choices=["mncr", "strenc", "seqenc", "grenc"],
+                                type=str.lower)
+    predict_parser.add_argument("--fasta", default="", help="Fasta file (MncR, SeqEnc, optionally GrEnc)")
+    predict_parser.add_argument("--feature", default="", help="Graph feature file (MncR, GrEnc)")
+    predict_parser.add_argument("--structure", default="", help="Pysster structure file (StrEnc)")
+    predict_parser.add_argument("--output", default="", help="Output file, the output is printed if not provided")
+
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        models = [model.strip().lower() for model in args.models.split(",")]
+        unknown_models = [model for model in models if model not in model_registry.MODEL_FILES]
+        if len(unknown_models) > 0:
+            print(f"Unknown models: {', '.join(unknown_models)}")
+            sys.exit()
+        model_registry.set_backend(args.backend)
+        server = PredictionServer((args.host, args.port), models, args.max_batch_size, args.max_wait)
+        print(f"Serving {', '.join(sorted(server.batchers))} on http://{args.host}:{args.port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
+    else:
+        try:
+            output = predict_remote(args.model, args.fasta, args.feature, args.structure, args.host, args.port)
+        except urllib.error.HTTPError as error:
+            print(f"The server could not predict the input: {error.read().decode().strip()}")
+            sys.exit()
+        except urllib.error.URLError:
+            print(f"Could not connect to a server on {args.host}:{args.port}")
+            sys.exit()
+        if args.output == "":
+            print(output, end="")
+        else:
+            with open(args.output, "w") as file:
+                file.write(output)
+            print(f"Results are saved in {args.output}")
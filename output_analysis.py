@@ -1,24 +1,198 @@
+import sys
+import argparse
+import itertools
 import pandas as pd
-import plotnine as p9
 import numpy as np
-from sklearn.metrics import classification_report
-from sklearn.metrics import confusion_matrix
-from sklearn.metrics import matthews_corrcoef
 
 pd.options.mode.chained_assignment = None  # default='warn'
 
+RNA_TYPES = ["lncRNA", "miRNA", "rRNA", "snRNA", "snoRNA", "tRNA"]
 
-def return_output_analysis(true, pred):
+
+def matrix_scores(matrices):
+
+    # This method computes the scores of one or more confusion matrices (rows: true class, columns: predicted class)
+    # matrices has the shape (..., n, n), all scores are computed for all matrices at once
+    # Returns a dictionary with the per class "precision", "recall", "f1-score" and "support" (shape (..., n)) and the
+    # overall "accuracy", "macro f1-score", "weighted f1-score" and "mcc" (shape (...))
+    # Like scikit-learn, scores that are not defined (division by zero) are 0
+
+    matrices = np.asarray(matrices, dtype=np.float64)
+    true_positives = np.diagonal(matrices, axis1=-2, axis2=-1)
+    support = matrices.sum(axis=-1)
+    predicted = matrices.sum(axis=-2)
+    num_samples = support.sum(axis=-1)
+
+    def divide(a, b):
+        return np.divide(a, b, out=np.zeros(np.broadcast(a, b).shape), where=b != 0)
+
+    precision = divide(true_positives, predicted)
+    recall = divide(true_positives, support)
+    f1 = divide(2 * precision * recall, precision + recall)
+
+    # Matthews correlation coefficient of the multiclass case, computed from the matrix like in scikit-learn
+    correct = true_positives.sum(axis=-1)
+    cov_true_pred = correct * num_samples - (support * predicted).sum(axis=-1)
+    cov_pred_pred = num_samples ** 2 - (predicted * predicted).sum(axis=-1)
+    cov_true_true = num_samples ** 2 - (support * support).sum(axis=-1)
+
+    return {"precision": precision, "recall": recall, "f1-score": f1, "support": support,
+            "accuracy": divide(correct, num_samples),
+            "macro f1-score": f1.mean(axis=-1),
+            "weighted f1-score": divide((f1 * support).sum(axis=-1), num_samples),
+            "mcc": divide(cov_true_pred, np.sqrt(cov_true_true * cov_pred_pred))}
+
+
+class ConfusionMatrix:
+
+    # Counts the predictions of every true class and predicted class in a 6x6 matrix, which is updated batch by batch
+    # All scores are derived from the matrix, so neither the labels nor the predictions have to be kept in memory
+    # Like scikit-learn, labels that are not one of the classes are added as classes in sorted order and the matrix
+    # grows, with fixed_classes they raise a ValueError instead
+
+    def __init__(self, classes=RNA_TYPES, fixed_classes=False):
+        self.classes = list(classes)
+        self.fixed_classes = fixed_classes
+        # The columns of the softmax outputs given to update_probabilities
+        self.output_classes = list(classes)
+        self.matrix = np.zeros((len(self.classes), len(self.classes)), dtype=np.int64)
+
+    def add_classes(self, labels):
+
+        # Adds the labels that are not a class yet to the classes and the matrix
+
+        new_labels = [label for label in pd.unique(np.asarray(labels, dtype=object)) if label not in self.classes]
+        if len(new_labels) == 0:
+            return
+        classes = sorted(self.classes + new_labels)
+        positions = [classes.index(label) for label in self.classes]
+        matrix = np.zeros((len(classes), len(classes)), dtype=np.int64)
+        matrix[np.ix_(positions, positions)] = self.matrix
+        self.classes = classes
+        self.matrix = matrix
+
+    def codes(self, labels):
+
+        # Returns the class indices of the labels, raises a ValueError for labels that are not a class
+
+        codes = pd.Categorical(np.asarray(labels, dtype=object), categories=self.classes).codes.astype(np.int64)
+        if (codes < 0).any():
+            unknown = pd.unique(np.asarray(labels, dtype=object)[codes < 0])
+            raise ValueError(f"Unknown labels {', '.join(map(str, unknown[:10]))}, the labels have to be one of "
+                             f"{', '.join(self.classes)}")
+        return codes
+
+    def update(self, true, pred):
+
+        # Adds a batch of true labels and predicted labels (any sequences of class names of equal length)
+
+        if len(true) != len(pred):
+            raise ValueError(f"{len(true)} labels but {len(pred)} predictions")
+        if not self.fixed_classes:
+            self.add_classes(true)
+            self.add_classes(pred)
+        num_classes = len(self.classes)
+        self.matrix += np.bincount(self.codes(true) * num_classes + self.codes(pred),
+                                   minlength=num_classes ** 2).reshape(num_classes, num_classes)
+
+    def update_probabilities(self, true, prediction):
+
+        # Adds a batch of true labels and the softmax outputs of a model (one column per class)
+
+        if len(true) != len(prediction):
+            raise ValueError(f"{len(true)} labels but {len(prediction)} predictions")
+        self.update(true, np.asarray(self.output_classes, dtype=object)[np.asarray(prediction).argmax(axis=1)])
+
+    def merge(self, other):
+
+        # Adds the counts of another confusion matrix, e.g. of another shard of the same test set
+
+        self.add_classes(other.classes)
+        positions = [self.classes.index(label) for label in other.classes]
+        self.matrix[np.ix_(positions, positions)] += other.matrix
+
+    def scores(self):
+
+        # Returns the scores of the matrix, see matrix_scores
+
+        return matrix_scores(self.matrix)
+
+    def mcc(self):
+        return float(self.scores()["mcc"])
+
+    def bootstrap(self, num_samples=1000, confidence=0.95, seed=0):
+
+        # Returns bootstrap confidence intervals of the overall scores as dictionary of (lower, upper) bounds
+        # Resampling the sequences with replacement is the same as drawing the counts of the matrix from a multinomial
+        # distribution with the observed frequencies, so all num_samples matrices are drawn and scored at once
+
+        num_classes = len(self.classes)
+        total = int(self.matrix.sum())
+        rng = np.random.default_rng(seed)
+        samples = rng.multinomial(total, self.matrix.ravel() / max(total, 1), size=num_samples)
+        scores = matrix_scores(samples.reshape(num_samples, num_classes, num_classes))
+
+        alpha = (1 - confidence) / 2
+        return {name: tuple(np.quantile(scores[name], [alpha, 1 - alpha]))
+                for name in ("accuracy", "macro f1-score", "weighted f1-score", "mcc")}
+
+    def classification_report(self, digits=4):
+
+        # Returns the classification report in the format of scikit-learn's classification_report
+        # Like scikit-learn, only classes that occur as true or predicted label are listed
+
+        scores = self.scores()
+        present = np.flatnonzero((self.matrix.sum(axis=0) + self.matrix.sum(axis=1)) > 0)
+        headers = ["precision", "recall", "f1-score", "support"]
+        width = max([len(self.classes[i]) for i in present] + [len("weighted avg"), digits])
+        row_fmt = "{:>{width}s} " + " {:>9.{digits}f}" * 3 + " {:>9}\n"
+
+        report = ("{:>{width}s} " + " {:>9}" * len(headers)).format("", *headers, width=width) + "\n\n"
+        for i in present:
+            report += row_fmt.format(self.classes[i], scores["precision"][i], scores["recall"][i],
+                                     scores["f1-score"][i], int(scores["support"][i]), width=width, digits=digits)
+        report += "\n"
+
+        # The averages are taken over the listed classes only
+        support = scores["support"][present]
+        total = int(support.sum())
+        report += ("{:>{width}s} " + " {:>9.{digits}}" * 2 + " {:>9.{digits}f}" + " {:>9}\n").format(
+            "accuracy", "", "", scores["accuracy"], total, width=width, digits=digits)
+        report += row_fmt.format("macro avg", *[scores[name][present].mean() for name in headers[:3]], total,
+                                 width=width, digits=digits)
+        report += row_fmt.format("weighted avg", *[(scores[name][present] * support).sum() / max(total, 1)
+                                                   for name in headers[:3]], total, width=width, digits=digits)
+        return report
+
+
+def return_output_analysis(true, pred, num_bootstrap_samples=0):
 
     # This method writes scikit-learn's classification report and the MCC to "classification_scores.txt"
+    # true and pred are lists of labels, for large test sets use write_scores with a ConfusionMatrix
+    # Returns the confusion matrix
+
+    matrix = ConfusionMatrix()
+    matrix.update(true, pred)
+    write_scores(matrix, num_bootstrap_samples=num_bootstrap_samples)
+    return matrix
+
+
+def write_scores(matrix, output_file="classification_scores.txt", num_bootstrap_samples=0):
 
-    print(classification_report(true, pred, digits=4))
-    print(f"Matthews Correlation Coefficient: {np.round(matthews_corrcoef(true, pred), 4)}")
+    # This method writes the classification report and the MCC of a ConfusionMatrix to output_file
+    # If num_bootstrap_samples is larger than 0, 95% bootstrap confidence intervals of the accuracy, the macro
+    # and weighted f1-score and the MCC are added
+
+    scores = matrix.classification_report(digits=4) + \
+        f"Matthews Correlation Coefficient: {np.round(matrix.mcc(), 4)}"
+    if num_bootstrap_samples > 0:
+        intervals = matrix.bootstrap(num_bootstrap_samples)
+        scores += f"\n\n95% confidence intervals ({num_bootstrap_samples} bootstrap samples):\n" + \
+            "".join(f"{name}: {lower:.4f} - {upper:.4f}\n" for name, (lower, upper) in intervals.items())
+    print(scores)
 
-    output_file = "classification_scores.txt"
     output = open(output_file, "w")
-    output.write(classification_report(true, pred, digits=4))
-    output.write(f"Matthews Correlation Coefficient: {np.round(matthews_corrcoef(true, pred), 4)}")
+    output.write(scores)
     output.close()
     print(f"Classification scores are saved in {output_file}")
 
@@ -27,15 +201,24 @@ def plot_confusion_matrix(true, pred):
 
     # This method plots a normalized confusion matrix to a file called "confusion_matrix.png"
 
-    # Create regular confusion matrix
-    conf_mat = confusion_matrix(true, pred)
+    matrix = ConfusionMatrix()
+    matrix.update(true, pred)
+    plot_matrix(matrix)
+
+
+def plot_matrix(matrix, output_file="confusion_matrix.png"):
+
+    # This method plots a ConfusionMatrix normalized over each row to output_file
+    # plotnine is only imported when a plot is created, since importing it takes several seconds
 
-    # Normalize over each row
-    conf = []
-    for row in conf_mat:
-        conf.append(row / sum(row))
+    import plotnine as p9
 
-    rna_types = ["lncRNA", "miRNA", "rRNA", "snRNA", "snoRNA", "tRNA"]
+    # Normalize over each row, rows of classes that do not occur are 0
+    conf_mat = matrix.matrix.astype(np.float64)
+    row_sums = conf_mat.sum(axis=1, keepdims=True)
+    conf = np.divide(conf_mat, row_sums, out=np.zeros_like(conf_mat), where=row_sums != 0)
+
+    rna_types = matrix.classes
 
     # Turn into dataframe for melting
     conf = pd.DataFrame(conf, index=rna_types, columns=rna_types)
@@ -54,10 +237,8 @@ def plot_confusion_matrix(true, pred):
 
     # This creates the labels displayed in the conf_matrix
     # For values below the rounding threshold (<0.005) the box is left empty to reduce clutter
-    conf_melt["pred_string"] = ""
-    for i in range(0, len(conf_melt)):
-        if conf_melt.Prediction[i] >= 0.005:
-            conf_melt.pred_string[i] = str(np.round(conf_melt.Prediction[i], 2))
+    conf_melt["pred_string"] = np.where(conf_melt["Prediction"] >= 0.005,
+                                        conf_melt["Prediction"].round(2).astype(str), "")
 
     plot = (p9.ggplot(conf_melt, p9.aes('Predicted Class', 'rna_type', fill="Prediction"))
             + p9.geom_tile(p9.aes(width=.95, height=.95))
@@ -77,5 +258,84 @@ def plot_confusion_matrix(true, pred):
                 plot_title=p9.element_blank()
                 )
             )
-    plot.save(filename="confusion_matrix.png", dpi=300)
-    print("The confusion matrix was saved in confusion_matrix.png")
+    plot.save(filename=output_file, dpi=300)
+    print(f"The confusion matrix was saved in {output_file}")
+
+
+def iter_label_chunks(labels_file, chunk_size=1000000):
+
+    # This method reads a labels file (one ncRNA class per line) in chunks of chunk_size labels
+
+    with open(labels_file, "r") as file:
+        while True:
+            labels = [line.strip("\n") for line in itertools.islice(file, chunk_size)]
+            if len(labels) == 0:
+                break
+            yield labels
+
+
+def iter_prediction_chunks(output_file, chunk_size=1000000):
+
+    # This method reads the predicted classes of an output file of the models in chunks of at most chunk_size
+    # predictions, the output file is a text file or a parquet or arrow file (see prediction_output)
+
+    import prediction_output
+    file_format = prediction_output.output_format(output_file)
+    if file_format == "tsv":
+        for chunk in pd.read_csv(output_file, sep="\t", header=None, usecols=[1], dtype=str, quoting=3,
+                                 chunksize=chunk_size):
+            yield chunk[1].tolist()
+    elif file_format == "parquet":
+        pa = prediction_output.import_pyarrow()
+        for batch in pa.parquet.ParquetFile(output_file).iter_batches(batch_size=chunk_size, columns=["prediction"]):
+            yield batch.column(0).to_pandas().astype(str).tolist()
+    else:
+        pa = prediction_output.import_pyarrow()
+        with pa.memory_map(output_file, "r") as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                yield reader.get_batch(i).column("prediction").to_pandas().astype(str).tolist()
+
+
+def evaluate_files(labels_file, output_file, chunk_size=1000000):
+
+    # This method compares the predictions of an output file with the labels of a labels file chunk by chunk
+    # Only one chunk of labels and predictions is held in memory, so test sets of any size can be evaluated
+    # Labels and predictions have to be one of the RNA_TYPES, otherwise a ValueError is raised
+    # Returns the ConfusionMatrix
+
+    matrix = ConfusionMatrix(fixed_classes=True)
+    labels = itertools.chain.from_iterable(iter_label_chunks(labels_file, chunk_size))
+    num_predictions = 0
+    for predictions in iter_prediction_chunks(output_file, chunk_size):
+        true = list(itertools.islice(labels, len(predictions)))
+        if len(true) != len(predictions):
+            raise ValueError(f"{labels_file} contains fewer labels than {output_file} contains predictions")
+        matrix.update(true, predictions)
+        num_predictions = num_predictions + len(predictions)
+    if next(labels, None) is not None:
+        raise ValueError(f"{labels_file} contains more labels than {output_file} contains predictions "
+                         f"({num_predictions})")
+    return matrix
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compute the classification report, the MCC and the confusion "
+                                                 "matrix of an output file of the models and a labels file "
+                                                 "without loading them into memory at once.")
+    parser.add_argument("labels", help="Labels file with one ncRNA class per line")
+    parser.add_argument("predictions", help="Output file of the models (text, parquet or arrow)")
+    parser.add_argument("--bootstrap", type=int, default=1000,
+                        help="Number of bootstrap samples for the confidence intervals, 0 to skip them")
+    parser.add_argument("--scores", default="classification_scores.txt")
+    parser.add_argument("--plot", default="", help="Save the normalized confusion matrix as this image file")
+    args = parser.parse_args()
+
+    try:
+        evaluation = evaluate_files(args.labels, args.predictions)
+    except ValueError as error:
+        print(error.args[0])
+        sys.exit(1)
+    write_scores(evaluation, args.scores, args.bootstrap)
+    if args.plot != "":
+        plot_matrix(evaluation, args.plot)
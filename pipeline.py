@@ -0,0 +1,323 @@
+import model_registry
+import sys
+import queue
+import argparse
+import itertools
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import data_processing
+import prediction_output
+import prediction_cache
+import instrumentation
+import autotune
+import predict_ncRNAs
+
+# This module predicts the inputs of a job in chunks with the reading, encoding, predicting and writing overlapped
+# The main process only reads the raw records of every chunk from the input files, worker processes parse and encode
+# them, the main process predicts the encoded chunks in the order of the input and a separate thread writes the
+# predictions to the output file
+# While the model predicts a chunk, the workers already encode the next chunks and the previous chunk is written,
+# so a run takes about as long as the slower of the encoding and the prediction instead of their sum
+# At most max_pending chunks are read and encoded ahead of the prediction and at most two predicted chunks wait for
+# the writer, so the memory usage depends on the chunk size and not on the size of the input
+# The output is the same as the one of the streaming functions of the run_* scripts with the same chunk size
+# Fasta files (optionally compressed), graphprot feature files and pysster structure files are supported, ragged stores
+# and feature stores are already encoded and are predicted by the streaming functions instead
+
+# Number of predicted chunks that wait for the writer
+WRITER_QUEUE_SIZE = 2
+
+########################################################################################################################
+
+
+def is_supported(job):
+
+    # This function tests if all inputs of a job (see predict_ncRNAs.run_job) can be encoded by the workers
+
+    inputs = predict_ncRNAs.MODEL_INPUTS[job["model"]] + predict_ncRNAs.OPTIONAL_INPUTS.get(job["model"], [])
+    return not any(data_processing.is_ragged_store(job[key]) or data_processing.is_feature_store(job[key])
+                   for key in inputs if job[key] != "")
+
+########################################################################################################################
+
+
+def default_num_workers():
+
+    # This function returns the number of worker processes used by default, one core is left for the prediction
+
+    return max(1, autotune.available_cores() - 1)
+
+########################################################################################################################
+
+
+def record_starts(data, previous_end=b"\n"):
+
+    # This function returns the positions of all lines of a block of a fasta file that start a record
+    # previous_end is the byte before the block, a ">" at the start of the block starts a record if it is a line break
+
+    raw = np.frombuffer(data, dtype=np.uint8)
+    starts = np.flatnonzero(raw == ord(">"))
+    is_start = raw[np.maximum(starts - 1, 0)] == ord("\n")
+    if len(starts) > 0 and starts[0] == 0:
+        is_start[0] = previous_end == b"\n"
+    return starts[is_start]
+
+########################################################################################################################
+
+
+def iter_fasta_records(filename, chunk_size, block_size=data_processing.FASTA_BLOCK_SIZE):
+
+    # This function reads a fasta file (optionally compressed, see data_processing.open_fasta_file) and yields the raw
+    # bytes of chunk_size complete records at a time, which data_processing.parse_fasta_block parses
+    # The records are only found by the positions of their first lines, so reading costs little more than the I/O
+
+    data = bytearray()
+    starts = np.zeros(0, dtype=np.int64)
+    previous_end = b"\n"
+    with data_processing.open_fasta_file(filename) as file:
+        while True:
+            block = file.read(block_size)
+            starts = np.concatenate((starts, record_starts(block, previous_end) + len(data)))
+            data.extend(block)
+            previous_end = block[-1:] if len(block) > 0 else previous_end
+            # A record is complete once the next record starts or the file ends
+            while len(starts) > chunk_size or len(block) == 0 and len(starts) > 0:
+                end = starts[chunk_size] if len(starts) > chunk_size else len(data)
+                yield bytes(data[starts[0]:end])
+                del data[:end]
+                starts = starts[chunk_size:] - end
+            if len(block) == 0:
+                break
+
+########################################################################################################################
+
+
+def iter_lines(filename, num_lines, mode="rb"):
+
+    # This function yields the lines of a file in chunks of num_lines lines
+
+    with open(filename, mode) as file:
+        while True:
+            lines = list(itertools.islice(file, num_lines))
+            if len(lines) == 0:
+                break
+            yield lines
+
+########################################################################################################################
+
+
+def iter_raw_chunks(job, chunk_size):
+
+    # This function yields the raw records of chunk_size sequences of every input of a job as tasks for encode_chunk
+    # Every task is a tuple of the model and a dictionary with the bytes of the fasta records and the graphprot feature
+    # lines or the lines of the pysster records
+    # If one input ends before the others, its part of the remaining tasks is empty, so encode_chunk returns fewer rows
+    # for it and the mismatch is noticed by run_pipelined
+
+    model_name = job["model"]
+    readers = {}
+    for key in predict_ncRNAs.MODEL_INPUTS[model_name] + predict_ncRNAs.OPTIONAL_INPUTS.get(model_name, []):
+        if key == "fasta" and job[key] != "":
+            readers[key] = iter_fasta_records(job[key], chunk_size)
+        elif key == "feature":
+            readers[key] = (b"".join(lines) for lines in iter_lines(job[key], chunk_size))
+        elif key == "structure":
+            # Every pysster record consists of three lines
+            readers[key] = iter_lines(job[key], 3 * chunk_size, "r")
+
+    empty = {"fasta": b"", "feature": b"", "structure": []}
+    for chunk in itertools.zip_longest(*readers.values()):
+        yield model_name, {key: data if data is not None else empty[key] for key, data in zip(readers, chunk)}
+
+########################################################################################################################
+
+
+def encode_chunk(task):
+
+    # This function parses and encodes the raw records of a task of iter_raw_chunks, it runs in the worker processes
+    # Returns the identifiers (None if only graph features are given) and the encoded inputs in the format of
+    # run_ensemble.read_inputs, so the chunk can be predicted by run_ensemble.predict_model
+
+    model_name, chunk = task
+    ids = None
+    inputs = {}
+    if "fasta" in chunk:
+        with instrumentation.stage("parse_fasta_block") as stage:
+            ids, sequences = data_processing.parse_fasta_block(chunk["fasta"])
+            stage.add_items(len(ids))
+        # The fasta file of GrEnc only provides the identifiers
+        if model_name != "grenc":
+            inputs["sequences"] = data_processing.encode_ragged(sequences, data_processing.NUCLEOTIDE_TABLE, 12000)
+
+    if "structure" in chunk:
+        records = list(data_processing.parse_pysster_lines(chunk["structure"]))
+        ids = [record[0] for record in records]
+        structures = data_processing.struc_annotator_batch([record[1] for record in records],
+                                                           [record[2] for record in records])
+        if None in structures:
+            raise ValueError("Structure file contains invalid records")
+        inputs["structures"] = data_processing.encode_ragged(structures, data_processing.STRUCTURE_TABLE, 12000)
+
+    if "feature" in chunk:
+        inputs["graph"] = data_processing.parse_graphprot_features(chunk["feature"])
+
+    return ids, inputs
+
+########################################################################################################################
+
+
+def iter_encoded_chunks(tasks, executor, max_pending):
+
+    # This function submits the tasks to the worker processes and returns a generator of their results in the order
+    # of the tasks
+    # The first max_pending tasks are submitted right away and the next task whenever the oldest result is taken,
+    # so the workers encode ahead while the caller processes a result, but the raw and the encoded chunks that wait
+    # for the caller stay bounded
+
+    tasks = iter(tasks)
+    pending = deque(executor.submit(encode_chunk, task) for task in itertools.islice(tasks, max_pending))
+
+    def results():
+        while len(pending) > 0:
+            with instrumentation.stage("wait for encoded chunk"):
+                result = pending.popleft().result()
+            task = next(tasks, None)
+            if task is not None:
+                pending.append(executor.submit(encode_chunk, task))
+            yield result
+
+    return results()
+
+########################################################################################################################
+
+
+class BackgroundWriter:
+
+    # Writes the predictions with a writer of prediction_output in a separate thread, so the main process can predict
+    # the next chunk in the meantime
+    # write blocks while queue_size chunks are waiting, an error of the writer is raised by the next write or by close
+
+    def __init__(self, output_file, queue_size=WRITER_QUEUE_SIZE):
+        self.output = prediction_output.open_writer(output_file)
+        self.queue = queue.Queue(queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+
+        # Writes the queued chunks until close puts None into the queue
+        # After an error, the remaining chunks are taken from the queue without writing them, so write does not block
+
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is None:
+                try:
+                    with instrumentation.stage("write predictions", len(item[0])):
+                        self.output.write(*item)
+                except Exception as error:
+                    self.error = error
+
+    def write(self, ids, prediction):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((ids, prediction))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.output.close()
+        if self.error is not None:
+            raise self.error
+
+########################################################################################################################
+
+
+def run_pipelined(job, output_file, chunk_size=10000, num_workers=0, max_pending=0):
+
+    # This function predicts a job (see predict_ncRNAs.run_job) in chunks of chunk_size sequences and writes the
+    # predictions to output_file (see prediction_output) while the next chunks are encoded by num_workers worker
+    # processes (by default all cores but one) and at most max_pending chunks (by default two per worker) are
+    # encoded ahead
+    # The model is loaded while the workers encode the first chunks
+    # Raises a ValueError if the inputs do not contain the same number of sequences
+    # Returns the number of predicted sequences
+
+    import run_ensemble
+    model_name = job["model"]
+    if num_workers <= 0:
+        num_workers = default_num_workers()
+    if max_pending <= 0:
+        max_pending = 2 * num_workers
+
+    num_predicted = 0
+    output = BackgroundWriter(output_file)
+    try:
+        # The workers only import the modules for reading and encoding, tensorflow is not loaded in the workers
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            chunks = iter_encoded_chunks(iter_raw_chunks(job, chunk_size), executor, max_pending)
+            model = model_registry.get_model(model_name)
+            for ids, inputs in chunks:
+                num_rows = inputs["graph"].shape[0] if "graph" in inputs else None
+                if ids is not None and num_rows is not None and num_rows != len(ids):
+                    raise ValueError(f"Number of lines in {job['feature']} does not match number of sequences")
+                if ids is None:
+                    ids = [f"sequence_{i}" for i in range(num_predicted, num_predicted + num_rows)]
+
+                output.write(ids, run_ensemble.predict_model(model_name, inputs, model=model))
+                num_predicted = num_predicted + len(ids)
+                print(f"Predicted {num_predicted} sequences")
+    finally:
+        output.close()
+
+    return num_predicted
+
+########################################################################################################################
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Predict the inputs of one model in chunks while worker processes "
+                                                 "read and encode the next chunks and a separate thread writes the "
+                                                 "predictions.")
+    parser.add_argument("model", type=str.lower, choices=list(predict_ncRNAs.MODEL_INPUTS))
+    parser.add_argument("--fasta", default="", help="Fasta file (MncR, SeqEnc, optionally GrEnc)")
+    parser.add_argument("--feature", default="", help="GraphProt feature file (MncR, GrEnc)")
+    parser.add_argument("--structure", default="", help="Pysster structure file (StrEnc)")
+    parser.add_argument("--output", default="",
+                        help="Output file, by default [input_name]_[model]_prediction.txt, files ending with "
+                             ".parquet, .arrow or .feather contain the probabilities of all classes")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="Number of sequences per chunk")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Number of worker processes that encode the chunks, by default all cores but one")
+    parser.add_argument("--max-pending", type=int, default=0,
+                        help="Number of chunks that are encoded ahead of the prediction, by default two per worker")
+    parser.add_argument("--backend", default=model_registry.backend, choices=list(model_registry.BACKENDS))
+    parser.add_argument("--prediction-cache", default=prediction_cache.cache_file,
+                        help="Prediction cache file, see prediction_cache.py")
+    args = parser.parse_args()
+    model_registry.set_backend(args.backend)
+    prediction_cache.enable(args.prediction_cache)
+
+    import predict_ncRNAs
+    pipelined_job = {"model": args.model, "fasta": args.fasta, "feature": args.feature,
+                     "structure": args.structure, "output": args.output}
+    error = predict_ncRNAs.check_job(pipelined_job)
+    if error == "" and not is_supported(pipelined_job):
+        error = "ragged stores and feature stores are predicted by predict_ncRNAs.py --chunk-size"
+    if error != "":
+        parser.error(error)
+
+    pipelined_output = args.output if args.output != "" else predict_ncRNAs.default_output_file(pipelined_job)
+    try:
+        run_pipelined(pipelined_job, pipelined_output, args.chunk_size, args.workers, args.max_pending)
+    except ValueError as error:
+        print(error.args[0])
+        sys.exit(1)
+    print(f"Results are saved in {pipelined_output}")
+    model_registry.report_timings()
+    prediction_cache.report()
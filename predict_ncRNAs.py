@@ -1,9 +1,13 @@
+# model_registry is imported first, since it records the start time of the process
+import model_registry
 import os
+import sys
+import time
+import argparse
 import pandas as pd
-import run_mncr
-import run_grenc
-import run_seqenc
-import run_strenc
+import data_processing
+import prediction_output
+import prediction_cache
 pd.options.mode.chained_assignment = None  # default='warn'
 
 
@@ -13,6 +17,10 @@ def predict_ncrnas():
     # what sequences (in the form of a fasta file) they want to predict,
     # and lastly, if they chose MncR or GrEnc, they will have to provide a graph features file.
     # The model outputs will be saved in a txt file with each sequence identifier and the according probability.
+    # The run_* modules, and with them tensorflow, are only imported once the model has been chosen.
+
+    # Record the time until the user is asked for the first input
+    model_registry.timings["startup"] = time.time() - model_registry.START_TIME
 
     # The following code asks the user what model they want to use to predict
     model = "None"
@@ -88,45 +96,258 @@ def predict_ncrnas():
     print("\nPlease input the path to the file, to which you want the predictions to be written.\n"
           "If you do not want to specify a file, simply press enter: The predictions will be written to\n"
           "[input_name]_[model]_predictions.txt in the current working directory,\n"
-          "where 'input_name' is the name of the input file and model is the name of the chosen model.\n")
+          "where 'input_name' is the name of the input file and model is the name of the chosen model.\n"
+          "If the file ends with .parquet, .arrow or .feather, the probabilities of all classes are saved.\n")
     output_file = input("Enter the path to the output file or press enter\n")
 
+    # Large input files can be predicted in chunks, in which case the results are written after every chunk
+    chunk_size = "None"
+    if model.upper() in {"MNCR", "SEQENC", "STRENC"}:
+        print("\nLarge input files can be predicted in chunks of a fixed number of sequences to limit memory usage.\n"
+              "If you want to predict in chunks, enter the number of sequences per chunk.\n"
+              "If you want to predict all sequences at once, simply press enter.\n")
+        while not (chunk_size.isdigit() and int(chunk_size) > 0 or chunk_size == ""):
+            chunk_size = input("Enter the number of sequences per chunk or press enter\n")
+
+    # Run the chosen model, the results are written to the output file
+    job = {"model": model.lower(), "fasta": fasta_file_input, "feature": graph_input, "structure": struct_input,
+           "output": output_file}
+    try:
+        output_file, num_predicted = run_job(job, int(chunk_size) if chunk_size.isdigit() else 0)
+    except ValueError as error:
+        print(error.args[0])
+        sys.exit(1)
+    print(f"\nResults are saved in {output_file}")
+    model_registry.report_timings()
+    prediction_cache.report()
+
+    # Read the predicted types back from the output file
+    results = prediction_output.read_predicted_types(output_file)
+
+    return results
+
+
+def default_output_file(job):
+
+    # This function returns the standard output name [input_name]_[model]_prediction.txt of a job,
+    # where input_name is the name of the fasta input for MncR and SeqEnc, of the structure input for StrEnc
+    # and of the graph feature input for GrEnc
+
+    input_file = {"mncr": job["fasta"], "seqenc": job["fasta"],
+                  "strenc": job["structure"], "grenc": job["feature"]}[job["model"]]
+    return f"{input_file.split('.')[0]}_{job['model']}_prediction.txt"
+
+
+def run_job(job, chunk_size=0, num_workers=0):
+
+    # This function runs one prediction job and writes its results to the output file of the job
+    # A job is a dictionary with the keys "model" (mncr, strenc, seqenc or grenc), "fasta", "feature", "structure"
+    # and "output", where unused inputs and a missing output are empty strings
+    # If chunk_size is larger than 0, the inputs are predicted in chunks of that many sequences
+    # If the output file ends with .parquet, .arrow or .feather, the probabilities of all classes are written in that
+    # format (see prediction_output), in chunks of 100,000 sequences if no chunk_size is given
+    # If num_workers is larger than 0, the chunks (10,000 sequences if no chunk_size is given) are read and encoded
+    # by that many worker processes while the previous chunk is predicted (see pipeline), unless an input is a ragged
+    # store or a feature store
+    # The models are loaded through model_registry, so every model is only loaded once per process
+    # Raises a ValueError if the inputs are invalid or do not match each other
+    # Returns the path to the output file and the number of predicted sequences
+
+    model = job["model"]
+    output_file = job["output"] if job["output"] != "" else default_output_file(job)
+    if prediction_output.output_format(output_file) != "tsv" and chunk_size <= 0:
+        chunk_size = 100000
+    elif num_workers > 0 and chunk_size <= 0:
+        chunk_size = 10000
+
+    # Run the model in chunks, the results are written to the output file while predicting
+    import pipeline
+    if chunk_size > 0 and num_workers > 0 and pipeline.is_supported(job):
+        num_predicted = pipeline.run_pipelined(job, output_file, chunk_size, num_workers)
+        return output_file, num_predicted
+    elif chunk_size > 0:
+        if model == "mncr":
+            import run_mncr
+            num_predicted = run_mncr.test_mncr_streaming(job["fasta"], job["feature"], output_file, chunk_size)
+        elif model == "strenc":
+            import run_strenc
+            num_predicted = run_strenc.test_strenc_streaming(job["structure"], output_file, chunk_size)
+        elif model == "grenc":
+            import run_grenc
+            num_predicted = run_grenc.test_grenc_streaming(job["feature"], output_file, job["fasta"], chunk_size)
+        else:
+            import run_seqenc
+            num_predicted = run_seqenc.test_seqenc_streaming(job["fasta"], output_file, chunk_size)
+        return output_file, num_predicted
+
     # Run the MncR model
-    if model.upper() == "MNCR":
-        ids, results, pred_probabilities = run_mncr.test_mncr(fasta_file_input, graph_input)
-        if output_file == "":
-            output_file = f"{fasta_file_input.split('.')[0]}_mncr_prediction.txt"
+    if model == "mncr":
+        import run_mncr
+        ids, results, pred_probabilities = run_mncr.test_mncr(job["fasta"], job["feature"])
 
     # Run the GrEnc model
-    elif model.upper() == "GRENC":
-        ids, results, pred_probabilities = run_grenc.test_grenc(graph_input, fasta_file_input)
-        if output_file == "":
-            output_file = f"{graph_input.split('.')[0]}_grenc_prediction.txt"
+    elif model == "grenc":
+        import run_grenc
+        ids, results, pred_probabilities = run_grenc.test_grenc(job["feature"], job["fasta"])
 
     # Run the SeqEnc model
-    elif model.upper() == "SEQENC":
-        ids, results, pred_probabilities = run_seqenc.test_seqenc(fasta_file_input)
-        if output_file == "":
-            output_file = f"{fasta_file_input.split('.')[0]}_seqenc_prediction.txt"
+    elif model == "seqenc":
+        import run_seqenc
+        ids, results, pred_probabilities = run_seqenc.test_seqenc(job["fasta"])
 
     # Run the StrEnc model
-    elif model.upper() == "STRENC":
-        ids, results, pred_probabilities = run_strenc.test_strenc(struct_input)
-        if output_file == "":
-            output_file = f"{struct_input.split('.')[0]}_strenc_prediction.txt"
+    else:
+        import run_strenc
+        ids, results, pred_probabilities = run_strenc.test_strenc(job["structure"])
 
     # Write output to specified path
     output = open(output_file, "w")
-    for id, pred, pred_probability in zip(ids, results, pred_probabilities):
-        output.write(f"{id}\t{pred}\t{pred_probability}\n")
+    data_processing.write_predictions(output, ids, results, pred_probabilities)
     output.close()
-    print(f"\nResults are saved in {output_file}")
 
-    return results
+    return output_file, len(ids)
+
+
+def read_job_manifest(manifest_file):
+
+    # This function reads a job manifest, a tab separated file with a header line and the columns
+    # "model", "fasta", "feature", "structure" and "output", where every row is one job
+    # Columns that are not needed may be left empty or omitted
+    # Returns the jobs as list of dictionaries, see run_job
+
+    manifest = pd.read_csv(manifest_file, sep="\t", dtype=str).fillna("")
+    jobs = []
+    for row in manifest.to_dict("records"):
+        job = {key: row.get(key, "").strip() for key in ("model", "fasta", "feature", "structure", "output")}
+        job["model"] = job["model"].lower()
+        jobs.append(job)
+    return jobs
+
+
+# Inputs of the models, the fasta file of GrEnc is optional and only provides the identifiers
+MODEL_INPUTS = {"mncr": ["fasta", "feature"], "seqenc": ["fasta"], "strenc": ["structure"], "grenc": ["feature"]}
+OPTIONAL_INPUTS = {"grenc": ["fasta"]}
+
+
+def check_job(job):
+
+    # This function checks if all inputs a job needs are given and exist
+    # Returns an error message or an empty string if the job can be run
+
+    if job["model"] not in MODEL_INPUTS:
+        return f"unknown model '{job['model']}'"
+    for key in MODEL_INPUTS[job["model"]] + ([] if job["fasta"] == "" else ["fasta"]):
+        if job[key] == "":
+            return f"{job['model']} requires a {key} input"
+        if not os.path.exists(job[key]):
+            return f"could not find {job[key]}"
+    return ""
+
+
+def run_batch_jobs(jobs, chunk_size=0, num_workers=0):
+
+    # This function runs all jobs in the current process without asking for input
+    # Jobs of the same model are run one after another, so that every model is only loaded once
+    # The throughput of every job is printed and a summary is printed at the end
+    # A job that fails is reported and the remaining jobs are still run
+    # Returns the number of jobs that were skipped or failed
+
+    # Group the jobs by model while keeping the order of the jobs within each model
+    model_order = list(dict.fromkeys(job["model"] for job in jobs))
+    grouped_jobs = sorted(enumerate(jobs), key=lambda x: (model_order.index(x[1]["model"]), x[0]))
+
+    num_failed = 0
+    total_predicted = 0
+    total_start_time = time.time()
+    for i, job in grouped_jobs:
+        error = check_job(job)
+        if error != "":
+            print(f"Job {i + 1} skipped: {error}")
+            num_failed = num_failed + 1
+            continue
+
+        start_time = time.time()
+        try:
+            output_file, num_predicted = run_job(job, chunk_size, num_workers)
+        except Exception as error:
+            print(f"Job {i + 1} ({job['model']}) failed: {error}")
+            num_failed = num_failed + 1
+            continue
+        seconds = time.time() - start_time
+        total_predicted = total_predicted + num_predicted
+        print(f"Job {i + 1} ({job['model']}): {num_predicted} sequences in {seconds:.2f}s "
+              f"({num_predicted / max(seconds, 1e-9):.1f} sequences/s), results are saved in {output_file}")
+
+    total_seconds = time.time() - total_start_time
+    print(f"\nFinished {len(jobs) - num_failed} of {len(jobs)} jobs: {total_predicted} sequences in "
+          f"{total_seconds:.2f}s ({total_predicted / max(total_seconds, 1e-9):.1f} sequences/s)")
+    model_registry.report_timings()
+    prediction_cache.report()
+
+    return num_failed
 
 
 if __name__ == '__main__':
 
+    # With run parameters, the jobs are run without asking for input
+    if len(sys.argv) > 1:
+        parser = argparse.ArgumentParser(description="Predict ncRNA classes without interactive prompts. "
+                                                     "Either provide one job with --model and its inputs "
+                                                     "or a job manifest with one job per row.")
+        parser.add_argument("--manifest", default="",
+                            help="Tab separated file with a header line and the columns model, fasta, feature, "
+                                 "structure and output")
+        parser.add_argument("--model", default="", type=str.lower, choices=["mncr", "strenc", "seqenc", "grenc"])
+        parser.add_argument("--fasta", nargs="*", default=[],
+                            help="Fasta file(s), one job is run per fasta file for MncR and SeqEnc")
+        parser.add_argument("--feature", nargs="*", default=[],
+                            help="Graph feature file(s) in the same order as the fasta files")
+        parser.add_argument("--structure", nargs="*", default=[], help="Pysster structure file(s) for StrEnc")
+        parser.add_argument("--output", nargs="*", default=[],
+                            help="Output file(s) in the same order as the inputs, "
+                                 "by default [input_name]_[model]_prediction.txt, files ending with .parquet, "
+                                 ".arrow or .feather contain the probabilities of all classes")
+        parser.add_argument("--chunk-size", type=int, default=0,
+                            help="Predict the inputs in chunks of that many sequences")
+        parser.add_argument("--pipeline-workers", type=int, default=0,
+                            help="Read and encode the next chunks in that many worker processes while the current "
+                                 "chunk is predicted (see pipeline.py)")
+        parser.add_argument("--backend", default=model_registry.backend, choices=list(model_registry.BACKENDS),
+                            help="Run the models with keras or with the TFLite files exported by model_export.py")
+        parser.add_argument("--memory-budget", default=model_registry.memory_budget,
+                            help="Choose the batch size and threads of the models so that the process stays below "
+                                 "this memory, e.g. 16G (see autotune.py)")
+        parser.add_argument("--prediction-cache", default=prediction_cache.cache_file,
+                            help="Take the predictions of inputs that were predicted before from this cache file and "
+                                 "add all new predictions to it, 'default' uses "
+                                 "~/.cache/ncrna_classifier/prediction_cache.sqlite")
+        args = parser.parse_args()
+        model_registry.set_backend(args.backend)
+        prediction_cache.enable(args.prediction_cache)
+        try:
+            model_registry.set_memory_budget(args.memory_budget)
+        except ValueError as error:
+            parser.error(error.args[0])
+
+        if args.manifest != "":
+            batch_jobs = read_job_manifest(args.manifest)
+        elif args.model != "":
+            # One job per input file of the main input of the model
+            main_input = {"mncr": args.fasta, "seqenc": args.fasta,
+                          "strenc": args.structure, "grenc": args.feature}[args.model]
+            batch_jobs = []
+            for n in range(len(main_input)):
+                batch_jobs.append({"model": args.model,
+                                   "fasta": args.fasta[n] if n < len(args.fasta) else "",
+                                   "feature": args.feature[n] if n < len(args.feature) else "",
+                                   "structure": args.structure[n] if n < len(args.structure) else "",
+                                   "output": args.output[n] if n < len(args.output) else ""})
+        else:
+            parser.error("Please provide either --manifest or --model")
+
+        num_failed_jobs = run_batch_jobs(batch_jobs, args.chunk_size, args.pipeline_workers)
+        sys.exit(1 if num_failed_jobs > 0 else 0)
+
     print("\nWelcome to ncRNA classification\n"
           "Which model would you like to use to predict ncRNA sequences?\n\n"
           "MncR\nInputs: Graph Features file created using GraphProt and Fasta file\n"
@@ -0,0 +1,238 @@
+import os
+import sys
+import hashlib
+import threading
+import numpy as np
+import model_registry
+import sequence_cache
+import instrumentation
+
+# This module avoids predicting the same input more than once
+# Every encoded input of a model (padded sequence, structure, graph feature vector or both for MncR) is hashed
+# Inputs that occur several times in a run are predicted once and the prediction is copied to all of their identifiers
+# With a prediction cache, the softmax outputs are also stored on disk in a sequence_cache.SequenceCache, keyed by the
+# checksum of the model file and the hash of the input, so inputs that were predicted by earlier runs are not
+# predicted again and a changed model never returns outdated predictions
+# The cache is disabled by default, set the environment variable NCRNA_PREDICTION_CACHE to a cache file
+# (or "default" for ~/.cache/ncrna_classifier/prediction_cache.sqlite) or use enable
+
+DEFAULT_CACHE_FILE = os.path.expanduser("~/.cache/ncrna_classifier/prediction_cache.sqlite")
+
+# Number of rows of a graph feature matrix that are hashed at once
+GRAPH_CHUNK_SIZE = 10000
+
+cache_file = ""
+cache_max_bytes = sequence_cache.DEFAULT_MAX_BYTES
+# sqlite connections cannot be shared by threads, so every thread opens the cache itself
+local = threading.local()
+
+# Checksums of the model files, computed once per process
+checksums = {}
+# Number of predicted inputs, unique inputs and cache hits per model, see report
+statistics = {}
+lock = threading.Lock()
+
+########################################################################################################################
+
+
+def enable(file=DEFAULT_CACHE_FILE, max_bytes=sequence_cache.DEFAULT_MAX_BYTES):
+
+    # This function stores all predictions in the cache file and takes predictions from it
+    # The least recently used predictions are evicted when the cache exceeds max_bytes
+
+    global cache_file, cache_max_bytes
+    cache_file = file if file != "default" else DEFAULT_CACHE_FILE
+    cache_max_bytes = max_bytes
+
+########################################################################################################################
+
+
+def get_cache():
+
+    # This function returns the cache of the current thread, or None if the cache is disabled
+
+    if cache_file == "":
+        return None
+    if getattr(local, "cache_file", None) != cache_file:
+        local.cache = sequence_cache.SequenceCache(cache_file, cache_max_bytes)
+        local.cache_file = cache_file
+    return local.cache
+
+########################################################################################################################
+
+
+def model_file(model_name, model):
+
+    # This function returns the file a model was loaded from, so predictions are only shared by the same model file
+    # TFLite models are identified by their TFLite file and the keras model of model_registry by its hdf5 file (or the
+    # converted weights without it), returns None for all other models, whose predictions are not cached
+
+    if isinstance(model, model_registry.TFLiteModel):
+        return model.tflite_file
+    if model is not model_registry.models.get(model_name):
+        return None
+    if not os.path.isfile(model_registry.MODEL_FILES[model_name]):
+        return model_registry.converted_model_files(model_name)[1]
+    return model_registry.MODEL_FILES[model_name]
+
+########################################################################################################################
+
+
+def model_checksum(model_file_name):
+
+    # This function returns the sha256 checksum of a model file (see model_file)
+    # The converted files of model_registry.convert_model are created from the hdf5 file, so its checksum covers them
+
+    with lock:
+        if model_file_name not in checksums:
+            checksum = hashlib.sha256()
+            with open(model_file_name, "rb") as file:
+                for block in iter(lambda: file.read(1024 ** 2), b""):
+                    checksum.update(block)
+            checksums[model_file_name] = checksum.hexdigest()
+        return checksums[model_file_name]
+
+########################################################################################################################
+
+
+def ragged_digests(buffer, offsets):
+
+    # This function returns a digest of every encoded sequence of a ragged representation (see
+    # data_processing.encode_ragged), which are already cut to the length the models use
+
+    data = memoryview(buffer)
+    return [hashlib.blake2b(data[start:stop], digest_size=16).digest()
+            for start, stop in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+########################################################################################################################
+
+
+def graph_digests(graph_matrix):
+
+    # This function returns a digest of every row of a sparse graph feature matrix or a feature store
+
+    digests = []
+    for start in range(0, graph_matrix.shape[0], GRAPH_CHUNK_SIZE):
+        chunk = graph_matrix[start:start + GRAPH_CHUNK_SIZE].sorted_indices()
+        indices = chunk.indices.astype(np.int32, copy=False).tobytes()
+        data = chunk.data.astype(np.float32, copy=False).tobytes()
+        indptr = chunk.indptr.tolist()
+        digests.extend(hashlib.blake2b(indices[4 * first:4 * last] + b"\0" + data[4 * first:4 * last],
+                                       digest_size=16).digest()
+                       for first, last in zip(indptr[:-1], indptr[1:]))
+    return digests
+
+########################################################################################################################
+
+
+def ragged_rows(buffer, offsets, rows):
+
+    # This function returns the ragged representation of the given rows, which are in ascending order
+
+    if len(rows) == len(offsets) - 1:
+        return buffer, offsets
+    lengths = offsets[rows + 1] - offsets[rows]
+    new_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    new_offsets[1:] = np.cumsum(lengths)
+    # Position of every byte of the selected rows in the old buffer
+    positions = np.repeat(offsets[rows] - new_offsets[:-1], lengths) + np.arange(new_offsets[-1])
+    return buffer[positions], new_offsets
+
+########################################################################################################################
+
+
+def graph_rows(graph_matrix, rows):
+
+    # This function returns the given rows of a sparse graph feature matrix or a feature store
+
+    if len(rows) == graph_matrix.shape[0]:
+        return graph_matrix
+    if hasattr(graph_matrix, "rows"):
+        return graph_matrix.rows(rows)
+    return graph_matrix[rows]
+
+########################################################################################################################
+
+
+def predict_unique(model_name, digests, predict_rows, model):
+
+    # This function predicts every distinct input once and returns the softmax outputs of all inputs
+    # digests contains one digest per input (see ragged_digests and graph_digests) and predict_rows(rows) has to
+    # return the softmax outputs of the inputs at the given positions
+    # With a prediction cache, inputs that are in the cache are not predicted and all others are added to it, the
+    # cache is keyed on the file of the predicting model (see model_file)
+
+    with instrumentation.stage("deduplicate inputs", len(digests)):
+        # Position of every distinct input in unique_digests and its first occurrence
+        unique_digests = {}
+        first_rows = []
+        inverse = []
+        for row, digest in enumerate(digests):
+            index = unique_digests.get(digest)
+            if index is None:
+                index = unique_digests[digest] = len(first_rows)
+                first_rows.append(row)
+            inverse.append(index)
+        first_rows = np.array(first_rows, dtype=np.int64)
+        predictions = np.zeros((len(first_rows), len(model_registry.RNA_TYPES)), dtype=np.float32)
+        is_missing = np.ones(len(first_rows), dtype=bool)
+
+        cache = get_cache()
+        model_file_name = model_file(model_name, model) if cache is not None else None
+        if model_file_name is None:
+            cache = None
+        else:
+            checksum = model_checksum(model_file_name)
+            keys = [f"{model_name} {checksum} {digest.hex()}" for digest in unique_digests]
+            cached = cache.get_many(keys)
+            for i, key in enumerate(keys):
+                if key in cached:
+                    predictions[i] = np.frombuffer(cached[key], dtype=np.float32)
+                    is_missing[i] = False
+
+    # The distinct inputs are predicted in the order of their first occurrence
+    missing = np.flatnonzero(is_missing)
+    if len(missing) > 0:
+        predictions[missing] = predict_rows(first_rows[missing])
+        if cache is not None:
+            cache.put_many({keys[i]: predictions[i].tobytes() for i in missing.tolist()})
+
+    with lock:
+        record = statistics.setdefault(model_name, {"inputs": 0, "unique": 0, "cache_hits": 0})
+        record["inputs"] = record["inputs"] + len(digests)
+        record["unique"] = record["unique"] + len(unique_digests)
+        record["cache_hits"] = record["cache_hits"] + len(unique_digests) - len(missing)
+
+    return predictions[np.array(inverse, dtype=np.int64)]
+
+########################################################################################################################
+
+
+def report():
+
+    # This function prints how many inputs of every model were duplicates, taken from the cache and predicted
+
+    for model_name, record in statistics.items():
+        hit_rate = record["cache_hits"] / record["unique"] if record["unique"] > 0 else 0
+        cache_hits = f"{record['cache_hits']} from the prediction cache ({hit_rate:.1%} hit rate), " \
+            if cache_file != "" else ""
+        print(f"{model_name}: {record['inputs']} inputs, {record['inputs'] - record['unique']} duplicates, "
+              f"{cache_hits}{record['unique'] - record['cache_hits']} predicted")
+    if get_cache() is not None and len(statistics) > 0:
+        # The hits above are counted over all threads, the cache of this thread only counts its own
+        stats = get_cache().stats()
+        print(f"Prediction cache: {stats['entries']} entries with {stats['bytes'] / 1024 ** 2:.1f} MB in {cache_file}")
+
+########################################################################################################################
+
+
+if os.environ.get("NCRNA_PREDICTION_CACHE", "") != "":
+    enable(os.environ["NCRNA_PREDICTION_CACHE"])
+
+if __name__ == '__main__':
+    # Print the statistics of a prediction cache
+    cache = sequence_cache.SequenceCache(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_CACHE_FILE)
+    for name, value in cache.stats().items():
+        if name not in ("hits", "misses"):
+            print(f"{name}: {value}")
+    cache.close()
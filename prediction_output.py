@@ -0,0 +1,180 @@
+import os
+import shutil
+import numpy as np
+import model_registry
+import data_processing
+
+# This module writes the predictions of the models batch by batch while they are predicted
+# By default, every prediction is written as a line "id\tclass\tprobability" of a text file, which only contains
+# the probability of the predicted class
+# If the output file ends with .parquet, .arrow or .feather, the predictions are written in a columnar format with the
+# columns id, prediction (the predicted class), probability (the probability of the predicted class) and the
+# probabilities of all six classes (lncRNA, miRNA, rRNA, snRNA, snoRNA, tRNA), which can be read quickly,
+# e.g. with pandas.read_parquet or pandas.read_feather
+# The columnar formats require pyarrow (pip install pyarrow)
+
+# File extensions of the columnar formats
+COLUMNAR_FORMATS = {".parquet": "parquet", ".arrow": "arrow", ".feather": "arrow"}
+
+########################################################################################################################
+
+
+def output_format(output_file):
+
+    # This function returns the format of an output file by its extension: "parquet", "arrow" or "tsv"
+
+    return COLUMNAR_FORMATS.get(os.path.splitext(output_file)[1].lower(), "tsv")
+
+########################################################################################################################
+
+
+def import_pyarrow():
+
+    # This function imports pyarrow, which is only needed for the columnar formats
+
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        import pyarrow.ipc
+    except ImportError:
+        raise ImportError("Writing parquet or arrow files requires pyarrow, please install it with "
+                          "'pip install pyarrow' or use an output file ending with .txt")
+    return pyarrow
+
+########################################################################################################################
+
+
+class TextWriter:
+
+    # Writes the predictions as lines "id\tclass\tprobability", the output of the standalone scripts
+
+    def __init__(self, output_file):
+        self.output = open(output_file, "w")
+
+    def write(self, ids, prediction):
+
+        # Writes the identifiers and the softmax outputs of one batch, the file is flushed after every batch
+
+        results, pred_probabilities = model_registry.decode_predictions(prediction)
+        data_processing.write_predictions(self.output, ids, results, pred_probabilities)
+        self.output.flush()
+
+    def close(self):
+        self.output.close()
+
+########################################################################################################################
+
+
+class ColumnarWriter:
+
+    # Writes the predictions with the probabilities of all classes into a parquet file (one row group per batch)
+    # or an arrow file (one record batch per batch)
+    # The predicted classes are stored dictionary encoded, so they need one byte per sequence
+
+    def __init__(self, output_file, file_format):
+        pa = import_pyarrow()
+        self.pa = pa
+        self.classes = pa.array(model_registry.RNA_TYPES, type=pa.string())
+        self.schema = pa.schema([("id", pa.string()), ("prediction", pa.dictionary(pa.int8(), pa.string())),
+                                 ("probability", pa.float32())] +
+                                [(rna_type, pa.float32()) for rna_type in model_registry.RNA_TYPES])
+        if file_format == "parquet":
+            self.writer = pa.parquet.ParquetWriter(output_file, self.schema)
+        else:
+            self.writer = pa.ipc.new_file(output_file, self.schema)
+
+    def write(self, ids, prediction):
+
+        # Writes the identifiers and the softmax outputs of one batch
+
+        prediction = np.asarray(prediction, dtype=np.float32).reshape(-1, len(model_registry.RNA_TYPES))
+        predicted = prediction.argmax(axis=1).astype(np.int8)
+        columns = [self.pa.array([str(seq_id) for seq_id in ids], type=self.pa.string()),
+                   self.pa.DictionaryArray.from_arrays(self.pa.array(predicted), self.classes),
+                   self.pa.array(prediction[np.arange(len(prediction)), predicted])]
+        columns.extend(self.pa.array(prediction[:, i]) for i in range(prediction.shape[1]))
+        self.writer.write_batch(self.pa.record_batch(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+########################################################################################################################
+
+
+def open_writer(output_file):
+
+    # This function opens a writer for the format of the output file (see output_format)
+    # Predictions are written with writer.write(ids, prediction), where prediction are the softmax outputs of a model,
+    # and the file is completed with writer.close()
+
+    file_format = output_format(output_file)
+    if file_format == "tsv":
+        return TextWriter(output_file)
+    return ColumnarWriter(output_file, file_format)
+
+########################################################################################################################
+
+
+def write_dataframe(df, output_file):
+
+    # This function writes a dataframe with the sequence identifiers as index into a parquet or arrow file
+
+    import_pyarrow()
+    if output_format(output_file) == "parquet":
+        df.reset_index().to_parquet(output_file, index=False)
+    else:
+        df.reset_index().to_feather(output_file)
+
+########################################################################################################################
+
+
+def read_predicted_types(output_file):
+
+    # This function reads the predicted classes of an output file in any of the formats
+
+    if output_format(output_file) == "tsv":
+        with open(output_file, "r") as output:
+            return [line.split("\t")[1] for line in output]
+
+    import pandas as pd
+    import_pyarrow()
+    if output_format(output_file) == "parquet":
+        df = pd.read_parquet(output_file, columns=["prediction"])
+    else:
+        df = pd.read_feather(output_file, columns=["prediction"])
+    return df["prediction"].astype(str).tolist()
+
+########################################################################################################################
+
+
+def merge_files(files, output_file):
+
+    # This function concatenates output files of the same format as output_file in the given order into output_file
+    # Text files are copied byte by byte and the record batches of parquet and arrow files are copied one by one
+    # The merged file is written under a temporary name and renamed once it is complete
+
+    file_format = output_format(output_file)
+    temporary_file = f"{output_file}.{os.getpid()}.tmp{os.path.splitext(output_file)[1]}"
+    if file_format == "tsv":
+        with open(temporary_file, "wb") as output:
+            for file in files:
+                with open(file, "rb") as shard:
+                    shutil.copyfileobj(shard, output)
+    else:
+        pa = import_pyarrow()
+        writer = None
+        for file in files:
+            if file_format == "parquet":
+                batches = pa.parquet.ParquetFile(file).iter_batches()
+            else:
+                reader = pa.ipc.open_file(pa.memory_map(file, "r"))
+                batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+            for batch in batches:
+                if writer is None:
+                    writer = pa.parquet.ParquetWriter(temporary_file, batch.schema) if file_format == "parquet" \
+                        else pa.ipc.new_file(temporary_file, batch.schema)
+                writer.write_batch(batch)
+        # Without any predictions, an empty file with the usual columns is written
+        writer = writer if writer is not None else open_writer(temporary_file)
+        writer.close()
+    os.replace(temporary_file, output_file)
@@ -0,0 +1,179 @@
+import model_registry
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import numpy as np
+import data_processing
+import prediction_output
+import prediction_cache
+
+pd.options.mode.chained_assignment = None  # default='warn'
+
+# Inputs needed by every model
+MODEL_INPUTS = {"mncr": ["fasta", "feature"], "seqenc": ["fasta"], "strenc": ["structure"], "grenc": ["feature"]}
+
+
+def read_inputs(fasta_file_input="", graph_input="", structure_input=""):
+
+    # This method reads and encodes every given input exactly once
+    # fasta_file_input is a fasta file or a ragged store, graph_input a graphprot feature file or a feature store
+    # and structure_input a pysster structure file, every input may be an empty string
+    # All inputs have to describe the same sequences in the same order, the identifiers are taken from the fasta file,
+    # the structure file or the fasta file used for the creation of the feature store, in this order
+    # Returns the identifiers and a dictionary with the encoded inputs "sequences" (ragged buffer and offsets),
+    # "graph" (sparse matrix or feature store) and "structures" (ragged buffer and offsets)
+
+    ids = None
+    inputs = {}
+    if fasta_file_input != "":
+        ids, buffer, offsets = data_processing.read_encoded_sequences(fasta_file_input, 12000)
+        inputs["sequences"] = (buffer, offsets)
+
+    if structure_input != "":
+        structure_ids = []
+        buffers = [np.zeros(0, dtype=np.uint8)]
+        offsets_list = [np.zeros(1, dtype=np.int64)]
+        for chunk_ids, structures in data_processing.read_pysster_chunks(structure_input, 10000):
+            if None in structures:
+                raise ValueError(f"{structure_input} contains invalid records")
+            buffer, offsets = data_processing.encode_ragged(structures, data_processing.STRUCTURE_TABLE, 12000)
+            structure_ids.extend(chunk_ids)
+            buffers.append(buffer)
+            offsets_list.append(offsets[1:] + offsets_list[-1][-1])
+        if ids is not None and list(ids) != structure_ids:
+            raise ValueError(f"The identifiers in {structure_input} do not match the sequences in {fasta_file_input}")
+        ids = structure_ids if ids is None else ids
+        inputs["structures"] = (np.concatenate(buffers), np.concatenate(offsets_list))
+
+    if graph_input != "":
+        # A feature store with identifiers returns the rows of the sequences read above
+        graph_matrix = data_processing.read_graph_features(graph_input, ids)
+        if ids is None:
+            ids = graph_matrix.get_ids() if isinstance(graph_matrix, data_processing.FeatureStore) else \
+                [f"sequence_{i}" for i in range(graph_matrix.shape[0])]
+        if graph_matrix.shape[0] != len(ids):
+            raise ValueError(f"Number of lines in {graph_input} does not match number of sequences")
+        inputs["graph"] = graph_matrix
+
+    return ids, inputs
+
+
+def predict_model(model_name, inputs, batch_size=None, model=None):
+
+    # This method predicts the encoded inputs (see read_inputs) with one model and returns its softmax outputs
+    # By default, the model and its batch size are taken from model_registry
+
+    if model is None:
+        model = model_registry.get_model(model_name)
+    if batch_size is None:
+        batch_size = model_registry.get_batch_size(model_name)
+    if model_name == "mncr":
+        import run_mncr
+        return run_mncr.predict_batches(model, *inputs["sequences"], inputs["graph"], batch_size)
+    elif model_name == "seqenc":
+        import run_seqenc
+        return run_seqenc.predict_batches(model, *inputs["sequences"], batch_size)
+    elif model_name == "strenc":
+        import run_strenc
+        return run_strenc.predict_batches(model, *inputs["structures"], batch_size)
+    else:
+        import run_grenc
+        return run_grenc.predict_batches(model, inputs["graph"], batch_size)
+
+
+def test_ensemble(fasta_file_input="", graph_input="", structure_input="", model_names=None, num_threads=0):
+
+    # This method predicts the given inputs with all models that can be applied to them, or with model_names
+    # Every input is read and encoded once and shared by all models, which are run concurrently in a thread pool
+    # (by default one thread per model), so the prediction takes about as long as the slowest model
+    # Returns the identifiers and a dictionary with the softmax outputs of every model
+
+    given_inputs = {"fasta": fasta_file_input, "feature": graph_input, "structure": structure_input}
+    if model_names is None:
+        model_names = [model_name for model_name, required in MODEL_INPUTS.items()
+                       if all(given_inputs[key] != "" for key in required)]
+    for model_name in model_names:
+        missing = [key for key in MODEL_INPUTS[model_name] if given_inputs[key] == ""]
+        if len(missing) > 0:
+            raise ValueError(f"{model_name} requires a {' and a '.join(missing)} input")
+
+    ids, inputs = read_inputs(fasta_file_input, graph_input, structure_input)
+
+    # Load the models one after another before the predictions start
+    # With a memory budget, the batch sizes are chosen so that the batches of all models fit into it at the same time
+    if model_registry.memory_budget != "":
+        model_registry.set_memory_budget(model_registry.memory_budget,
+                                         min(len(model_names), num_threads if num_threads > 0 else len(model_names)))
+    for model_name in model_names:
+        model_registry.get_model(model_name)
+
+    with ThreadPoolExecutor(max_workers=num_threads if num_threads > 0 else max(1, len(model_names))) as executor:
+        futures = {model_name: executor.submit(predict_model, model_name, inputs) for model_name in model_names}
+        predictions = {model_name: future.result() for model_name, future in futures.items()}
+
+    return ids, predictions
+
+
+def write_ensemble_predictions(output_file, ids, predictions):
+
+    # This method writes the predictions of all models side by side into one tab separated file with a header line
+    # For every model, the predicted ncRNA type and the probabilities of all six ncRNA types are written
+    # If the output file ends with .parquet, .arrow or .feather, the columns are written in that format instead
+
+    columns = {}
+    for model_name, prediction in predictions.items():
+        results, pred_probabilities = model_registry.decode_predictions(prediction)
+        columns[f"{model_name}_prediction"] = results
+        for i, rna_type in enumerate(model_registry.RNA_TYPES):
+            columns[f"{model_name}_{rna_type}"] = prediction[:, i]
+    output_df = pd.DataFrame(columns, index=pd.Index(ids, name="id"))
+    if prediction_output.output_format(output_file) != "tsv":
+        prediction_output.write_dataframe(output_df, output_file)
+    else:
+        output_df.to_csv(output_file, sep="\t")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Predict ncRNA classes with several models at once. Every input is "
+                                                 "read once and all models that can be applied to the given inputs "
+                                                 "are run concurrently.")
+    parser.add_argument("--fasta", default="", help="Fasta file or ragged store (MncR, SeqEnc)")
+    parser.add_argument("--feature", default="", help="GraphProt feature file or feature store (MncR, GrEnc)")
+    parser.add_argument("--structure", default="", help="Pysster structure file (StrEnc)")
+    parser.add_argument("--models", nargs="*", choices=list(MODEL_INPUTS),
+                        help="Models to run, by default all models whose inputs are given")
+    parser.add_argument("--output", default="",
+                        help="Output file, by default [input name]_ensemble_predictions.txt")
+    parser.add_argument("--threads", type=int, default=0, help="Number of models predicted at the same time")
+    parser.add_argument("--memory-budget", default=model_registry.memory_budget,
+                        help="Choose the batch sizes and threads of the models so that the process stays below "
+                             "this memory, e.g. 16G (see autotune.py)")
+    parser.add_argument("--prediction-cache", default=prediction_cache.cache_file,
+                        help="Take the predictions of inputs that were predicted before from this cache file and add "
+                             "all new predictions to it, 'default' uses "
+                             "~/.cache/ncrna_classifier/prediction_cache.sqlite")
+    args = parser.parse_args()
+    prediction_cache.enable(args.prediction_cache)
+    try:
+        model_registry.set_memory_budget(args.memory_budget)
+    except ValueError as error:
+        parser.error(error.args[0])
+
+    first_input = args.fasta or args.structure or args.feature
+    if first_input == "":
+        parser.error("Please provide at least one input")
+    output_file = args.output if args.output != "" else f"{first_input.split('.')[0]}_ensemble_predictions.txt"
+
+    start_time = time.time()
+    try:
+        ids, predictions = test_ensemble(args.fasta, args.feature, args.structure, args.models, args.threads)
+    except (ValueError, KeyError) as error:
+        print(error.args[0])
+        sys.exit(1)
+    write_ensemble_predictions(output_file, ids, predictions)
+    print(f"Predicted {len(ids)} sequences with {', '.join(predictions)} in {time.time() - start_time:.2f}s, "
+          f"results are saved in {output_file}")
+    model_registry.report_timings()
+    prediction_cache.report()
@@ -1,67 +1,152 @@
-import os
 import data_processing
+import model_registry
+import instrumentation
+import prediction_output
+import prediction_cache
 import sys
 import pandas as pd
 import numpy as np
-os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
-import keras as ks
-from sklearn.preprocessing import OneHotEncoder
 
 pd.options.mode.chained_assignment = None  # default='warn'
 
 
+def predict_batch(model, graph_batch):
+
+    # This method predicts one dense or sparse batch of graph feature vectors
+
+    with instrumentation.stage("predict grenc", graph_batch.shape[0]):
+        return model.predict(graph_batch, verbose=0, batch_size=model_registry.get_predict_batch_size("grenc"))
+
+
+def predict_batches(model, graph_matrix, batch_size=None):
+
+    # This method predicts a sparse graph feature matrix or a feature store batch by batch
+    # Only the current batch of feature vectors is stored as dense matrix, if it cannot be predicted as sparse matrix
+    # Identical feature vectors are only predicted once and, with a prediction cache, feature vectors that were
+    # predicted by earlier runs are not predicted at all (see prediction_cache)
+    # By default, the batch size of model_registry is used, which is chosen for the memory budget if one is set
+    # Batches chosen for the memory budget are predicted in one call of the model, see get_predict_batch_size
+
+    if batch_size is None:
+        batch_size = model_registry.get_batch_size("grenc")
+
+    # With the keras backend, the first layer is computed from the sparse feature vectors, which is faster and
+    # needs less memory than the dense feature vectors (see model_registry.get_sparse_model)
+    sparse_model = model_registry.get_sparse_model(model)
+    if sparse_model is not None:
+        batch_model, iter_batches = sparse_model, data_processing.iter_sparse_batches
+    else:
+        batch_model, iter_batches = model, data_processing.iter_dense_batches
+
+    def predict_rows(rows):
+        prediction = [predict_batch(batch_model, graph_batch) for graph_batch in
+                      iter_batches(prediction_cache.graph_rows(graph_matrix, rows), batch_size)]
+        return np.concatenate(prediction) if len(prediction) > 0 else np.zeros((0, 6), dtype=np.float32)
+
+    return prediction_cache.predict_unique("grenc", prediction_cache.graph_digests(graph_matrix), predict_rows, model)
+
+
 def test_grenc(graph_input, fasta_file_input=""):
 
     # This method loads the trained GrEnc model and tests it on graph features
     # sequence_df is a dataframe that has the sequence IDs as row names and at least one column named "Seq"
     # in which Sequences are stored as uppercase Strings including only IUPAC codes for nucleotides
     # graph_input is the path to the file in which the corresponding graph features are saved
+    # or a feature store created by data_processing.write_feature_store
     # These graph features must match the sequences in sequence_df
+    # If the feature store contains sequence identifiers, only the sequences of the fasta file are predicted,
+    # which may be any subset of the stored sequences
+
+    if data_processing.is_feature_store(graph_input):
+        # The feature store is memory mapped, only the rows that are predicted are read from disk
+        graph_matrix = data_processing.FeatureStore(graph_input)
+        ids = graph_matrix.get_ids()
+    else:
+        # Read the graph feature vectors into a sparse matrix with one row per line of the feature file
+        graph_matrix = data_processing.read_graphprot_matrix(graph_input)
+        ids = [f"sequence_{i}" for i in range(graph_matrix.shape[0])]
 
     if fasta_file_input != "":
         sequence_df = data_processing.read_fasta_file(fasta_file_input)
-        if not data_processing.test_graphfeat_seq_match(sequence_df, graph_input):
-            sys.exit()
-            # Read graph feature vector into the dataframe in a new column called "feature_vector"
-        sequence_df.drop(["Seq"], axis=1, inplace=True)
-        sequence_df = data_processing.read_graphprot_vectors(sequence_df, graph_input)
-    else:
-        i = 0
-        index_list = []
-        for line in open(graph_input):
-            index_list.append(f"sequence_{i}")
-            i = i+1
-        sequence_df = pd.DataFrame.from_dict({"id": index_list})
-        sequence_df.index = index_list
-        sequence_df = data_processing.read_graphprot_vectors(sequence_df,
-                                                             graph_input)
-
-    graph_matrix = np.array(sequence_df.feature_vectors.to_list()).reshape(len(sequence_df.feature_vectors),
-                                                                           len(sequence_df.feature_vectors[0]))
-    # Drop "Seq" and "feature_vector" from data frame to save on memory
-    sequence_df.drop(["feature_vectors"], axis=1, inplace=True)
-
-    # Create a one hot encoder with the 6 possible RNA types to return the output as plain text
-    rna_types = ["lncRNA", "miRNA", "rRNA", "snRNA", "snoRNA", "tRNA"]
-    ohe = OneHotEncoder(sparse_output=False)
-    ohe.fit(np.array(rna_types).reshape(-1, 1))
-
-    # Load the model
-    model = ks.models.load_model("model_files/grenc_fold2.hdf5")
-
-    # Predict the ncRNA types from the two inputs
-    prediction = model.predict(graph_matrix)
-    # Return probability for each prediction
-    pred_probabilities = [np.max(x) for x in prediction]
-    # Convert results to ncRNA types
-    results = ohe.inverse_transform(prediction)
-    results = [x[0] for x in results]
-
-    ids = sequence_df.index
+        if isinstance(graph_matrix, data_processing.FeatureStore) and graph_matrix.has_ids:
+            # Only the sequences of the fasta file are predicted, in the order of the fasta file
+            try:
+                graph_matrix = graph_matrix.rows_by_id(sequence_df.index)
+            except KeyError as error:
+                raise ValueError(error.args[0])
+        elif graph_matrix.shape[0] != len(sequence_df):
+            raise ValueError(f"Number of lines in {graph_input} does not match number of sequences")
+        ids = sequence_df.index
+
+    # Load the model, it is only loaded once per process
+    model = model_registry.get_model("grenc")
+
+    # Predict the ncRNA types batch by batch, only the current batch of feature vectors is stored as dense matrix
+    prediction = predict_batches(model, graph_matrix)
+    # Convert results to ncRNA types and return probability for each prediction
+    results, pred_probabilities = model_registry.decode_predictions(prediction)
 
     return ids, results, pred_probabilities
 
 
+def test_grenc_streaming(graph_input, output_file, fasta_file_input="", chunk_size=10000):
+
+    # This method predicts the graph feature vectors in chunks of chunk_size vectors
+    # Every chunk is predicted on its own and its results are appended to output_file before the next chunk is read,
+    # so the memory usage depends on chunk_size and not on the size of the input
+    # If a fasta file is given, its identifiers are read chunk by chunk as well, otherwise the identifiers are taken
+    # from the feature store or are 'sequence_n'
+    # output_file is a text file or, with the probabilities of all classes, a parquet or arrow file,
+    # see prediction_output
+    # Returns the number of predicted sequences
+
+    # Load the model, it is only loaded once per process
+    model = model_registry.get_model("grenc")
+
+    store = data_processing.FeatureStore(graph_input) if data_processing.is_feature_store(graph_input) else None
+    if fasta_file_input != "":
+        sequence_chunks = (list(sequence_df.index)
+                           for sequence_df in data_processing.read_fasta_chunks(fasta_file_input, chunk_size))
+    elif store is not None:
+        sequence_chunks = store.iter_ids(chunk_size)
+    else:
+        sequence_chunks = None
+    graph_chunks = data_processing.read_graphprot_chunks(graph_input, chunk_size) if store is None else None
+
+    num_predicted = 0
+    output = prediction_output.open_writer(output_file)
+    while True:
+        ids = next(sequence_chunks, None) if sequence_chunks is not None else None
+        if store is not None and store.has_ids and fasta_file_input != "":
+            # Only the sequences of the fasta file are predicted, in the order of the fasta file
+            try:
+                graph_matrix = store.rows_by_id(ids) if ids is not None else None
+            except KeyError as error:
+                output.close()
+                raise ValueError(error.args[0])
+        elif store is not None:
+            graph_matrix = store[num_predicted:num_predicted + chunk_size] if num_predicted < store.shape[0] else None
+        else:
+            graph_matrix = next(graph_chunks, None)
+        if ids is None and graph_matrix is None:
+            break
+        if sequence_chunks is not None and (ids is None or graph_matrix is None or graph_matrix.shape[0] != len(ids)):
+            output.close()
+            raise ValueError(f"Number of lines in {graph_input} does not match number of sequences")
+        if ids is None:
+            ids = [f"sequence_{i}" for i in range(num_predicted, num_predicted + graph_matrix.shape[0])]
+
+        prediction = predict_batches(model, graph_matrix)
+
+        # Append the results of the chunk to the output file
+        output.write(ids, prediction)
+        num_predicted = num_predicted + len(ids)
+        print(f"Predicted {num_predicted} sequences")
+    output.close()
+
+    return num_predicted
+
+
 if __name__ == '__main__':
     # Exception for when the command is not properly executed with fasta and feature file
     if len(sys.argv) not in (2, 3):
@@ -84,7 +169,11 @@ if __name__ == '__main__':
         # Read in sequences as dataframe
 
         # Load and test the model
-        ids, results, pred_probabilities = test_grenc(graph_input, fasta_file_input)
+        try:
+            ids, results, pred_probabilities = test_grenc(graph_input, fasta_file_input)
+        except ValueError as error:
+            print(error.args[0])
+            sys.exit(1)
 
         # Save output to file
         output_file = f"{graph_input.split('.')[0]}_grenc_predictions.txt"
@@ -93,3 +182,6 @@ if __name__ == '__main__':
             output.write(f"{id}\t{pred}\t{pred_probability}\n")
         output.close()
         print(f"Results are saved in {output_file}")
+
+    # Print how many inputs were duplicates or taken from the prediction cache
+    prediction_cache.report()
@@ -1,83 +1,183 @@
-import os
 import data_processing
+import model_registry
+import instrumentation
+import prediction_output
+import prediction_cache
 import sys
 import pandas as pd
 import numpy as np
-os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
-import keras as ks
-from sklearn.preprocessing import OneHotEncoder
 
 pd.options.mode.chained_assignment = None  # default='warn'
 
 
+def predict_batches(model, buffer, offsets, graph_matrix, batch_size=None):
+
+    # This method predicts ragged encoded sequences (see data_processing.encode_ragged)
+    # and the sparse graph feature matrix batch by batch
+    # Only the current batch of sequences is padded to 12,000 nt and only the current batch of feature vectors
+    # is stored as dense matrix, if it cannot be predicted as sparse matrix
+    # Identical pairs of sequences and feature vectors are only predicted once and, with a prediction cache, pairs that
+    # were predicted by earlier runs are not predicted at all (see prediction_cache)
+    # By default, the batch size of model_registry is used, which is chosen for the memory budget if one is set
+    # Batches chosen for the memory budget are predicted in one call of the model, see get_predict_batch_size
+
+    if batch_size is None:
+        batch_size = model_registry.get_batch_size("mncr")
+    predict_batch_size = model_registry.get_predict_batch_size("mncr")
+
+    # With the keras backend, the first layer of the graph branch is computed from the sparse feature vectors
+    # (see model_registry.get_sparse_model)
+    sparse_model = model_registry.get_sparse_model(model)
+    if sparse_model is not None:
+        batch_model, iter_graph_batches = sparse_model, data_processing.iter_sparse_batches
+    else:
+        batch_model, iter_graph_batches = model, data_processing.iter_dense_batches
+
+    def predict_rows(rows):
+        prediction = []
+        for sequence_batch, graph_batch in zip(
+                data_processing.iter_padded_batches(*prediction_cache.ragged_rows(buffer, offsets, rows),
+                                                    data_processing.NUCLEOTIDE_PAD_VALUE, batch_size, 12000),
+                iter_graph_batches(prediction_cache.graph_rows(graph_matrix, rows), batch_size)):
+            with instrumentation.stage("predict mncr", sequence_batch.shape[0]):
+                prediction.append(batch_model.predict([sequence_batch, graph_batch], verbose=0,
+                                                      batch_size=predict_batch_size))
+        return np.concatenate(prediction) if len(prediction) > 0 else np.zeros((0, 6), dtype=np.float32)
+
+    # An input of MncR is identified by its sequence and its feature vector
+    digests = [sequence_digest + graph_digest for sequence_digest, graph_digest in
+               zip(prediction_cache.ragged_digests(buffer, offsets), prediction_cache.graph_digests(graph_matrix))]
+    return prediction_cache.predict_unique("mncr", digests, predict_rows, model)
+
+
 def test_mncr(fasta_file_input, graph_input):
 
     # This method loads the trained MncR model and tests it on sequences and their graph features
-    # sequence_df is a dataframe that has the sequence IDs as row names and at least one column named "Seq"
-    # in which Sequences are stored as uppercase Strings including only IUPAC codes for nucleotides
+    # fasta_file_input is either a fasta file or a ragged store created by data_processing.write_ragged_store
+    # Sequences are stored as uppercase Strings including only IUPAC codes for nucleotides
     # graph_input is the path to the file in which the corresponding graph features are saved
-    # These graph features must match the sequences in sequence_df
+    # or a feature store created by data_processing.write_feature_store
+    # These graph features must match the sequences in the fasta file
+
+    # Read in the sequences in the fasta file and encode the nucleotides into integers
+    # The encoded sequences are kept without padding in one buffer
+    ids, buffer, offsets = data_processing.read_encoded_sequences(fasta_file_input, 12000)
 
-    # Read in the sequences in the fasta file
-    sequence_df = data_processing.read_fasta_file(fasta_file_input)
+    # Read the graph feature vectors into a sparse matrix with one row per line of the feature file
+    # A feature store with sequence identifiers returns the rows of the sequences in the fasta file
+    try:
+        graph_matrix = data_processing.read_graph_features(graph_input, ids)
+    except KeyError as error:
+        raise ValueError(f"{error.args[0]}\nGraph Feature file does not match sequence file. Exiting.")
 
     # Test if number of graph feature vector is the same as number of sequences
-    if not data_processing.test_graphfeat_seq_match(sequence_df, graph_input):
-        print("Graph Feature file does not match sequence file. Exiting.")
-        sys.exit()
-
-    # Read graph feature vector into the dataframe in a new column called "feature_vector"
-    sequence_df = data_processing.read_graphprot_vectors(sequence_df,
-                                                         graph_input)
-
-    # Pad sequences to the fixed length of 12,000 nt by appending "_"
-    sequence_input = data_processing.pad_sequences(sequence_df["Seq"], 12000)
-    # Encode the nucleotides into integers
-    sequence_input = data_processing.encode_nucleotides(sequence_input)
-    # Transform the list of lists of integers into one matrix used as input for the model
-    sequence_input = data_processing.transform_seq_into_ml_input(sequence_input)
-    # Save the graph features as a matrix
-    graph_input = np.array(sequence_df.feature_vectors.to_list()).reshape(len(sequence_df.feature_vectors),
-                                                                          len(sequence_df.feature_vectors[0]))
-    # Drop "Seq" and "feature_vector" from data frame to save on memory
-    sequence_df.drop(["Seq", "feature_vectors"], axis=1, inplace=True)
-
-    # Create a one hot encoder with the 6 possible RNA types to return the output as plain text
-    rna_types = ["lncRNA", "miRNA", "rRNA", "snRNA", "snoRNA", "tRNA"]
-    ohe = OneHotEncoder(sparse_output=False)
-    ohe.fit(np.array(rna_types).reshape(-1, 1))
-
-    # Load the model
-    model = ks.models.load_model("model_files/mncr_fold7.hdf5")
-
-    # Predict the ncRNA types from the two inputs
-    prediction = model.predict([sequence_input, graph_input])
-    # Return probability for each prediction
-    pred_probabilities = [np.max(x) for x in prediction]
-    # Convert results to ncRNA types
-    results = ohe.inverse_transform(prediction)
-    results = [x[0] for x in results]
-
-    # Save IDs for return
-    ids = sequence_df.index
+    if graph_matrix.shape[0] != len(ids):
+        raise ValueError(f"Number of lines in {graph_input} does not match number of sequences\n"
+                         "Graph Feature file does not match sequence file. Exiting.")
+
+    # Load the model, it is only loaded once per process
+    model = model_registry.get_model("mncr")
+
+    # Predict the ncRNA types from the two inputs, the sequences are padded to 12,000 nt batch by batch
+    prediction = predict_batches(model, buffer, offsets, graph_matrix)
+    # Convert results to ncRNA types and return probability for each prediction
+    results, pred_probabilities = model_registry.decode_predictions(prediction)
 
     return ids, results, pred_probabilities
 
 
+def test_mncr_streaming(fasta_file_input, graph_input, output_file, chunk_size=10000):
+
+    # This method predicts the sequences of a fasta file and their graph features in chunks of chunk_size sequences
+    # Every chunk is padded, encoded and predicted on its own and its results are appended to output_file
+    # before the next chunk is read, so the memory usage depends on chunk_size and not on the size of the input
+    # The number of graph feature vectors is compared to the number of sequences chunk by chunk
+    # output_file is a text file or, with the probabilities of all classes, a parquet or arrow file,
+    # see prediction_output
+    # Returns the number of predicted sequences
+
+    # Load the model, it is only loaded once per process
+    model = model_registry.get_model("mncr")
+
+    num_predicted = 0
+    output = prediction_output.open_writer(output_file)
+    if data_processing.is_feature_store(graph_input):
+        # Rows of a feature store are fetched by the identifiers of the chunk or by position
+        store = data_processing.FeatureStore(graph_input)
+        graph_chunks = iter(())
+    else:
+        store = None
+        graph_chunks = data_processing.read_graphprot_chunks(graph_input, chunk_size)
+    for sequence_df in data_processing.read_fasta_chunks(fasta_file_input, chunk_size):
+        if store is not None and store.has_ids:
+            try:
+                graph_matrix = store.rows_by_id(list(sequence_df.index))
+            except KeyError as error:
+                print(error.args[0])
+                graph_matrix = None
+        elif store is not None:
+            graph_matrix = store[num_predicted:num_predicted + len(sequence_df)]
+        else:
+            graph_matrix = next(graph_chunks, None)
+        if graph_matrix is None or graph_matrix.shape[0] != len(sequence_df):
+            output.close()
+            raise ValueError(f"Number of lines in {graph_input} does not match number of sequences\n"
+                             "Graph Feature file does not match sequence file. Exiting.")
+
+        # Encode the sequences of the chunk, they are padded batch by batch during the prediction
+        buffer, offsets = data_processing.encode_ragged(sequence_df["Seq"], data_processing.NUCLEOTIDE_TABLE, 12000)
+
+        prediction = predict_batches(model, buffer, offsets, graph_matrix)
+
+        # Append the results of the chunk to the output file
+        output.write(sequence_df.index, prediction)
+        num_predicted = num_predicted + len(sequence_df)
+        print(f"Predicted {num_predicted} sequences")
+    output.close()
+
+    # Feature vectors that are left over after the last sequence also indicate mismatching files
+    if next(graph_chunks, None) is not None or store is not None and not store.has_ids and \
+            store.shape[0] > num_predicted:
+        print(f"Number of lines in {graph_input} does not match number of sequences")
+        print("Graph Feature file does not match sequence file. The predictions might be incorrect.")
+
+    return num_predicted
+
+
 if __name__ == '__main__':
     # Exception for when the command is not properly executed with fasta and feature file
-    if len(sys.argv) != 3:
+    if len(sys.argv) not in (3, 4):
         print("Please enter a fasta file and a graph features file when running the file\n"
+              "Optionally, you may also enter a chunk size to predict large files in chunks of that many "
+              "sequences.\n"
               "Example:\n"
               "python run_mncr.py testing_datasets/small_testset_30.fasta "
-              "testing_datasets/small_testset_30_graphprot.feature")
+              "testing_datasets/small_testset_30_graphprot.feature\n"
+              "or\n"
+              "python run_mncr.py testing_datasets/small_testset_30.fasta "
+              "testing_datasets/small_testset_30_graphprot.feature 10000")
+    elif len(sys.argv) == 4:
+        # Predict the files in chunks and append the results to the output file after every chunk
+        fasta_file_input = sys.argv[1]
+        graph_input = sys.argv[2]
+        output_file = f"{fasta_file_input.split('.')[0]}_mncr_predictions.txt"
+        try:
+            test_mncr_streaming(fasta_file_input, graph_input, output_file, int(sys.argv[3]))
+        except ValueError as error:
+            print(error.args[0])
+            sys.exit(1)
+        print(f"Results are saved in {output_file}")
     else:
         # Identify run parameters
         fasta_file_input = sys.argv[1]
         graph_input = sys.argv[2]
 
         # Load and test the model
-        ids, results, pred_probabilities = test_mncr(fasta_file_input, graph_input)
+        try:
+            ids, results, pred_probabilities = test_mncr(fasta_file_input, graph_input)
+        except ValueError as error:
+            print(error.args[0])
+            sys.exit(1)
 
         # Save output to file
         output_file = f"{fasta_file_input.split('.')[0]}_mncr_predictions.txt"
@@ -86,3 +186,6 @@ if __name__ == '__main__':
             output.write(f"{id}\t{pred}\t{pred_probability}\n")
         output.close()
         print(f"Results are saved in {output_file}")
+
+    # Print how many inputs were duplicates or taken from the prediction cache
+    prediction_cache.report()
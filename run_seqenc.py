@@ -1,61 +1,107 @@
-import os
 import data_processing
+import model_registry
+import instrumentation
+import prediction_output
+import prediction_cache
 import sys
 import pandas as pd
 import numpy as np
-os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
-import keras as ks
-from sklearn.preprocessing import OneHotEncoder
 
 pd.options.mode.chained_assignment = None  # default='warn'
 
 
+def predict_batches(model, buffer, offsets, batch_size=None):
+
+    # This method predicts ragged encoded sequences (see data_processing.encode_ragged) batch by batch
+    # The sequences are only padded to the fixed length of 12,000 nt for the batch that is currently predicted
+    # Identical sequences are only predicted once and, with a prediction cache, sequences that were
+    # predicted by earlier runs are not predicted at all (see prediction_cache)
+    # By default, the batch size of model_registry is used, which is chosen for the memory budget if one is set
+    # Batches chosen for the memory budget are predicted in one call of the model, see get_predict_batch_size
+
+    if batch_size is None:
+        batch_size = model_registry.get_batch_size("seqenc")
+    predict_batch_size = model_registry.get_predict_batch_size("seqenc")
+
+    def predict_rows(rows):
+        prediction = []
+        rows_buffer, rows_offsets = prediction_cache.ragged_rows(buffer, offsets, rows)
+        for sequence_batch in data_processing.iter_padded_batches(rows_buffer, rows_offsets,
+                                                                  data_processing.NUCLEOTIDE_PAD_VALUE, batch_size):
+            with instrumentation.stage("predict seqenc", len(sequence_batch)):
+                prediction.append(model.predict(sequence_batch, verbose=0, batch_size=predict_batch_size))
+        return np.concatenate(prediction) if len(prediction) > 0 else np.zeros((0, 6), dtype=np.float32)
+
+    digests = prediction_cache.ragged_digests(buffer, offsets)
+    return prediction_cache.predict_unique("seqenc", digests, predict_rows, model)
+
+
 def test_seqenc(fasta_file_input):
 
     # This method loads the trained Sequence model and tests it on sequences
-    # sequence_df is a dataframe that has the sequence IDs as row names and at least one column named "Seq"
-    # in which Sequences are stored as uppercase Strings including only IUPAC codes for nucleotides
+    # fasta_file_input is either a fasta file or a ragged store created by data_processing.write_ragged_store
+    # Sequences are stored as uppercase Strings including only IUPAC codes for nucleotides
 
-    # Read in the sequences from the fasta file input
-    sequence_df = data_processing.read_fasta_file(fasta_file_input)
+    # Read in the sequences from the fasta file input and encode the nucleotides into integers
+    # The encoded sequences are kept without padding in one buffer
+    ids, buffer, offsets = data_processing.read_encoded_sequences(fasta_file_input, 12000)
 
-    # Pad sequences to the fixed length of 12,000 nt by appending "_"
-    sequence_input = data_processing.pad_sequences(sequence_df["Seq"], 12000)
-    # Encode the nucleotides into integers
-    sequence_input = data_processing.encode_nucleotides(sequence_input)
-    # Transform the list of lists of integers into one matrix used as input for the model
-    sequence_input = data_processing.transform_seq_into_ml_input(sequence_input)
+    # Load the model, it is only loaded once per process
+    model = model_registry.get_model("seqenc")
 
-    # Drop "Seq" and "feature_vector" from data frame to save on memory
-    sequence_df.drop(["Seq"], axis=1, inplace=True)
+    # Predict the ncRNA types, the sequences are padded to 12,000 nt batch by batch
+    prediction = predict_batches(model, buffer, offsets)
+    # Convert results to ncRNA types and return probability for each prediction
+    results, pred_probabilities = model_registry.decode_predictions(prediction)
 
-    # Create a one hot encoder with the 6 possible RNA types to return the output as plain text
-    rna_types = ["lncRNA", "miRNA", "rRNA", "snRNA", "snoRNA", "tRNA"]
-    ohe = OneHotEncoder(sparse_output=False)
-    ohe.fit(np.array(rna_types).reshape(-1, 1))
+    return ids, results, pred_probabilities
 
-    # Load the model
-    model = ks.models.load_model("model_files/seqenc_fold8.hdf5")
 
-    # Predict the ncRNA types from the two inputs
-    prediction = model.predict(sequence_input)
-    # Return probability for each prediction
-    pred_probabilities = [np.max(x) for x in prediction]
-    # Convert results to ncRNA types
-    results = ohe.inverse_transform(prediction)
-    results = [x[0] for x in results]
+def test_seqenc_streaming(fasta_file_input, output_file, chunk_size=10000):
 
-    ids = sequence_df.index
+    # This method predicts the sequences of a fasta file in chunks of chunk_size sequences
+    # Every chunk is padded, encoded and predicted on its own and its results are appended to output_file
+    # before the next chunk is read, so the memory usage depends on chunk_size and not on the size of the input
+    # output_file is a text file or, with the probabilities of all classes, a parquet or arrow file,
+    # see prediction_output
+    # Returns the number of predicted sequences
 
-    return ids, results, pred_probabilities
+    # Load the model, it is only loaded once per process
+    model = model_registry.get_model("seqenc")
+
+    num_predicted = 0
+    output = prediction_output.open_writer(output_file)
+    for sequence_df in data_processing.read_fasta_chunks(fasta_file_input, chunk_size):
+        # Encode the sequences of the chunk, they are padded batch by batch during the prediction
+        buffer, offsets = data_processing.encode_ragged(sequence_df["Seq"], data_processing.NUCLEOTIDE_TABLE, 12000)
+
+        prediction = predict_batches(model, buffer, offsets)
+
+        # Append the results of the chunk to the output file
+        output.write(sequence_df.index, prediction)
+        num_predicted = num_predicted + len(sequence_df)
+        print(f"Predicted {num_predicted} sequences")
+    output.close()
+
+    return num_predicted
 
 
 if __name__ == '__main__':
     # Exception for when the command is not properly executed with fasta and feature file
-    if len(sys.argv) != 2:
+    if len(sys.argv) not in (2, 3):
         print("Please enter a fasta file when running the file\n"
+              "Optionally, you may also enter a chunk size to predict large fasta files in chunks of that many "
+              "sequences.\n"
               "Example:\n"
-              "python run_seqenc.py testing_datasets/small_testset_30.fasta")
+              "python run_seqenc.py testing_datasets/small_testset_30.fasta\n"
+              "or\n"
+              "python run_seqenc.py testing_datasets/rnacentral_testset.fasta 10000")
+    elif len(sys.argv) == 3:
+        # Predict the fasta file in chunks and append the results to the output file after every chunk
+        fasta_file_input = sys.argv[1]
+        output_file = f"{fasta_file_input.split('.')[0]}_seqenc_predictions.txt"
+        test_seqenc_streaming(fasta_file_input, output_file, int(sys.argv[2]))
+        print(f"Results are saved in {output_file}")
     else:
         # Identify fasta file from run parameter
         fasta_file_input = sys.argv[1]
@@ -70,3 +116,6 @@ if __name__ == '__main__':
             output.write(f"{id}\t{pred}\t{pred_probability}\n")
         output.close()
         print(f"Results are saved in {output_file}")
+
+    # Print how many inputs were duplicates or taken from the prediction cache
+    prediction_cache.report()
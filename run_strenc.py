@@ -1,94 +1,202 @@
-import os
 import data_processing
+import model_registry
+import instrumentation
+import prediction_output
+import prediction_cache
+import structure_prediction
+import sequence_cache
 import sys
 import pandas as pd
 import numpy as np
-os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
-import keras as ks
-from sklearn.preprocessing import OneHotEncoder
 
 pd.options.mode.chained_assignment = None  # default='warn'
 
 
+def predict_batches(model, buffer, offsets, batch_size=None):
+
+    # This method predicts ragged encoded structure sequences (see data_processing.encode_ragged) batch by batch
+    # The structure sequences are only padded to the fixed length of 12,000 for the batch that is currently predicted
+    # Identical structure sequences are only predicted once and, with a prediction cache, structure sequences that were
+    # predicted by earlier runs are not predicted at all (see prediction_cache)
+    # By default, the batch size of model_registry is used, which is chosen for the memory budget if one is set
+    # Batches chosen for the memory budget are predicted in one call of the model, see get_predict_batch_size
+
+    if batch_size is None:
+        batch_size = model_registry.get_batch_size("strenc")
+    predict_batch_size = model_registry.get_predict_batch_size("strenc")
+
+    def predict_rows(rows):
+        prediction = []
+        rows_buffer, rows_offsets = prediction_cache.ragged_rows(buffer, offsets, rows)
+        for structure_batch in data_processing.iter_padded_batches(rows_buffer, rows_offsets,
+                                                                   data_processing.STRUCTURE_PAD_VALUE, batch_size):
+            with instrumentation.stage("predict strenc", len(structure_batch)):
+                prediction.append(model.predict(structure_batch, verbose=0, batch_size=predict_batch_size))
+        return np.concatenate(prediction) if len(prediction) > 0 else np.zeros((0, 6), dtype=np.float32)
+
+    digests = prediction_cache.ragged_digests(buffer, offsets)
+    return prediction_cache.predict_unique("strenc", digests, predict_rows, model)
+
+
 def test_strenc(structure_input):
 
     # This method loads the trained Sequence model and tests it on sequences
     # sequence_df is a dataframe that has the sequence IDs as row names and at least one column named "Seq"
     # in which Sequences are stored as uppercase Strings including only IUPAC codes for nucleotides
 
-    # Open the input file
-    pysster_file = open(structure_input)
-    lines = pysster_file.readlines()
-
+    # Read the identifiers and the annotated structure sequences record by record using struc_annotator_batch
+    # Every chunk of structure sequences is encoded into integers right away and kept without padding
     id_list = []
-    structure_list = []
-
-    # Variable i is used to determine what line we are in
-    # using the modulo operation, we can determine, if the current line contains identifier, sequence or structure
-    i = 0
-    for line in lines:
-        # Read in identifiers
-        if i % 3 == 0:
-            id_list.append(line.strip(">").split(" ")[0].strip("\n"))
-        # Save the most recent nucleotide sequence
-        elif i % 3 == 1:
-            sequence = line.strip("\n")
-        # Read in structure sequences
-        elif i % 3 == 2:
-            struct_seq = (line.strip("\n"))
-            # Annotate the structure sequence using struc_annotator()
-            structure_list.append(data_processing.struc_annotator(sequence, struct_seq))
-        i = i + 1
-
-    pysster_file.close()
-
-    structure_df = pd.DataFrame.from_dict({"id": id_list, "structure": structure_list})
-
-    # Pad the structure sequences to the fixed length of 12,000
-    structure_sequences = data_processing.pad_sequences(structure_df.structure, 12000)
-    # Encode the structure sequence into integers
-    structure_sequences = data_processing.struct_list_annotator(structure_sequences)
-    # Transform the list of lists of integers into one matrix used as input for the model
-    structure_sequences = data_processing.transform_seq_into_ml_input(structure_sequences)
-
-    # Create a one hot encoder with the 6 possible RNA types to return the output as plain text
-    rna_types = ["lncRNA", "miRNA", "rRNA", "snRNA", "snoRNA", "tRNA"]
-    ohe = OneHotEncoder(sparse_output=False)
-    ohe.fit(np.array(rna_types).reshape(-1, 1))
-
-    # Load the model
-    model = ks.models.load_model("model_files/strenc_fold7.hdf5")
-
-    # Predict the ncRNA types from the two inputs
-    prediction = model.predict(structure_sequences)
-    # Return probability for each prediction
-    pred_probabilities = [np.max(x) for x in prediction]
-    # Convert results to ncRNA types
-    results = ohe.inverse_transform(prediction)
-    results = [x[0] for x in results]
+    buffers = [np.zeros(0, dtype=np.uint8)]
+    offsets_list = [np.zeros(1, dtype=np.int64)]
+    for ids, structures in data_processing.read_pysster_chunks(structure_input, 10000):
+        if None in structures:
+            raise ValueError("Structure file contains invalid records. Exiting.")
+        buffer, offsets = data_processing.encode_ragged(structures, data_processing.STRUCTURE_TABLE, 12000)
+        id_list.extend(ids)
+        buffers.append(buffer)
+        offsets_list.append(offsets[1:] + offsets_list[-1][-1])
+
+    buffer = np.concatenate(buffers)
+    offsets = np.concatenate(offsets_list)
+
+    # Load the model, it is only loaded once per process
+    model = model_registry.get_model("strenc")
+
+    # Predict the ncRNA types, the structure sequences are padded to 12,000 batch by batch
+    prediction = predict_batches(model, buffer, offsets)
+    # Convert results to ncRNA types and return probability for each prediction
+    results, pred_probabilities = model_registry.decode_predictions(prediction)
 
     return id_list, results, pred_probabilities
 
 
+def test_strenc_streaming(structure_input, output_file, chunk_size=10000):
+
+    # This method predicts the records of a pysster structure file in chunks of chunk_size records
+    # Every chunk is annotated, padded, encoded and predicted on its own and its results are appended to output_file
+    # before the next chunk is read, so the memory usage depends on chunk_size and not on the size of the input
+    # output_file is a text file or, with the probabilities of all classes, a parquet or arrow file,
+    # see prediction_output
+    # Returns the number of predicted sequences
+
+    # Load the model, it is only loaded once per process
+    model = model_registry.get_model("strenc")
+
+    num_predicted = 0
+    output = prediction_output.open_writer(output_file)
+    for ids, structures in data_processing.read_pysster_chunks(structure_input, chunk_size):
+        if None in structures:
+            output.close()
+            raise ValueError("Structure file contains invalid records. Exiting.")
+
+        # Encode the structure sequences of the chunk, they are padded batch by batch during the prediction
+        buffer, offsets = data_processing.encode_ragged(structures, data_processing.STRUCTURE_TABLE, 12000)
+
+        prediction = predict_batches(model, buffer, offsets)
+
+        # Append the results of the chunk to the output file
+        output.write(ids, prediction)
+        num_predicted = num_predicted + len(ids)
+        print(f"Predicted {num_predicted} sequences")
+    output.close()
+
+    return num_predicted
+
+
+def test_strenc_from_fasta(fasta_file_input, output_file, chunk_size=10000, num_processes=0,
+                           cache_file=sequence_cache.DEFAULT_CACHE_FILE):
+
+    # This method predicts the sequences of a fasta file without a structure file
+    # The structures are predicted and annotated with RNAfold in num_processes processes (by default one per cpu),
+    # see structure_prediction.iter_structure_chunks, and every chunk of chunk_size structures is annotated, encoded
+    # and predicted while the workers already predict the structures of the next chunk
+    # Structures of sequences that are in the cache are not predicted again
+    # Returns the number of predicted sequences
+
+    # Load the model, it is only loaded once per process
+    model = model_registry.get_model("strenc")
+
+    num_predicted = 0
+    output = prediction_output.open_writer(output_file)
+    for ids, sequences, structures in structure_prediction.iter_structure_chunks(fasta_file_input, chunk_size,
+                                                                               num_processes, cache_file):
+        structures = data_processing.struc_annotator_batch(sequences, structures)
+        if None in structures:
+            output.close()
+            raise ValueError("Structure file contains invalid records. Exiting.")
+
+        # Encode the structure sequences of the chunk, they are padded batch by batch during the prediction
+        buffer, offsets = data_processing.encode_ragged(structures, data_processing.STRUCTURE_TABLE, 12000)
+
+        prediction = predict_batches(model, buffer, offsets)
+
+        # Append the results of the chunk to the output file
+        output.write(ids, prediction)
+        num_predicted = num_predicted + len(ids)
+        print(f"Predicted {num_predicted} sequences")
+    output.close()
+
+    return num_predicted
+
+
 if __name__ == '__main__':
     # Exception for when the command is not properly executed with structure file
-    if len(sys.argv) != 2:
+    if len(sys.argv) not in (2, 3):
         print("Please enter a structure file when running the file\n"
+              "Optionally, you may also enter a chunk size to predict large structure files in chunks of that many "
+              "records.\n"
+              "Instead of a structure file, you may also enter a fasta file. Its structures are predicted with the "
+              "python bindings of ViennaRNA on all cpus or, if they are not installed, with pysster. Structures "
+              "predicted in earlier runs are taken from the cache.\n"
               "Example:\n"
-              "python run_strenc.py testing_datasets/small_testset_30_pysster.txt")
+              "python run_strenc.py testing_datasets/small_testset_30_pysster.txt\n"
+              "or\n"
+              "python run_strenc.py testing_datasets/small_testset_30_pysster.txt 10000\n"
+              "or\n"
+              "python run_strenc.py testing_datasets/small_testset_30.fasta")
     else:
         structure_input = sys.argv[1]
-
-        # Load and test the model
-        ids, results, pred_probabilities = test_strenc(structure_input)
-
-        # Save output to file
         output_file = f"{structure_input.split('.')[0]}_strenc_predictions.txt"
-        output = open(output_file, "w")
-        for id, pred, pred_probability in zip(ids, results, pred_probabilities):
-            output.write(f"{id}\t{pred}\t{pred_probability}\n")
-        output.close()
+        if structure_prediction.is_fasta_file(structure_input) and structure_prediction.has_viennarna():
+            # Predict the structures in parallel and stream them into the model without a structure file
+            try:
+                test_strenc_from_fasta(structure_input, output_file, int(sys.argv[2]) if len(sys.argv) == 3 else 10000)
+            except ValueError as error:
+                print(error.args[0])
+                sys.exit(1)
+        else:
+            if structure_prediction.is_fasta_file(structure_input):
+                # Predict the structures of all sequences that are not in the cache with pysster
+                structure_file = f"{structure_input.split('.')[0]}_structures.txt"
+                if not structure_prediction.create_structure_file(structure_input, structure_file):
+                    sys.exit()
+                structure_input = structure_file
+
+            if len(sys.argv) == 3:
+                # Predict the structure file in chunks and append the results to the output file after every chunk
+                try:
+                    test_strenc_streaming(structure_input, output_file, int(sys.argv[2]))
+                except ValueError as error:
+                    print(error.args[0])
+                    sys.exit(1)
+            else:
+                # Load and test the model
+                try:
+                    ids, results, pred_probabilities = test_strenc(structure_input)
+                except ValueError as error:
+                    print(error.args[0])
+                    sys.exit(1)
+
+                # Save output to file
+                output = open(output_file, "w")
+                for id, pred, pred_probability in zip(ids, results, pred_probabilities):
+                    output.write(f"{id}\t{pred}\t{pred_probability}\n")
+                output.close()
         print(f"Results are saved in {output_file}")
 
+    # Print how many inputs were duplicates or taken from the prediction cache
+    prediction_cache.report()
+
     # change "from collections import Mapping" to "from collections.abc import Mapping" in linecloud.py
     # predict_structures("small_testset_30.fasta", "small_testset_30_pysster.txt", annotate=True)
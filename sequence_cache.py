@@ -0,0 +1,161 @@
+import os
+import sys
+import time
+import sqlite3
+import hashlib
+
+# This module provides a local on-disk cache for results that only depend on a sequence and the parameters of the
+# tool that computed them, e.g. GraphProt feature vectors or Pysster structures
+# Entries are keyed by a hash of the sequence and the tool parameters, so identical sequences under different
+# identifiers or from different runs share one entry
+# The cache is a sqlite database, which can safely be used by several processes at the same time
+
+# Default location and size limit of the cache
+DEFAULT_CACHE_FILE = os.path.expanduser("~/.cache/ncrna_classifier/sequence_cache.sqlite")
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+
+# Number of keys per sqlite query, sqlite limits the number of parameters per statement
+QUERY_SIZE = 500
+
+########################################################################################################################
+
+
+def sequence_key(sequence, parameters):
+
+    # This function returns the cache key of a sequence computed with the given tool parameters
+
+    return hashlib.sha256(f"{parameters}\0{sequence}".encode()).hexdigest()
+
+########################################################################################################################
+
+
+class SequenceCache:
+
+    # A size limited key-value store on disk
+    # When the stored values exceed max_bytes, the least recently used entries are evicted
+    # Hits and misses are counted per instance (hits, misses) and in total over all runs (see stats)
+
+    def __init__(self, cache_file=DEFAULT_CACHE_FILE, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_file = cache_file
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        if os.path.dirname(cache_file) != "" and not os.path.isdir(os.path.dirname(cache_file)):
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+
+        # Other processes might write at the same time, so wait for their locks instead of failing
+        self.connection = sqlite3.connect(cache_file, timeout=600, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS entries "
+                                "(key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_access REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)")
+        self.connection.execute("INSERT OR IGNORE INTO stats VALUES ('hits', 0), ('misses', 0), ('bytes', 0)")
+
+    def get_many(self, keys):
+
+        # Returns a dictionary with the cached values of all keys that are in the cache
+        # The access time of the returned entries is updated
+
+        keys = list(dict.fromkeys(keys))
+        values = {}
+        now = time.time()
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            for start in range(0, len(keys), QUERY_SIZE):
+                query_keys = keys[start:start + QUERY_SIZE]
+                placeholders = ",".join("?" * len(query_keys))
+                for key, value in self.connection.execute(
+                        f"SELECT key, value FROM entries WHERE key IN ({placeholders})", query_keys):
+                    values[key] = value
+                self.connection.execute(f"UPDATE entries SET last_access = ? WHERE key IN ({placeholders})",
+                                        [now] + query_keys)
+            self.connection.execute("UPDATE stats SET value = value + ? WHERE name = 'hits'", (len(values),))
+            self.connection.execute("UPDATE stats SET value = value + ? WHERE name = 'misses'",
+                                    (len(keys) - len(values),))
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+
+        self.hits = self.hits + len(values)
+        self.misses = self.misses + len(keys) - len(values)
+        return values
+
+    def put_many(self, items):
+
+        # Stores a dictionary of keys and values (bytes or str) and evicts the least recently used entries
+        # if the cache exceeds its size limit
+
+        now = time.time()
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            for key, value in items.items():
+                value = value.encode() if isinstance(value, str) else bytes(value)
+                old_size = self.connection.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+                self.connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                                        (key, value, len(value), now))
+                self.connection.execute("UPDATE stats SET value = value + ? WHERE name = 'bytes'",
+                                        (len(value) - (old_size[0] if old_size is not None else 0),))
+            self._evict()
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+
+    def _evict(self):
+
+        # Deletes the least recently used entries until the cache is within its size limit
+        # Has to be called within a transaction
+
+        total_bytes = self.connection.execute("SELECT value FROM stats WHERE name = 'bytes'").fetchone()[0]
+        while total_bytes > self.max_bytes:
+            oldest = self.connection.execute("SELECT key, size FROM entries ORDER BY last_access LIMIT 1000").fetchall()
+            if len(oldest) == 0:
+                break
+            freed = 0
+            evicted_keys = []
+            for key, size in oldest:
+                if total_bytes - freed <= self.max_bytes:
+                    break
+                evicted_keys.append(key)
+                freed = freed + size
+            self.connection.execute(f"DELETE FROM entries WHERE key IN ({','.join('?' * len(evicted_keys))})",
+                                    evicted_keys)
+            total_bytes = total_bytes - freed
+            self.connection.execute("UPDATE stats SET value = ? WHERE name = 'bytes'", (total_bytes,))
+
+    def stats(self):
+
+        # Returns the hits and misses of this instance, the hits and misses of all runs,
+        # the number of entries and the size of all stored values in bytes
+
+        totals = dict(self.connection.execute("SELECT name, value FROM stats").fetchall())
+        entries = self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "total_hits": totals["hits"],
+                "total_misses": totals["misses"], "entries": entries, "bytes": totals["bytes"]}
+
+    def report(self, name="Cache"):
+
+        # Prints the hit rate of this instance and the size of the cache
+
+        stats = self.stats()
+        requests = stats["hits"] + stats["misses"]
+        hit_rate = stats["hits"] / requests if requests > 0 else 0
+        print(f"{name}: {stats['hits']} hits, {stats['misses']} misses ({hit_rate:.1%} hit rate), "
+              f"{stats['entries']} entries with {stats['bytes'] / 1024 ** 2:.1f} MB in {self.cache_file}")
+
+    def close(self):
+        self.connection.close()
+
+########################################################################################################################
+
+
+if __name__ == '__main__':
+    # Print the statistics of a cache
+    cache = SequenceCache(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_CACHE_FILE)
+    for name, value in cache.stats().items():
+        if name not in ("hits", "misses"):
+            print(f"{name}: {value}")
+    cache.close()
@@ -0,0 +1,458 @@
+import model_registry
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import data_processing
+import prediction_output
+import prediction_cache
+import predict_ncRNAs
+
+# This module predicts large inputs in ordered shards that are recorded in a job directory, so that an interrupted run
+# continues with the unfinished shards
+# The inputs are split once into shards of shard_size sequences, which are predicted by one or more worker processes
+# Workers on several hosts can share the job directory on a shared filesystem: every worker claims a shard by
+# creating a claim file that no other worker can create at the same time, and a finished shard is recorded by renaming
+# its complete output into place
+# Once all shards are finished, their outputs are concatenated in the order of the input, which gives the same output
+# file as predicting the whole input in chunks of shard_size sequences in one process
+
+# File extensions of the shards of every input
+SHARD_EXTENSIONS = {"fasta": ".fasta", "feature": ".feature", "structure": "_pysster.txt"}
+
+# Seconds after which a claim of a worker that stopped updating it is taken over by other workers
+DEFAULT_CLAIM_TIMEOUT = 600
+
+########################################################################################################################
+
+
+def describe_job(job, shard_size):
+
+    # This function returns the description of a job that is saved in the job directory
+    # Inputs are identified by their absolute path, size and modification time, so that a changed input is noticed
+
+    inputs = {}
+    for key in predict_ncRNAs.MODEL_INPUTS[job["model"]] + predict_ncRNAs.OPTIONAL_INPUTS.get(job["model"], []):
+        if job[key] != "":
+            stat = os.stat(job[key])
+            inputs[key] = {"path": os.path.abspath(job[key]), "size": stat.st_size, "mtime": stat.st_mtime}
+    output_file = job["output"] if job["output"] != "" else predict_ncRNAs.default_output_file(job)
+    return {"model": job["model"], "inputs": inputs, "output": os.path.abspath(output_file), "shard_size": shard_size}
+
+########################################################################################################################
+
+
+def write_json_once(file_name, content):
+
+    # This function atomically creates a json file if it does not exist yet
+    # Returns the content of the file, which is the content of another process if it created the file first
+
+    with open(f"{file_name}.{socket.gethostname()}.{os.getpid()}.tmp", "w") as file:
+        json.dump(content, file, indent=1)
+    try:
+        # A hard link fails if the file exists, also on network filesystems
+        os.link(f"{file_name}.{socket.gethostname()}.{os.getpid()}.tmp", file_name)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(f"{file_name}.{socket.gethostname()}.{os.getpid()}.tmp")
+    with open(file_name, "r") as file:
+        return json.load(file)
+
+########################################################################################################################
+
+
+def create_claim(claim_file):
+
+    # This function creates a claim file with the host and process of the worker
+    # Returns False if the claim file already exists
+
+    try:
+        descriptor = os.open(claim_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(descriptor, "w") as file:
+        json.dump({"host": socket.gethostname(), "pid": os.getpid(), "time": time.time()}, file)
+    return True
+
+########################################################################################################################
+
+
+def read_claim(claim_file):
+
+    # This function returns the content of a claim file and the seconds since it was last updated,
+    # or None if the claim file is being written or was just removed
+
+    try:
+        with open(claim_file, "r") as file:
+            claim_owner = json.load(file)
+        return claim_owner, time.time() - os.path.getmtime(claim_file)
+    except (OSError, ValueError):
+        return None
+
+########################################################################################################################
+
+
+def is_stale(claim_owner, age, claim_timeout):
+
+    # This function checks if the worker of a claim (see read_claim) stopped: its process does not exist anymore
+    # (only known on the same host) or it did not update the claim file for claim_timeout seconds
+
+    if claim_owner["host"] == socket.gethostname():
+        try:
+            os.kill(claim_owner["pid"], 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+    return age > claim_timeout
+
+########################################################################################################################
+
+
+def claim(claim_file, claim_timeout=DEFAULT_CLAIM_TIMEOUT):
+
+    # This function claims a shard or the splitting of the inputs for the current worker
+    # Stale claims are moved away before they are taken over, which only succeeds for one worker
+    # Returns True if the claim belongs to the current worker
+
+    if create_claim(claim_file):
+        return True
+    inspected = read_claim(claim_file)
+    if inspected is None or not is_stale(*inspected, claim_timeout):
+        return False
+    stale_file = f"{claim_file}.stale.{socket.gethostname()}.{os.getpid()}"
+    try:
+        os.rename(claim_file, stale_file)
+    except FileNotFoundError:
+        return False
+    # Another worker might have taken over the stale claim between the check and the rename, its new claim is
+    # put back unless yet another claim was created in the meantime
+    moved = read_claim(stale_file)
+    if moved is None or moved[0] != inspected[0]:
+        try:
+            os.link(stale_file, claim_file)
+        except FileExistsError:
+            pass
+        os.remove(stale_file)
+        return False
+    os.remove(stale_file)
+    return create_claim(claim_file)
+
+########################################################################################################################
+
+
+def release(claim_file):
+
+    # This function removes a claim of the current worker, claims that were taken over by other workers are kept
+
+    try:
+        with open(claim_file, "r") as file:
+            claim_owner = json.load(file)
+    except (OSError, ValueError):
+        return
+    if claim_owner["host"] == socket.gethostname() and claim_owner["pid"] == os.getpid():
+        os.remove(claim_file)
+
+########################################################################################################################
+
+
+class ClaimUpdater:
+
+    # Updates the modification time of a claim file while its shard is predicted, so that other workers can tell
+    # a running worker from a stopped one
+
+    def __init__(self, claim_file, claim_timeout):
+        self.claim_file = claim_file
+        self.interval = max(1, min(60, claim_timeout / 4))
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                os.utime(self.claim_file)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        self.thread.join()
+        return False
+
+########################################################################################################################
+
+
+def split_inputs(description, shard_dir):
+
+    # This function splits all inputs of a job into shards of shard_size sequences in the order of the input
+    # The inputs of the i-th shard are saved in shard_dir as shard_0000i.fasta, shard_0000i.feature and
+    # shard_0000i_pysster.txt
+    # Returns the description of the shards, or raises a ValueError if the inputs contain different numbers of sequences
+
+    shard_size = description["shard_size"]
+    num_sequences = {}
+    for key, input_file in description["inputs"].items():
+        if key == "fasta":
+            chunks = ("".join(f">{seq_id}\n{sequence}\n" for seq_id, sequence in zip(ids, sequences))
+                      for ids, sequences in data_processing.iter_fasta_batches(input_file["path"], shard_size))
+            lines_per_sequence = 2
+        else:
+            if key == "feature" and data_processing.is_feature_store(input_file["path"]):
+                raise ValueError("Sharded runs need a graphprot feature file, not a feature store")
+            # Feature files contain one line per sequence and pysster files three lines per sequence
+            lines_per_sequence = 1 if key == "feature" else 3
+            lines = open(input_file["path"], "r")
+            chunks = iter(lambda: "".join(itertools.islice(lines, shard_size * lines_per_sequence)), "")
+
+        num_sequences[key] = 0
+        for i, chunk in enumerate(chunks):
+            with open(f"{shard_dir}/shard_{i:05d}{SHARD_EXTENSIONS[key]}", "w") as file:
+                file.write(chunk)
+            num_lines = chunk.count("\n") + (0 if chunk.endswith("\n") else 1)
+            num_sequences[key] = num_sequences[key] + num_lines // lines_per_sequence
+        if key != "fasta":
+            lines.close()
+
+    if len(set(num_sequences.values())) > 1:
+        raise ValueError("The inputs contain different numbers of sequences: " +
+                         ", ".join(f"{num} in {description['inputs'][key]['path']}"
+                                   for key, num in num_sequences.items()))
+    num_total = list(num_sequences.values())[0]
+    return {"sequences": num_total,
+            "shards": [{"name": f"shard_{i:05d}", "sequences": min(shard_size, num_total - i * shard_size)}
+                       for i in range((num_total + shard_size - 1) // shard_size)]}
+
+########################################################################################################################
+
+
+def prepare_job(job_dir, job, shard_size, claim_timeout=DEFAULT_CLAIM_TIMEOUT):
+
+    # This function creates the job directory and splits the inputs into shards, or checks that an existing job
+    # directory belongs to the same job
+    # If another worker is splitting the inputs, it waits until the shards exist
+    # Returns the description of the job and of the shards
+
+    shard_dir = f"{job_dir}/shards"
+    os.makedirs(shard_dir, exist_ok=True)
+    description = describe_job(job, shard_size)
+    existing = write_json_once(f"{job_dir}/job.json", description)
+    if existing != description:
+        raise ValueError(f"{job_dir} belongs to a different job or its inputs changed, "
+                         f"use another job directory or remove {job_dir}")
+
+    while not os.path.isfile(f"{job_dir}/shards.json"):
+        if claim(f"{job_dir}/split.claim", claim_timeout):
+            try:
+                with ClaimUpdater(f"{job_dir}/split.claim", claim_timeout):
+                    print(f"Splitting the inputs into shards of {shard_size} sequences")
+                    shards = split_inputs(description, shard_dir)
+                write_json_once(f"{job_dir}/shards.json", shards)
+            finally:
+                release(f"{job_dir}/split.claim")
+        else:
+            time.sleep(5)
+
+    with open(f"{job_dir}/shards.json", "r") as file:
+        return description, json.load(file)
+
+########################################################################################################################
+
+
+def shard_output_file(job_dir, description, shard):
+
+    # This function returns the output file of a finished shard, which has the format of the output of the job
+
+    extension = os.path.splitext(description["output"])[1]
+    return f"{job_dir}/shards/{shard['name']}{extension if extension != '' else '.txt'}"
+
+########################################################################################################################
+
+
+def run_shard(job_dir, description, shard, chunk_size=0):
+
+    # This function predicts one shard with predict_ncRNAs.run_job
+    # The output is written under a temporary name and renamed once it is complete, which records the shard as finished
+
+    output_file = shard_output_file(job_dir, description, shard)
+    base, extension = os.path.splitext(output_file)
+    # The temporary file keeps the extension, which determines the output format
+    temporary_file = f"{base}.{socket.gethostname()}.{os.getpid()}.tmp{extension}"
+    shard_job = {"model": description["model"], "fasta": "", "feature": "", "structure": "",
+                 "output": temporary_file}
+    for key in description["inputs"]:
+        shard_job[key] = f"{job_dir}/shards/{shard['name']}{SHARD_EXTENSIONS[key]}"
+
+    try:
+        temporary_file, num_predicted = predict_ncRNAs.run_job(shard_job, chunk_size)
+    except Exception:
+        # The partial output of a failed shard is not kept
+        if os.path.isfile(temporary_file):
+            os.remove(temporary_file)
+        raise
+    if num_predicted != shard["sequences"]:
+        os.remove(temporary_file)
+        raise ValueError(f"{num_predicted} of {shard['sequences']} sequences of {shard['name']} were predicted")
+    os.replace(temporary_file, output_file)
+
+########################################################################################################################
+
+
+def work_on_shards(job_dir, chunk_size=0, claim_timeout=DEFAULT_CLAIM_TIMEOUT):
+
+    # This function claims and predicts unfinished shards in the order of the input until every shard is finished or
+    # claimed by another worker
+    # Returns the number of predicted and failed shards
+
+    with open(f"{job_dir}/job.json", "r") as file:
+        description = json.load(file)
+    with open(f"{job_dir}/shards.json", "r") as file:
+        shards = json.load(file)["shards"]
+
+    num_predicted = 0
+    num_failed = 0
+    for shard in shards:
+        claim_file = f"{job_dir}/shards/{shard['name']}.claim"
+        if os.path.isfile(shard_output_file(job_dir, description, shard)) or not claim(claim_file, claim_timeout):
+            continue
+        try:
+            # The shard might have been finished by a worker whose claim was just removed
+            if not os.path.isfile(shard_output_file(job_dir, description, shard)):
+                start_time = time.time()
+                with ClaimUpdater(claim_file, claim_timeout):
+                    run_shard(job_dir, description, shard, chunk_size)
+                num_predicted = num_predicted + 1
+                print(f"{shard['name']} finished by {socket.gethostname()} ({os.getpid()}): {shard['sequences']} "
+                      f"sequences in {time.time() - start_time:.2f}s")
+        except Exception as error:
+            num_failed = num_failed + 1
+            print(f"{shard['name']} failed: {error}")
+        finally:
+            # Other workers can retry the shard right away
+            release(claim_file)
+
+    return num_predicted, num_failed
+
+########################################################################################################################
+
+
+def init_worker(backend, cache_file, num_threads):
+
+    # This function configures a worker process like the process that started it
+
+    model_registry.set_backend(backend)
+    prediction_cache.enable(cache_file)
+    if num_threads > 0:
+        model_registry.set_threads(num_threads, 1)
+
+########################################################################################################################
+
+
+def run_sharded_job(job, job_dir, shard_size=100000, num_workers=1, chunk_size=0,
+                    claim_timeout=DEFAULT_CLAIM_TIMEOUT):
+
+    # This function predicts a job (see predict_ncRNAs.run_job) in shards of shard_size sequences with num_workers
+    # worker processes, which share the cores of the host
+    # More workers can be started on other hosts with the same job directory at any time
+    # The output file of the job is written once all shards are finished, by whichever worker finishes last
+    # Returns True if the output file was written
+
+    description, shards = prepare_job(job_dir, job, shard_size, claim_timeout)
+    shard_files = [shard_output_file(job_dir, description, shard) for shard in shards["shards"]]
+    num_finished = sum(os.path.isfile(file) for file in shard_files)
+    print(f"{num_finished} of {len(shard_files)} shards are already finished, "
+          f"predicting the remaining shards with {num_workers} workers")
+
+    start_time = time.time()
+    if num_workers > 1:
+        # Every worker loads the models itself, so the cores are divided among the workers
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=init_worker,
+                                 initargs=(model_registry.backend, prediction_cache.cache_file,
+                                           max(1, (os.cpu_count() or 1) // num_workers))) as executor:
+            futures = [executor.submit(work_on_shards, job_dir, chunk_size, claim_timeout)
+                       for _ in range(num_workers)]
+            results = [future.result() for future in futures]
+    else:
+        results = [work_on_shards(job_dir, chunk_size, claim_timeout)]
+    num_failed = sum(failed for predicted, failed in results)
+
+    num_finished = sum(os.path.isfile(file) for file in shard_files)
+    if num_finished < len(shard_files):
+        print(f"{num_finished} of {len(shard_files)} shards are finished "
+              f"({num_failed} failed, the others are claimed by other workers)\n"
+              f"Run again with the same job directory to continue, finished shards are kept in {job_dir}/shards")
+        return False
+
+    prediction_output.merge_files(shard_files, description["output"])
+    print(f"Predicted {shards['sequences']} sequences in {(time.time() - start_time) / 60:.1f} min, "
+          f"results are saved in {description['output']}")
+    return True
+
+########################################################################################################################
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Predict large inputs in shards that are recorded in a job "
+                                                 "directory. Interrupted runs continue with the unfinished shards "
+                                                 "and workers on several hosts can share the job directory.")
+    parser.add_argument("job_dir", help="Job directory, workers of the same job have to use the same directory")
+    parser.add_argument("--model", default="", type=str.lower, choices=list(predict_ncRNAs.MODEL_INPUTS),
+                        help="Model of a new job, workers of an existing job take the job from the job directory")
+    parser.add_argument("--fasta", default="", help="Fasta file (MncR, SeqEnc, optionally GrEnc)")
+    parser.add_argument("--feature", default="", help="GraphProt feature file (MncR, GrEnc)")
+    parser.add_argument("--structure", default="", help="Pysster structure file (StrEnc)")
+    parser.add_argument("--output", default="",
+                        help="Output file, by default [input_name]_[model]_prediction.txt, files ending with "
+                             ".parquet, .arrow or .feather contain the probabilities of all classes")
+    parser.add_argument("--shard-size", type=int, default=100000, help="Number of sequences per shard")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes on this host")
+    parser.add_argument("--chunk-size", type=int, default=0,
+                        help="Predict every shard in chunks of that many sequences")
+    parser.add_argument("--claim-timeout", type=float, default=DEFAULT_CLAIM_TIMEOUT,
+                        help="Seconds after which shards of workers on other hosts that stopped are taken over")
+    parser.add_argument("--backend", default=model_registry.backend, choices=list(model_registry.BACKENDS))
+    parser.add_argument("--prediction-cache", default=prediction_cache.cache_file,
+                        help="Prediction cache file shared by the workers, see prediction_cache.py")
+    args = parser.parse_args()
+    model_registry.set_backend(args.backend)
+    prediction_cache.enable(args.prediction_cache)
+
+    if args.model != "":
+        sharded_job = {"model": args.model, "fasta": args.fasta, "feature": args.feature,
+                       "structure": args.structure, "output": args.output}
+        error = predict_ncRNAs.check_job(sharded_job)
+        shard_size = args.shard_size
+    elif os.path.isfile(f"{args.job_dir}/job.json"):
+        # Join an existing job with the inputs and shard size it was created with
+        with open(f"{args.job_dir}/job.json", "r") as file:
+            existing_job = json.load(file)
+        sharded_job = {"model": existing_job["model"], "fasta": "", "feature": "", "structure": "",
+                       "output": existing_job["output"]}
+        sharded_job.update({key: input_file["path"] for key, input_file in existing_job["inputs"].items()})
+        error = predict_ncRNAs.check_job(sharded_job)
+        shard_size = existing_job["shard_size"]
+    else:
+        error = f"{args.job_dir} does not contain a job, please provide --model and its inputs"
+    if error != "":
+        print(error)
+        sys.exit(1)
+
+    try:
+        success = run_sharded_job(sharded_job, args.job_dir, shard_size, args.workers, args.chunk_size,
+                                  args.claim_timeout)
+    except ValueError as error:
+        print(error.args[0])
+        sys.exit(1)
+    prediction_cache.report()
+    sys.exit(0 if success else 1)
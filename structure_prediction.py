@@ -0,0 +1,255 @@
+import os
+import sys
+import itertools
+import multiprocessing
+from collections import deque
+import numpy as np
+import data_processing
+import sequence_cache
+from Bio import SeqIO
+
+# This module creates the structure files used by StrEnc from a fasta file
+# The structures are predicted by pysster (RNAfold and the annotation of the substructures), structures of sequences
+# that were already predicted are taken from a cache (see sequence_cache), so only new sequences are predicted
+# If the python bindings of ViennaRNA are installed, iter_structure_chunks predicts and annotates the structures
+# in a pool of processes without pysster and without an intermediate structure file
+
+# The structure of a sequence is cached under the sequence and the parameters of the prediction
+CACHE_PARAMETERS = "pysster.utils.predict_structures annotate=True"
+RNAFOLD_CACHE_PARAMETERS = "ViennaRNA RNA.fold annotated with F, S, I, M, H and T"
+
+# File extensions of fasta files, any other file given to StrEnc is expected to be a structure file
+FASTA_EXTENSIONS = (".fasta", ".fa", ".fna", ".fas")
+
+########################################################################################################################
+
+
+def is_fasta_file(filename):
+
+    # This function returns True if the file name has the extension of a fasta file
+
+    return filename.lower().endswith(FASTA_EXTENSIONS)
+
+########################################################################################################################
+
+
+def has_viennarna():
+
+    # This function returns True if the python bindings of ViennaRNA (module RNA) can be imported
+
+    try:
+        import RNA
+    except ImportError:
+        return False
+    return True
+
+########################################################################################################################
+
+
+def annotate_structure(dot_bracket):
+
+    # This function annotates every position of a structure in dot-bracket notation with the substructure it belongs to
+    # in the same way as pysster: F (5'-end), T (3'-end), S (stem), H (hairpin loop), I (inner loop or bulge)
+    # and M (multi loop)
+    # Unpaired positions are annotated by the loop they are part of, which is defined by the closest enclosing base pair
+    # and the number of branches within it: no branch is a hairpin loop, one branch an inner loop and more branches
+    # a multi loop. Unpaired positions between the branches of the exterior loop count as multi loop as well
+
+    annotation = ["S"] * len(dot_bracket)
+    num_branches = {}
+    enclosing = []
+    for i, char in enumerate(dot_bracket):
+        if char == "(":
+            if len(enclosing) > 0:
+                num_branches[enclosing[-1]] = num_branches.get(enclosing[-1], 0) + 1
+            enclosing.append(i)
+        elif char == ")":
+            enclosing.pop()
+        else:
+            # The loop type is not known yet, so the enclosing base pair is stored
+            annotation[i] = enclosing[-1] if len(enclosing) > 0 else -1
+
+    first_pair, last_pair = dot_bracket.find("("), dot_bracket.rfind(")")
+    for i, loop in enumerate(annotation):
+        if loop == "S":
+            continue
+        if loop == -1:
+            annotation[i] = "F" if i < first_pair or first_pair == -1 else "T" if i > last_pair else "M"
+        else:
+            annotation[i] = {0: "H", 1: "I"}.get(num_branches.get(loop, 0), "M")
+
+    return "".join(annotation)
+
+########################################################################################################################
+
+
+def fold_and_annotate(sequence):
+
+    # This function predicts the minimum free energy structure of a sequence with RNAfold (ViennaRNA)
+    # and returns its annotation, see annotate_structure
+    # It is run in the worker processes of iter_structure_chunks
+
+    import RNA
+    dot_bracket, mfe = RNA.fold(sequence)
+    return annotate_structure(dot_bracket)
+
+########################################################################################################################
+
+
+def iter_structure_chunks(fasta_file, chunk_size=10000, num_processes=0, cache_file=""):
+
+    # This function predicts and annotates the structures of all sequences of a fasta file with RNAfold
+    # in num_processes processes (by default one per cpu) and yields them in chunks of chunk_size sequences
+    # as tuples of (identifiers, sequences, structures) in the order of the input
+    # The next chunk is already predicted while the current chunk is processed by the caller, so that the workers
+    # do not wait for the caller
+    # If a cache_file is given, only the structures that are not in the cache are predicted
+    # The workers are spawned instead of forked, the caller may already have loaded tensorflow, which must not be
+    # copied into forked processes
+
+    if num_processes <= 0:
+        num_processes = os.cpu_count() or 1
+    cache = sequence_cache.SequenceCache(cache_file) if cache_file != "" else None
+
+    def finish_chunk(ids, sequences, keys, cached, predicted):
+        predicted = iter(predicted.get())
+        structures = [cached[key].decode() if key in cached else next(predicted) for key in keys]
+        if cache is not None:
+            cache.put_many({key: structure for key, structure in zip(keys, structures) if key not in cached})
+        return ids, sequences, structures
+
+    records = SeqIO.parse(fasta_file, "fasta")
+    pending = deque()
+    with multiprocessing.get_context("spawn").Pool(num_processes) as pool:
+        while True:
+            chunk = list(itertools.islice(records, chunk_size))
+            if len(chunk) == 0:
+                break
+            ids = [rec.id for rec in chunk]
+            sequences = [str(rec.seq).upper() for rec in chunk]
+            keys = [sequence_cache.sequence_key(sequence, RNAFOLD_CACHE_PARAMETERS) for sequence in sequences]
+            cached = cache.get_many(keys) if cache is not None else {}
+            misses = [sequence for sequence, key in zip(sequences, keys) if key not in cached]
+
+            # Small tasks balance the load if a few long sequences take much longer than the others
+            predicted = pool.map_async(fold_and_annotate, misses,
+                                       chunksize=max(1, len(misses) // (num_processes * 16)))
+            pending.append((ids, sequences, keys, cached, predicted))
+            if len(pending) > 1:
+                yield finish_chunk(*pending.popleft())
+        while len(pending) > 0:
+            yield finish_chunk(*pending.popleft())
+
+    if cache is not None:
+        cache.report("Structure cache")
+        cache.close()
+
+########################################################################################################################
+
+
+def split_cached_structures(fasta_file, hits_file, misses_file, cache, chunk_size=10000):
+
+    # This function looks up the structures of all sequences of a fasta file in the cache
+    # Cached structures are written line by line in the order of the input to hits_file and all other sequences
+    # to the fasta file misses_file
+    # Returns a boolean array that is True for every sequence with a cached structure
+
+    is_cached = []
+    records = SeqIO.parse(fasta_file, "fasta")
+    with open(hits_file, "wb") as hits, open(misses_file, "w") as misses:
+        while True:
+            chunk = list(itertools.islice(records, chunk_size))
+            if len(chunk) == 0:
+                break
+            keys = [sequence_cache.sequence_key(str(rec.seq), CACHE_PARAMETERS) for rec in chunk]
+            cached = cache.get_many(keys)
+            for rec, key in zip(chunk, keys):
+                if key in cached:
+                    hits.write(cached[key] + b"\n")
+                else:
+                    SeqIO.write(rec, misses, "fasta")
+                is_cached.append(key in cached)
+
+    return np.array(is_cached, dtype=bool)
+
+########################################################################################################################
+
+
+def create_structure_file(fasta_file, structure_file, cache_file=sequence_cache.DEFAULT_CACHE_FILE,
+                          cache_max_bytes=sequence_cache.DEFAULT_MAX_BYTES, num_processes=None):
+
+    # This function creates a structure file in the pysster format (identifier, sequence, structure) for a fasta file
+    # Only the structures of sequences that are not in the cache are predicted with pysster and added to the cache
+    # Set cache_file to "" to predict all sequences without a cache
+    # Returns True if the structure file was created
+
+    hits_file, misses_file = f"{structure_file}.cache_hits", f"{structure_file}.cache_misses.fasta"
+    predicted_file = f"{structure_file}.cache_misses.txt"
+
+    cache = None
+    if cache_file != "":
+        cache = sequence_cache.SequenceCache(cache_file, cache_max_bytes)
+        is_cached = split_cached_structures(fasta_file, hits_file, misses_file, cache)
+        print(f"{is_cached.sum()} of {len(is_cached)} structures are taken from the cache {cache_file}")
+    else:
+        is_cached = np.zeros(sum(1 for rec in SeqIO.parse(fasta_file, "fasta")), dtype=bool)
+        misses_file = fasta_file
+
+    if not is_cached.all():
+        try:
+            from pysster.utils import predict_structures
+        except ImportError:
+            print("Could not import pysster, which is needed to predict the structures. "
+                  "Please install pysster (see README) or provide a structure file")
+            return False
+        predict_structures(misses_file, predicted_file, num_processes, annotate=True)
+
+        # Add the predicted structures to the cache, the records of pysster are in the order of its input
+        if cache is not None:
+            predicted = data_processing.read_pysster_file(predicted_file)
+            records = SeqIO.parse(misses_file, "fasta")
+            while True:
+                chunk = list(itertools.islice(zip(records, predicted), 10000))
+                if len(chunk) == 0:
+                    break
+                cache.put_many({sequence_cache.sequence_key(str(rec.seq), CACHE_PARAMETERS): structure
+                                for rec, (seq_id, sequence, structure) in chunk})
+
+    # Merge the cached and the predicted structures in the order of the input
+    with open(f"{structure_file}.tmp", "w") as output:
+        hits = open(hits_file, "r") if is_cached.any() else None
+        predicted = data_processing.read_pysster_file(predicted_file) if not is_cached.all() else None
+        for rec, cached in zip(SeqIO.parse(fasta_file, "fasta"), is_cached):
+            if cached:
+                output.write(f">{rec.description}\n{rec.seq}\n{next(hits)}")
+            else:
+                seq_id, sequence, structure = next(predicted)
+                output.write(f">{rec.description}\n{sequence}\n{structure}\n")
+        if hits is not None:
+            hits.close()
+    os.replace(f"{structure_file}.tmp", structure_file)
+
+    for file in (hits_file, predicted_file, f"{structure_file}.cache_misses.fasta"):
+        if os.path.isfile(file):
+            os.remove(file)
+
+    if cache is not None:
+        cache.report("Structure cache")
+        cache.close()
+    print(f"Structures of {len(is_cached)} sequences are saved in {structure_file}")
+    return True
+
+########################################################################################################################
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (3, 4):
+        print("Please enter a fasta file and the structure file that is created\n"
+              "Optionally, you may also enter a cache file, which defaults to "
+              f"{sequence_cache.DEFAULT_CACHE_FILE} (use \"\" to disable the cache)\n"
+              "Example:\n"
+              "python structure_prediction.py testing_datasets/small_testset_30.fasta small_testset_30_pysster.txt")
+    else:
+        success = create_structure_file(sys.argv[1], sys.argv[2],
+                                        sys.argv[3] if len(sys.argv) == 4 else sequence_cache.DEFAULT_CACHE_FILE)
+        sys.exit(0 if success else 1)